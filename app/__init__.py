@@ -18,7 +18,16 @@ principal = Principal()
 cdn = CDN()
 toolbar = DebugToolbarExtension()
 mail = Mail()
-local_redis = redis.StrictRedis(host='localhost', port=6379, db=0)
+local_redis = redis.StrictRedis(connection_pool=redis.BlockingConnectionPool(host='localhost', port=6379, db=0))
+
+
+def init_redis(app):
+    # swap in a pool sized for this process before the first command is sent
+    pool = redis.BlockingConnectionPool.from_url(app.config['REDIS_URL'],
+                                                 max_connections=app.config['REDIS_MAX_CONNECTIONS'],
+                                                 timeout=app.config['REDIS_POOL_TIMEOUT'])
+    local_redis.connection_pool.disconnect()
+    local_redis.connection_pool = pool
 
 
 def create_app(config_name):
@@ -27,6 +36,7 @@ def create_app(config_name):
     app.template_folder = 'templates'
     config[config_name].init_app(app)
     app.config.from_object(config[config_name])
+    init_redis(app)
     db.init_app(app)
     login_manager.init_app(app)
     login_manager.session_protection = 'basic'
@@ -75,8 +85,7 @@ def create_app(config_name):
 
     if config_name != 'testing':
         from app import statisitc
-        with app.app_context():
-            statisitc.init_statistic()
+        app.before_request(statisitc.refresh)
 
     return app
 
@@ -85,6 +94,7 @@ def create_celery_app():
     app = Flask(__name__)
     config['celery'].init_app(app)
     app.config.from_object(config['celery'])
+    init_redis(app)
     db.init_app(app)
     mail.init_app(app)
     return app
@@ -48,3 +48,15 @@ VENDOR_REMINDS_PENDING = 'VENDOR_REMINDS_PENDING'
 DISTRIBUTOR_REMINDS = 'DISTRIBUTOR_REMINDS'
 
 ADMIN_EMAIL_REMINDS = 'ADMIN_EMAIL_REMINDS'
+
+STATISTIC_SNAPSHOT = 'STATISTIC_SNAPSHOT'
+STATISTIC_VERSION = 'STATISTIC_VERSION'
+STATISTIC_SERIAL = 'STATISTIC_SERIAL'
+STATISTIC_PATCHES = 'STATISTIC_PATCHES'
+STATISTIC_LOCK = 'STATISTIC_LOCK'
+
+ITEM_DUMPS = 'ITEM_DUMPS'
+ITEM_COMPARE = 'ITEM_COMPARE'
+ITEM_COVER = 'ITEM_COVER'
+GEO_CODING = 'GEO_CODING'
+GEO_CODING_MISS = 'GEO_CODING_MISS'
@@ -1,13 +1,16 @@
 # -*- coding: utf-8 -*-
+import csv
+import json
+
 from flask import current_app
 from flask.ext.login import login_user, current_user
 from flask.ext.principal import identity_changed, Identity
 from wtforms import StringField, PasswordField
 from wtforms.validators import DataRequired, Length, EqualTo, ValidationError
 
-from app import db
+from app import db, statisitc
 from app.forms import Form
-from app.models import Distributor, DistributorAddress
+from app.models import Distributor, DistributorAddress, Item, Stock
 from app.utils.validator import AreaValidator
 from app.tasks import distributor_geo_coding
 
@@ -106,3 +109,49 @@ class SettingsForm(Form):
         current_user.address.update_distributor_amount()
         if geo_coding:
             distributor_geo_coding.delay(current_user.id, current_user.address.id)
+
+
+class StockImportForm(Form):
+    # csv lines of item_id,...,stock (the export of /distributor/items/stock, with its header, works as is) or a
+    # json list of {"item_id": , "stock": }
+    stocks = StringField(validators=[DataRequired(u'库存数据不能为空')])
+
+    stock_dict = None
+
+    def validate_stocks(self, field):
+        try:
+            if field.data.lstrip().startswith('['):
+                rows = [(row['item_id'], row['stock']) for row in json.loads(field.data)]
+            else:
+                lines = [row for row in csv.reader(field.data.splitlines()) if row]
+                # columns by header when there is one, item_id first and stock last otherwise
+                id_column, stock_column = 0, -1
+                if lines and lines[0][0].strip() == 'item_id':
+                    header = [name.strip() for name in lines.pop(0)]
+                    id_column, stock_column = header.index('item_id'), header.index('stock')
+                rows = [(row[id_column], row[stock_column]) for row in lines]
+            stock_dict = {int(item_id): int(stock) for item_id, stock in rows}
+        except (ValueError, TypeError, KeyError, IndexError):
+            raise ValidationError(u'库存数据格式不正确')
+        if not stock_dict:
+            raise ValidationError(u'库存数据不能为空')
+        if set(stock_dict.values()) - {0, 1}:
+            raise ValidationError(u'库存只能为0或1')
+        owned = {item.id for item in db.session.query(Item.id).filter(
+            Item.id.in_(stock_dict), Item.vendor_id == current_user.vendor_id, Item.is_deleted == False,
+            Item.is_component == False)}
+        if len(owned) != len(stock_dict):
+            raise ValidationError(u'无此商品: %s' % ','.join(map(str, sorted(set(stock_dict) - owned)[:20])))
+        self.stock_dict = stock_dict
+
+    def import_stocks(self):
+        stocks = {stock.item_id: stock for stock in
+                  Stock.query.filter(Stock.distributor_id == current_user.id, Stock.item_id.in_(self.stock_dict))}
+        for item_id, amount in self.stock_dict.items():
+            if item_id in stocks:
+                stocks[item_id].stock = amount
+            else:
+                db.session.add(Stock(item_id, current_user.id, amount))
+        db.session.commit()
+        statisitc.stock_changed(current_user.id, list(self.stock_dict))
+        return len(self.stock_dict)
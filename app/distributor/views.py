@@ -1,16 +1,20 @@
 # -*- coding: utf-8 -*-
-from flask import current_app, render_template, request, redirect, session, url_for, jsonify, abort
+import csv
+import io
+
+from flask import current_app, render_template, request, redirect, session, url_for, jsonify, abort, Response, \
+    stream_with_context
 from flask.ext.login import login_user, logout_user, current_user
 from flask.ext.principal import identity_changed, Identity, AnonymousIdentity
 
-from app import db
+from app import db, statisitc
 from app.models import Vendor, Stock, Item
 from app.constants import DISTRIBUTOR_REGISTER
 from app.permission import distributor_permission
-from app.utils import DataTableHandler
+from app.utils import DataTableHandler, chunked_query
 from app.utils.redis import redis_get
 from . import distributor as distributor_blueprint
-from .forms import LoginForm, RegisterForm, SettingsForm
+from .forms import LoginForm, RegisterForm, SettingsForm, StockImportForm
 
 
 @distributor_blueprint.errorhandler(401)
@@ -86,9 +90,11 @@ def items_stock():
 @distributor_blueprint.route('/items/datatable')
 @distributor_permission.require(401)
 def items_data_table():
-    def handle_stock(item):
-        stock = Stock.query.filter_by(distributor_id=current_user.id, item_id=item.id).first()
-        return stock.stock if stock else 0
+    stocks = {}
+
+    def prefetch_stock(items):
+        stocks.update((stock.item_id, stock.stock) for stock in Stock.query.filter(
+            Stock.distributor_id == current_user.id, Stock.item_id.in_([item.id for item in items])))
 
     params = {
         'id': {'orderable': False, 'data': lambda x: x.id},
@@ -97,10 +103,10 @@ def items_data_table():
         'scene_id': {'orderable': False, 'data': lambda x: x.scene},
         'size': {'orderable': False, 'data': lambda x: x.size},
         'price': {'orderable': True, 'order_key': Item.price, 'data': lambda x: x.price},
-        'inventory': {'orderable': False, 'data': handle_stock}
+        'inventory': {'orderable': False, 'prefetch': prefetch_stock, 'data': lambda x: stocks.get(x.id, 0)}
     }
     query = Item.query.filter_by(vendor_id=current_user.vendor.id, is_deleted=False, is_component=False)
-    data_table_handler = DataTableHandler(params)
+    data_table_handler = DataTableHandler(params, key=Item.id)
     data = data_table_handler.query_params(query)
     return jsonify(data)
 
@@ -120,9 +126,44 @@ def item_stock(item_id):
         stock.stock = request.form['stock']
     db.session.add(stock)
     db.session.commit()
+    statisitc.stock_changed(current_user.id, [item.id])
     return jsonify({'success': True})
 
 
+@distributor_blueprint.route('/items/stock', methods=['GET', 'POST'])
+@distributor_permission.require(401)
+def items_stock_bulk():
+    if request.method == 'POST':
+        form = StockImportForm(formdata=request.form, csrf_enabled=False)
+        if 'file' in request.files:
+            form.stocks.data = request.files['file'].read().decode('utf-8-sig')
+        elif request.get_json(silent=True) is not None:
+            form.stocks.data = request.get_data(as_text=True)
+        if form.validate():
+            return jsonify({'success': True, 'amount': form.import_stocks()})
+        return jsonify({'success': False, 'message': form.error2str()})
+
+    distributor_id = current_user.id
+    query = db.session.query(Item.id, Item.item).\
+        filter_by(vendor_id=current_user.vendor_id, is_deleted=False, is_component=False)
+    stocks = {stock.item_id: stock.stock for stock in Stock.query.filter_by(distributor_id=distributor_id)}
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(('item_id', 'item', 'stock'))
+        for chunk in chunked_query(query, Item.id):
+            for item_id, item in chunk:
+                writer.writerow((item_id, item, stocks.get(item_id, 0)))
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    return Response(stream_with_context(generate()), mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename=stocks_%d.csv' % distributor_id})
+
+
 @distributor_blueprint.route('/settings', methods=['GET', 'POST'])
 @distributor_permission.require(401)
 def settings():
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+from app.models import Item
+
+
+def copy_file(src_path, dst_path):
+    """
+    Copy inside the kernel, with copy_file_range where it exists and sendfile otherwise, falling back to a
+    user space copy when the filesystem refuses both. Returns the size copied.
+    """
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        size = os.fstat(src.fileno()).st_size
+        offset = 0
+        try:
+            while offset < size:
+                if hasattr(os, 'copy_file_range'):
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), size - offset)
+                else:
+                    copied = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+                if copied == 0:
+                    break
+                offset += copied
+        except OSError:
+            src.seek(offset)
+            dst.seek(offset)
+            shutil.copyfileobj(src, dst)
+        return size
+
+
+class ImagesDump(object):
+    """
+    Copies the images of every item to <dump_dir>/<brand>_<vendor id>/<item>_<item id>/ with a 商品信息.txt.
+
+    Vendors and images are loaded in bulk up front, files are copied by a thread pool, and every finished item is
+    appended to a checkpoint file so running the dump again resumes where it stopped.
+
+    dump = ImagesDump(workers=8)
+    dump.run(report=lambda dump: print(dump.items_done, dump.bytes_copied))
+    """
+
+    checkpoint_name = '.images_dump_checkpoint'
+
+    def __init__(self, dump_dir=None, workers=8):
+        self.image_dir = current_app.config['IMAGE_DIR']
+        self.dump_dir = dump_dir or os.path.join(self.image_dir, 'raw_images')
+        self.workers = workers
+        self.checkpoint_path = os.path.join(self.dump_dir, self.checkpoint_name)
+        self.items_total = self.items_done = self.items_skipped = 0
+        self.files_copied = self.bytes_copied = 0
+        self.started = None
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started if self.started else 0
+
+    def finished_items(self):
+        if not os.path.exists(self.checkpoint_path):
+            return set()
+        with open(self.checkpoint_path) as f:
+            return {int(line) for line in f if line.strip()}
+
+    def jobs(self):
+        """
+        Everything the workers need as plain tuples, the database is only read here, in the calling thread.
+        """
+        finished = self.finished_items()
+        items = [item for item in Item.query.filter_by(is_deleted=False).order_by(Item.id)
+                 if item.id not in finished]
+        self.items_skipped = len(finished)
+        Item.prefetch(items, 'vendor', 'images')
+        for item in items:
+            item_dir = os.path.join(self.dump_dir, '%s_%d' % (item.vendor.brand, item.vendor.id),
+                                    '%s_%d' % (item.item.replace('/', ''), item.id))
+            files = [(os.path.join(self.image_dir, image.path), image.path.rsplit('/', 1)[-1])
+                     for image in item.images]
+            info = ['寓意: %s\n' % item.story, '尺寸(cm): %s\n' % item.size,
+                    '适用面积(m^2): %s\n' % (item.area if item.area else '——')]
+            yield item.id, item_dir, files, info
+
+    def dump_item(self, job):
+        item_id, item_dir, files, info = job
+        os.makedirs(item_dir, exist_ok=True)
+        size = 0
+        for src_path, image_name in files:
+            size += copy_file(src_path, os.path.join(item_dir, image_name))
+        with open(os.path.join(item_dir, '商品信息.txt'), 'w', encoding='utf8') as f:
+            f.writelines(info)
+        return item_id, len(files), size
+
+    def run(self, report=None, report_every=100):
+        os.makedirs(self.dump_dir, exist_ok=True)
+        jobs = list(self.jobs())
+        self.items_total = len(jobs)
+        self.started = time.time()
+        with open(self.checkpoint_path, 'a') as checkpoint, ThreadPoolExecutor(self.workers) as pool:
+            for item_id, files, size in pool.map(self.dump_item, jobs):
+                checkpoint.write('%d\n' % item_id)
+                checkpoint.flush()
+                self.items_done += 1
+                self.files_copied += files
+                self.bytes_copied += size
+                if report is not None and self.items_done % report_every == 0:
+                    report(self)
+        if report is not None:
+            report(self)
+        return self
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from flask import current_app
+
+from app import local_redis
+from app.constants import GEO_CODING, GEO_CODING_MISS
+from app.utils.redis import redis_mget, redis_mset
+
+# one keep-alive pool per process, shared by the geocoding and poi calls
+session = requests.Session()
+session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+
+class GeoCodingError(Exception):
+    pass
+
+
+def _settings():
+    config = current_app.config
+    return {'url': config['GEO_CODING_URL'].rstrip('/'), 'ak': config['GEO_CODING_AK'],
+            'retries': config['GEO_CODING_RETRIES'], 'backoff': config['GEO_CODING_BACKOFF'],
+            'timeout': config['GEO_CODING_TIMEOUT']}
+
+
+def _call(settings, method, path, **kwargs):
+    """
+    JSON response of the map api, retrying connection errors, timeouts and 5xx with exponential backoff.
+    """
+    url = '%s%s' % (settings['url'], path)
+    for attempt in range(settings['retries'] + 1):
+        try:
+            response = session.request(method, url, timeout=settings['timeout'], **kwargs)
+            if response.status_code < 500:
+                return json.loads(response.content.decode('utf8'))
+            error = GeoCodingError('%s %s: HTTP %d' % (method, url, response.status_code))
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = GeoCodingError('%s %s: %s' % (method, url, e))
+        if attempt < settings['retries']:
+            time.sleep(settings['backoff'] * 2 ** attempt)
+    raise error
+
+
+def _geocode(settings, address):
+    """
+    (lng, lat) of the address, None if the api found nothing. Any other error status, like an exhausted quota
+    or a rejected key, raises GeoCodingError so the answer is not cached.
+    """
+    response = _call(settings, 'GET', '/geocoder/v2/',
+                     params={'address': address, 'output': 'json', 'ak': settings['ak']})
+    status = response.get('status')
+    if status == 0 and response.get('result'):
+        location = response['result']['location']
+        return location['lng'], location['lat']
+    if status == 0 or (status == 1 and u'无相关结果' in response.get('msg', '')):
+        return None
+    raise GeoCodingError('geocoding %s: status %s %s' % (address, status, response.get('msg', '')))
+
+
+def _geocode_or_error(settings, address):
+    try:
+        return _geocode(settings, address)
+    except GeoCodingError as e:
+        return e
+
+
+def geocode_many(addresses, workers=None):
+    """
+    {address: (lng, lat)} for every address the api could place. Locations are kept in a redis hash without
+    expiry and "not found" answers for GEO_CODING_MISS_DURATION, so only addresses not seen lately reach the
+    api, at most `workers` at a time. An address failing after its retries, or answered with an error status,
+    is logged and left out, it is tried again next time.
+    """
+    addresses = list(set(addresses))
+    if not addresses:
+        return {}
+    cached = local_redis.hmget(GEO_CODING, addresses)
+    # "null" locations are not-found answers kept for good before they expired, those are asked again
+    answers = {address: json.loads(value.decode()) for address, value in zip(addresses, cached)
+               if value not in (None, b'null')}
+    misses = redis_mget(GEO_CODING_MISS, [address for address in addresses if address not in answers])
+    answers.update((address, None) for address, miss in misses.items() if miss is not None)
+    missing = [address for address in addresses if address not in answers]
+    if missing:
+        settings = _settings()
+        workers = workers or current_app.config['GEO_CODING_CONCURRENCY']
+        with ThreadPoolExecutor(min(workers, len(missing))) as pool:
+            results = list(zip(missing, pool.map(lambda address: _geocode_or_error(settings, address), missing)))
+        resolved = {}
+        for address, result in results:
+            if isinstance(result, GeoCodingError):
+                current_app.logger.warning('geocoding %s failed: %s', address, result)
+            else:
+                resolved[address] = result
+        found = {address: json.dumps(location) for address, location in resolved.items() if location is not None}
+        if found:
+            local_redis.hmset(GEO_CODING, found)
+        redis_mset(GEO_CODING_MISS, {address: 1 for address in resolved if address not in found})
+        answers.update(resolved)
+    return {address: tuple(location) for address, location in answers.items() if location is not None}
+
+
+def geocode(address):
+    return geocode_many([address]).get(address)
+
+
+def save_poi(title, address, longitude, latitude, distributor_id, poi_id=None):
+    """
+    Create or move the distributor's point in the baidu geotable, returns its poi id.
+    """
+    settings = _settings()
+    data = {
+        'title': title,
+        'address': address,
+        'longitude': longitude,
+        'latitude': latitude,
+        'coord_type': 1,
+        'geotable_id': current_app.config['GEO_CODING_GEOTABLE_ID'],
+        'ak': settings['ak'],
+        'distributor_id': distributor_id
+    }
+    if poi_id:
+        data['id'] = poi_id
+        response = _call(settings, 'POST', '/geodata/v3/poi/update', data=data)
+    else:
+        response = _call(settings, 'POST', '/geodata/v3/poi/create', data=data)
+    if response.get('status') != 0 or not (poi_id or response.get('id')):
+        raise GeoCodingError('saving the poi of distributor %s: status %s %s' %
+                             (distributor_id, response.get('status'), response.get('message', '')))
+    return poi_id or response['id']
@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
+import hmac
 from math import ceil
 from flask import render_template, request, current_app, abort, jsonify, g
 from flask.ext.login import current_user
-from flask.ext.cdn import url_for
 
 from app import statisitc
-from app.models import Item, Category
-from app.permission import user_permission
+from app.models import Item, ItemImage
+from app.search import price_list, price_text
+from app.utils import encode_cursor, decode_cursor, chunked_query, stream_json
+from app.permission import user_permission, privilege_permission
 from . import item as item_blueprint
 
 
@@ -15,85 +17,103 @@ def item_list():
     return render_template("user/search.html", user=current_user)
 
 
+def category_counts(leaf_counts):
+    # items are filed under leaf categories, every category on their path adds up their counts
+    counts = {}
+    for category_id, count in leaf_counts.items():
+        closure = statisitc.category_closure.get(category_id)
+        for category in closure.path if closure else ():
+            counts[category.id] = counts.get(category.id, 0) + count
+    return counts
+
+
 @item_blueprint.route("/filter")
 def item_filter():
+    # the statistics are patched in place by other threads, hold them still until the response is serialized
+    with statisitc.lock.reading():
+        return filter_items()
+
+
+def filter_items():
     materials = request.args.getlist('material', type=int)
     styles = request.args.getlist('style', type=int)
     scenes = request.args.getlist('scene', type=int)
     brands = request.args.getlist('brand', type=int)
     category = request.args.get('category', None, type=int)
     price = request.args.get('price', type=int)
+    min_price = request.args.get('min_price', None, type=int)
+    max_price = request.args.get('max_price', None, type=int)
     price_order = request.args.get('order', type=str)
     search = request.args.get('search', type=str)
 
     page = request.args.get('page', 1, type=int)
-    price_list = ((1, 9999), (10000, 49999), (50000, 99999), (100000, 249999), (250000, 499999), (500000, 2147483647))
-    price_text = ('1万以下', '1万 - 5万', '5万 - 10万', '10万 - 25万', '25万 - 50万', '50万以上')
+    cursor = request.args.get('cursor', None, type=str)
+    item_index = statisitc.item_index
 
-    query = Item.query.filter(Item.is_deleted == False, Item.is_component == False)
+    facets = {}
     if brands:
         brands = list(
             statisitc.brands['available_set'] - (statisitc.brands['available_set'] - set(brands))
         )
-        query = query.filter(Item.vendor_id.in_(brands))
-    else:
-        query = query.filter(Item.vendor_id.in_(statisitc.brands['available_set']))
+        facets['vendor_id'] = brands
     if materials:
         materials = list(
             statisitc.materials['available_set'] - (statisitc.materials['available_set'] - set(materials))
         )
-        query = query.filter(Item.second_material_id.in_(materials))
+        facets['second_material_id'] = materials
+    closure = None
     if category is not None:
-        category = Category.query.get(category)
-        category_ids = []
-        if category is not None:
-            if category.level == 3:
-                category_ids = [category.id]
-            elif category.level == 2:
-                children = statisitc.categories['available'][category.father_id]['children'][category.id]['children']
-                if children:
-                    category_ids = children.keys()
-                else:
-                    category_ids = [category.id]
-            else:
-                children = statisitc.categories['available'][category.id]['children']
-                for child in children:
-                    if not children[child]['children']:
-                        category_ids.append(child)
-                    else:
-                        category_ids.extend(children[child]['children'].keys())
-        if category_ids:
-            query = query.filter(Item.category_id.in_(category_ids))
+        closure = statisitc.category_closure.get(category)
+        category = closure.path[-1] if closure else None
+        # an unknown category, or one no available item is filed under, matches nothing
+        facets['category_id'] = closure.leaves if closure else set()
     if scenes:
         scenes = list(
             statisitc.scenes['available_set'] - (statisitc.scenes['available_set'] - set(scenes))
         )
-        query = query.filter(Item.scene_id.in_(scenes))
+        facets['scene_id'] = scenes
     if styles:
         styles = list(
             statisitc.styles['available_set'] - (statisitc.styles['available_set'] - set(styles))
         )
-        query = query.filter(Item.style_id.in_(styles))
+        facets['style_id'] = styles
     if price is not None and 0 <= price < len(price_list):
-        query = query.filter(Item.price >= price_list[price][0], Item.price <= price_list[price][1])
+        facets['price'] = [price]
     else:
         price = None
+    # keyword matches and the price range restrict the counts of every facet, the price buckets are computed
+    # before the price range
+    matches = scores = None
     if search is not None and search != '':
-        query = query.filter(Item.item.like('%' + search + '%'))
-    if price_order == 'asc':
-        query = query.order_by(Item.price)
-    elif price_order == 'desc':
-        query = query.order_by(-Item.price)
-    elif price_order is not None:
+        matches = item_index.text.search(search)
+    restrict = None if matches is None else set(matches)
+    if min_price is not None or max_price is not None:
+        price_ids = item_index.price_range(min_price, max_price)
+        restrict = price_ids if restrict is None else restrict & price_ids
+    item_ids = item_index.filter(**facets)
+    if restrict is not None:
+        item_ids = item_ids & restrict
+    if matches is not None:
+        scores = {id_: matches[id_] for id_ in item_ids}
+    counts = item_index.counts(facets, restrict)
+    price_buckets = item_index.price_buckets(facets, matches)
+    if price_order not in ('asc', 'desc'):
         price_order = None
+    item_ids = item_index.sort(item_ids, price_order, scores)
 
-    items = query.paginate(page, current_app.config['ITEM_PER_PAGE'], False).items
     per_page = current_app.config['ITEM_PER_PAGE']
-    amount = query.count()
+    if cursor is not None:
+        after = decode_cursor(cursor, 1 if price_order is None and scores is None else 2) if cursor else None
+        items, next_key = item_index.seek(item_ids, price_order, after, per_page, scores)
+    else:
+        items = item_index.page(item_ids, page, per_page)
+        next_key = item_index.key(items[-1]['id'], price_order, scores) \
+            if items and page * per_page < len(item_ids) else None
+    amount = len(item_ids)
     data = {
         'filters': {'available': {}, 'selected': {}},
         'items': {'amount': amount, 'page': page, 'pages': ceil(amount / per_page), "search": search,
-                  "order": price_order, 'query': []}
+                  "order": price_order, 'query': [], 'next': encode_cursor(*next_key) if next_key else None}
     }
     if not brands:
         data['filters']['available']['brand'] = statisitc.brands['available']
@@ -107,42 +127,19 @@ def item_filter():
         first_categories = statisitc.categories['available']
         data['filters']['available']['category'] = \
             {key: {'category': first_categories[key]['category']} for key in first_categories}
-    elif category.level == 1:
-        data['filters']['selected']['category'] = {category.id: {'category': category.category}}
-        second_categories = statisitc.categories['available'][category.id]['children']
-        data['filters']['available']['category'] = \
-            {key: {'category': second_categories[key]['category']} for key in second_categories}
-    elif category.level == 2:
-        data['filters']['selected']['category'] = {
-            category.father_id: {
-                'category': category.father.category,
-                'children': {
-                    category.id: {
-                        'category': category.category
-                    }
-                }
-            }
-        }
-        third_categories = statisitc.categories['available'][category.father_id]['children'][category.id]['children']
-        if third_categories:
-            data['filters']['available']['category'] = \
-                {key: {'category': third_categories[key]['category']} for key in third_categories}
     else:
-        data['filters']['selected']['category'] = {
-            category.father.father_id: {
-                'category': category.father.father.category,
-                'children': {
-                    category.father.id: {
-                        'category': category.father.category,
-                        'children': {
-                            category.id: {
-                                'category': category.category
-                            }
-                        }
-                    }
-                }
-            }
-        }
+        # {first id: {'category', 'children': {second id: {'category', ...}}}} down to the selected category,
+        # whose available children are offered next
+        selected = data['filters']['selected']['category'] = {}
+        available = statisitc.categories['available']
+        for row in closure.path:
+            node = selected[row.id] = {'category': row.category}
+            available = available.get(row.id, {}).get('children') if available else None
+            if row is not category:
+                selected = node['children'] = {}
+        if available:
+            data['filters']['available']['category'] = \
+                {key: {'category': available[key]['category']} for key in available}
     if not scenes:
         data['filters']['available']['scene'] = statisitc.scenes['available']
     else:
@@ -155,19 +152,60 @@ def item_filter():
         data['filters']['selected']['price'] = {price: {'price': price_text[price]}}
     else:
         data['filters']['available']['price'] = {index: {'price': price_text[index]} for index in range(0, 6)}
+    data['filters']['counts'] = {
+        'brand': counts['vendor_id'],
+        'material': counts['second_material_id'],
+        'category': category_counts(counts['category_id']),
+        'scene': counts['scene_id'],
+        'style': counts['style_id'],
+        'price': counts['price']
+    }
+    data['filters']['price_buckets'] = price_buckets
+    covers = ItemImage.covers(item['id'] for item in items)
     for item in items:
-        image = item.images.first()
-        image_url = image.url if image else url_for('static', filename='img/user/item_default_img.jpg')
         data['items']['query'].append({
-            'id': item.id,
-            'item': item.item,
-            'price': item.price,
-            'image_url': image_url,
-            'is_suite': item.is_suite
+            'id': item['id'],
+            'item': item['item'],
+            'price': item['price'],
+            'image_url': covers[item['id']],
+            'is_suite': item['is_suite']
         })
     return jsonify(data)
 
 
+@item_blueprint.route("/export")
+def export():
+    token = request.args.get('token', '', type=str).encode()
+    tokens = current_app.config['EXPORT_TOKENS']
+    if not g.identity.can(privilege_permission) and \
+            not any(hmac.compare_digest(token, allowed.encode()) for allowed in tokens):
+        abort(403)
+    query = statisitc.item_query
+    # the stream outlives the request thread's view of the statistics, take the brand names along
+    with statisitc.lock.reading():
+        brands = {vendor_id: brand['brand'] for vendor_id, brand in statisitc.brands['available'].items()}
+
+    def rows():
+        for chunk in chunked_query(query, Item.id):
+            covers = ItemImage.covers(item.id for item in chunk)
+            for item in chunk:
+                yield {
+                    'id': item.id,
+                    'item': item.item,
+                    'price': item.price,
+                    'brand': brands[item.vendor_id] if item.vendor_id in brands else '',
+                    'category': item.category,
+                    'second_material': item.second_material,
+                    'style': item.style,
+                    'scene': item.scene,
+                    'size': item.size,
+                    'is_suite': item.is_suite,
+                    'image_url': covers[item.id]
+                }
+
+    return stream_json(rows(), amount=len(statisitc.item_index.items))
+
+
 @item_blueprint.route("/<int:item_id>")
 def detail(item_id):
     item = Item.query.get_or_404(item_id)
@@ -177,11 +215,8 @@ def detail(item_id):
     action = request.args.get('action', 'compare', type=str)
     if format == 'json':
         if action == 'detail':
-            item_dict = {'item': item.dumps()}
-            if item.id in statisitc.items:
-                item_dict['distributors'] = statisitc.items[item.id]
-            else:
-                item_dict['distributors'] = {}
+            item_dict = {'item': item.cached_dumps()}
+            item_dict['distributors'] = statisitc.item_distributors(item.id)
             if g.identity.can(user_permission):
                 item_dict['item']['collected'] = current_user.item_collected(item.id)
             else:
@@ -189,33 +224,23 @@ def detail(item_id):
         else:
             if item.is_suite:
                 return '套件商品无法对比'
-            image = item.images.first()
-            image_url = image.url if image else url_for('static', filename='img/user/item_default_img.jpg')
-            item_dict = {
-                'id': item.id,
-                'item': item.item,
-                'price': item.price,
-                'second_material': item.second_material,
-                'category': item.category,
-                'scene': item.scene,
-                'outside_sand': item.outside_sand,
-                'inside_sand': item.inside_sand,
-                'size': item.size,
-                'area': item.area if item.area else '——',
-                'stove': item.stove,
-                'paint': item.paint,
-                'decoration': item.decoration,
-                'story': item.story,
-                'image_url': image_url,
-                'carve': item.carve,
-                'carve_type': item.carve_type,
-                'tenon': item.tenon,
-                'brand': item.vendor.brand
-            }
+            item_dict = item.cached_dumps(compare=True)
         return jsonify(item_dict)
     return render_template("user/detail.html")
 
 
+@item_blueprint.route("/<int:item_id>/nearby")
+def nearby(item_id):
+    latitude = request.args.get('lat', None, type=float)
+    longitude = request.args.get('lng', None, type=float)
+    k = min(request.args.get('k', 5, type=int), 20)
+    if item_id not in statisitc.item_index.items:
+        abort(404)
+    if latitude is None or longitude is None or not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+        abort(400)
+    return jsonify({'stores': statisitc.nearby_stores(item_id, latitude, longitude, k)})
+
+
 @item_blueprint.route("/compare")
 def compare():
     return render_template("user/compare.html", user=current_user)
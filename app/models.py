@@ -1,20 +1,20 @@
 # -*- coding: utf-8 -*-
 import hashlib
 import json
-import os
-import shutil
 import time
-import re
 import random
+from collections import namedtuple, OrderedDict
 
 from flask import current_app
 from flask.ext.login import UserMixin
 from flask.ext.cdn import url_for
+from sqlalchemy.exc import IntegrityError
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from app import db, login_manager
+from app import db, login_manager, local_redis
 from app.constants import *
-from app.utils.redis import redis_get, redis_set
+from app.utils.redis import redis_get, redis_set, redis_delete
+from app.utils.image import derivative_reference, delete_image_file
 from app.permission import privilege_id_prefix, vendor_id_prefix, distributor_id_prefix, user_id_prefix
 
 
@@ -37,9 +37,20 @@ class Property(object):
 
     If sometime user._address is inconsistent with database
     user.flush('address')
+
+    Lists of instances are batch loaded through _prefetch, one query per attribute.
+    _prefetch maps an attribute to the column its value is keyed by and a loader which takes a set of keys and
+    returns a dict of key: value. Instances missing from the result, and attributes without a loader, fall back
+    to _flush.
+
+        _prefetch = {'address': ('id', lambda ids: {address.user_id: address for address in
+                                                    UserAddress.query.filter(UserAddress.user_id.in_(ids))})}
+
+    users = User.prefetch(User.query.limit(10), 'address')
     """
 
     _flush = {}
+    _prefetch = {}
 
     def flush(self, *attrs):
         for attr in attrs:
@@ -51,6 +62,85 @@ class Property(object):
             self.flush(attr)
         return getattr(self, real_attr, None)
 
+    @classmethod
+    def prefetch(cls, instances, *attrs):
+        instances = list(instances)
+        for attr in attrs:
+            real_attr = '_%s' % attr
+            pending = [instance for instance in instances if getattr(instance, real_attr, None) is None]
+            if not pending:
+                continue
+            if attr not in cls._prefetch:
+                for instance in pending:
+                    instance.flush(attr)
+                continue
+            key, loader = cls._prefetch[attr]
+            values = loader({getattr(instance, key) for instance in pending})
+            for instance in pending:
+                if getattr(instance, key) in values:
+                    setattr(instance, real_attr, values[getattr(instance, key)])
+                else:
+                    instance.flush(attr)
+        return instances
+
+
+class LookupTable(object):
+    """
+    Reference tables (styles, scenes, materials, ...) are loaded once per process and read from memory.
+    Rows are immutable namedtuples, so they stay usable after the session which loaded them is gone.
+
+    Style.cached(style_id).style
+    Style.cached_all()
+
+    Call Style.invalidate() after changing a table, LookupTable.invalidate() drops every table.
+    """
+
+    _tables = {}
+
+    @classmethod
+    def _rows(cls):
+        if cls.__tablename__ not in LookupTable._tables:
+            columns = [column.name for column in cls.__table__.columns]
+            row = namedtuple('%sRow' % cls.__name__, columns)
+            LookupTable._tables[cls.__tablename__] = OrderedDict(
+                (instance.id, row(*[getattr(instance, column) for column in columns]))
+                for instance in cls.query.order_by(cls.id))
+        return LookupTable._tables[cls.__tablename__]
+
+    @classmethod
+    def cached(cls, id_):
+        return cls._rows().get(id_)
+
+    @classmethod
+    def cached_all(cls):
+        return list(cls._rows().values())
+
+    @classmethod
+    def invalidate(cls):
+        if cls is LookupTable:
+            LookupTable._tables.clear()
+        else:
+            LookupTable._tables.pop(cls.__tablename__, None)
+
+
+class PrefetchedQuery(list):
+    """
+    Result of a prefetched one-to-many attribute, it can be used like the query _flush returns.
+    """
+
+    def first(self):
+        return self[0] if self else None
+
+    def count(self):
+        return len(self)
+
+
+def group_by_key(keys, rows):
+    groups = {key: PrefetchedQuery() for key in keys}
+    for key, value in rows:
+        groups[key].append(value)
+    return groups
+
 
 class BaseUser(UserMixin):
     # id
@@ -90,12 +180,10 @@ class BaseUser(UserMixin):
 
     @property
     def reminds(self):
-        reminds = redis_get(self.REMINDS, self.id)
-        if reminds:
-            reminds = json.loads(reminds)
-        else:
-            reminds = {}
-        return reminds
+        # the alert templates read this once per remind type, fetch it once per request
+        if '_reminds' not in self.__dict__:
+            self._reminds = redis_get(self.REMINDS, self.id, serialize=True) or {}
+        return self._reminds
 
 
 class User(BaseUser, db.Model):
@@ -156,6 +244,9 @@ class Collection(db.Model, Property):
     _flush = {
         'item': lambda x: Item.query.get(x.item_id)
     }
+    _prefetch = {
+        'item': ('item_id', lambda ids: {item.id: item for item in Item.query.filter(Item.id.in_(ids))})
+    }
     _item = None
 
     def __init__(self, user_id, item_id):
@@ -186,6 +277,11 @@ class GuideSMS(db.Model, Property):
         'item': lambda x: Item.query.get(x.item_id),
         'distributor': lambda x: Distributor.query.get(x.distributor_id)
     }
+    _prefetch = {
+        'item': ('item_id', lambda ids: {item.id: item for item in Item.query.filter(Item.id.in_(ids))}),
+        'distributor': ('distributor_id', lambda ids: {distributor.id: distributor for distributor in
+                                                       Distributor.query.filter(Distributor.id.in_(ids))})
+    }
     _item = None
     _distributor = None
 
@@ -279,6 +375,10 @@ class Vendor(BaseUser, db.Model, Property):
         x.agent_identity_back and x.name and x.license_limit and x.license_image and x.telephone and x.address and \
         x.address.cn_id and x.address.address
     }
+    _prefetch = {
+        'address': ('id', lambda ids: {address.vendor_id: address for address in
+                                       VendorAddress.query.filter(VendorAddress.vendor_id.in_(ids))})
+    }
     _logo = None
     _address = None
     _info_completed = None
@@ -331,6 +431,7 @@ class Vendor(BaseUser, db.Model, Property):
             link = {'text': '重新填写', 'href': '/vendor/reconfirm'}
         reminds = {'confirm': [{'message': message, 'type': status, 'link': link}]}
         redis_set(self.REMINDS, self.id, json.dumps(reminds), 3600 * 24 * 3)
+        self.__dict__.pop('_reminds', None)
 
     @staticmethod
     def generate_fake(num=100):
@@ -410,6 +511,14 @@ class Distributor(BaseUser, db.Model, Property):
         'address': lambda x: DistributorAddress.query.filter_by(distributor_id=x.id).limit(1).first(),
         'revocation': lambda x: DistributorRevocation.query.filter_by(distributor_id=x.id).first()
     }
+    _prefetch = {
+        'vendor': ('vendor_id', lambda ids: {vendor.id: vendor for vendor in Vendor.query.filter(Vendor.id.in_(ids))}),
+        'address': ('id', lambda ids: {address.distributor_id: address for address in
+                                       DistributorAddress.query.filter(DistributorAddress.distributor_id.in_(ids))}),
+        'revocation': ('id', lambda ids: {revocation.distributor_id: revocation for revocation in
+                                          DistributorRevocation.query.filter(
+                                              DistributorRevocation.distributor_id.in_(ids))})
+    }
     _vendor = None
     _address = None
     _revocation = None
@@ -452,6 +561,7 @@ class Distributor(BaseUser, db.Model, Property):
         message = '请牢记您的登录用户名: %s' % self.username
         reminds = {'confirm': [{'message': message, 'type': status, 'link': None}]}
         redis_set(self.REMINDS, self.id, json.dumps(reminds), 3600 * 24 * 3)
+        self.__dict__.pop('_reminds', None)
 
     @staticmethod
     def generate_username():
@@ -513,6 +623,10 @@ class DistributorRevocation(db.Model, Property):
     _flush = {
         'distributor': lambda x: Distributor.query.get(x.distributor_id)
     }
+    _prefetch = {
+        'distributor': ('distributor_id', lambda ids: {distributor.id: distributor for distributor in
+                                                       Distributor.query.filter(Distributor.id.in_(ids))})
+    }
     _distributor = None
 
     @property
@@ -575,21 +689,36 @@ class Item(db.Model, Property):
     _flush = {
         'vendor': lambda x: Vendor.query.get(x.vendor_id),
         'category': lambda x: [category.category if category is not None else '' for category in
-                               (Category.query.get(x.category_id),)][0],
+                               (Category.cached(x.category_id),)][0],
         'images': lambda x: ItemImage.query.filter_by(item_id=x.id, is_deleted=False).order_by(ItemImage.sort,
                                                                                                ItemImage.created),
         'components': lambda x: Item.query.filter_by(suite_id=x.id, is_deleted=False, is_component=True),
-        'scene': lambda x: Scene.query.get(x.scene_id).scene,
-        'second_material': lambda x: SecondMaterial.query.get(x.second_material_id).second_material,
-        'outside_sand': lambda x: Sand.query.get(x.outside_sand_id).sand,
-        'inside_sand': lambda x: Sand.query.get(x.inside_sand_id).sand if x.inside_sand_id else '——',
-        'stove': lambda x: Stove.query.get(x.stove_id).stove,
-        'paint': lambda x: Paint.query.get(x.paint_id).paint,
-        'decoration': lambda x: Decoration.query.get(x.decoration_id).decoration,
-        'style': lambda x: Style.query.get(x.style_id).style,
-        'carve_type': lambda x: CarveType.query.get(x.carve_type_id).carve_type,
-        'carve': lambda x: [carve.carve for carve in Carve.query.filter(Carve.id.in_(x.get_carve_id()))],
-        'tenon': lambda x: [tenon.tenon for tenon in Tenon.query.filter(Tenon.id.in_(x.get_tenon_id()))]
+        'scene': lambda x: Scene.cached(x.scene_id).scene,
+        'second_material': lambda x: SecondMaterial.cached(x.second_material_id).second_material,
+        'outside_sand': lambda x: Sand.cached(x.outside_sand_id).sand,
+        'inside_sand': lambda x: Sand.cached(x.inside_sand_id).sand if x.inside_sand_id else '——',
+        'stove': lambda x: Stove.cached(x.stove_id).stove,
+        'paint': lambda x: Paint.cached(x.paint_id).paint,
+        'decoration': lambda x: Decoration.cached(x.decoration_id).decoration,
+        'style': lambda x: Style.cached(x.style_id).style,
+        'carve_type': lambda x: CarveType.cached(x.carve_type_id).carve_type,
+        'carve': lambda x: [Carve.cached(carve_id).carve for carve_id in x.get_carve_id()],
+        'tenon': lambda x: [Tenon.cached(tenon_id).tenon for tenon_id in x.get_tenon_id()]
+    }
+    _prefetch = {
+        'vendor': ('vendor_id', lambda ids: {vendor.id: vendor for vendor in Vendor.query.filter(Vendor.id.in_(ids))}),
+        'images': ('id', lambda ids: group_by_key(ids, [(image.item_id, image) for image in ItemImage.query.filter(
+            ItemImage.item_id.in_(ids), ItemImage.is_deleted == False).order_by(ItemImage.sort, ItemImage.created)])),
+        'components': ('id', lambda ids: group_by_key(ids, [(component.suite_id, component) for component in
+                                                            Item.query.filter(Item.suite_id.in_(ids),
+                                                                              Item.is_deleted == False,
+                                                                              Item.is_component == True)])),
+        'carve': ('id', lambda ids: group_by_key(ids, [
+            (item_carve.item_id, Carve.cached(item_carve.carve_id).carve) for item_carve in
+            ItemCarve.query.filter(ItemCarve.item_id.in_(ids))])),
+        'tenon': ('id', lambda ids: group_by_key(ids, [
+            (item_tenon.item_id, Tenon.cached(item_tenon.tenon_id).tenon) for item_tenon in
+            ItemTenon.query.filter(ItemTenon.item_id.in_(ids))]))
     }
     _vendor = None
     _category = None
@@ -739,7 +868,8 @@ class Item(db.Model, Property):
             for attr in attrs:
                 data[attr] = getattr(self, attr)
             component_dumps = []
-            for component in self.components:
+            components = Item.prefetch(self.components, 'category', 'carve', 'tenon', 'paint', 'decoration')
+            for component in components:
                 component_dumps.append(component.dumps())
             data['components'] = component_dumps
             data['brand'] = self.vendor.brand
@@ -750,24 +880,46 @@ class Item(db.Model, Property):
                 data[attr] = getattr(self, attr)
         return data
 
+    def compare_dumps(self):
+        return {
+            'id': self.id,
+            'item': self.item,
+            'price': self.price,
+            'second_material': self.second_material,
+            'category': self.category,
+            'scene': self.scene,
+            'outside_sand': self.outside_sand,
+            'inside_sand': self.inside_sand,
+            'size': self.size,
+            'area': self.area if self.area else '——',
+            'stove': self.stove,
+            'paint': self.paint,
+            'decoration': self.decoration,
+            'story': self.story,
+            'image_url': ItemImage.covers([self.id])[self.id],
+            'carve': self.carve,
+            'carve_type': self.carve_type,
+            'tenon': self.tenon,
+            'brand': self.vendor.brand
+        }
+
+    def cached_dumps(self, compare=False):
+        content_type = ITEM_COMPARE if compare else ITEM_DUMPS
+        data = redis_get(content_type, self.id, serialize=True)
+        if data is None:
+            data = self.compare_dumps() if compare else self.dumps()
+            redis_set(content_type, self.id, data, serialize=True)
+        return data
+
+    @staticmethod
+    def invalidate_dumps(*item_ids):
+        redis_delete(ITEM_DUMPS, *item_ids)
+        redis_delete(ITEM_COMPARE, *item_ids)
+
     @staticmethod
     def images_dump():
-        for item in Item.query.filter_by(is_deleted=False):
-            vendor_dir = os.path.join(current_app.config['IMAGE_DIR'], 'raw_images/%s_%d/' % (item.vendor.brand, item.vendor.id))
-            item_dir = os.path.join(vendor_dir, '%s_%d' % (item.item.replace('/', ''), item.id))
-
-            if not os.path.exists(vendor_dir):
-                os.mkdir(vendor_dir)
-            if not os.path.exists(item_dir):
-                os.mkdir(item_dir)
-            for image in item.images:
-                src_path = os.path.join(current_app.config['IMAGE_DIR'], re.sub('.*(?=images)', '', image.url))
-                image_name = image.url.rsplit('/', maxsplit=1)[-1]
-                dst_path = os.path.join(item_dir, image_name)
-                shutil.copyfile(src_path, dst_path)
-            story_path = os.path.join(item_dir, '商品信息.txt')
-            with open(story_path, 'w', encoding='utf8') as f:
-                f.writelines(['寓意: %s\n' % item.story, '尺寸(cm): %s\n' % item.size, '适用面积(m^2): %s\n' % (item.area if item.area else '——')])
+        from app.export import ImagesDump
+        return ImagesDump().run()
 
     @staticmethod
     def generate_fake(num=10):
@@ -891,7 +1043,7 @@ class ItemImage(db.Model, Property):
     id = db.Column(db.Integer, primary_key=True)
     item_id = db.Column(db.Integer, nullable=False)
     path = db.Column(db.String(255), nullable=False)
-    hash = db.Column(db.String(32), nullable=False)
+    hash = db.Column(db.String(32), nullable=False, index=True)
     sort = db.Column(db.Integer, nullable=False)
     created = db.Column(db.Integer, default=time.time, nullable=False)
     is_deleted = db.Column(db.Boolean, default=False, nullable=False)
@@ -908,6 +1060,9 @@ class ItemImage(db.Model, Property):
         'item': lambda x: Item.query.get(x.item_id),
         'url': lambda x: url_for('static', filename=x.path)
     }
+    _prefetch = {
+        'item': ('item_id', lambda ids: {item.id: item for item in Item.query.filter(Item.id.in_(ids))})
+    }
     _item = None
     _url = None
 
@@ -922,6 +1077,133 @@ class ItemImage(db.Model, Property):
     def url(self):
         return self.get_or_flush('url')
 
+    def dumps(self):
+        return {'hash': self.hash, 'url': self.url, 'created': self.created}
+
+    @staticmethod
+    def add(item_id, image_hash, path, filename):
+        """
+        Adds the content as the last image of the item, or returns the item's image already showing it.
+        path is where this upload stored the content, None when nothing was uploaded: the content must then be
+        stored already, else None is returned. An uploaded copy left unused because the content was stored
+        before is deleted.
+        """
+        item_image = ItemImage.query.filter_by(item_id=item_id, hash=image_hash, is_deleted=False).limit(1).first()
+        if item_image is None:
+            stored_path = ImageBlob.acquire(image_hash, path)
+            if stored_path is None:
+                return None
+            item_image = ItemImage(item_id, stored_path, image_hash, filename[:30], 999)  # 新上传的图片默认在最后
+            db.session.add(item_image)
+            db.session.commit()
+            Item.invalidate_dumps(item_id)
+            ItemImage.invalidate_cover(item_id)
+        if path is not None and path != item_image.path:
+            ImageBlob.cleanup(image_hash, path)
+        return item_image
+
+    @staticmethod
+    def covers(item_ids):
+        """
+        Cover image url of every item, in one redis round trip plus at most one query.
+        The cover is the list derivative of the first non-deleted image by (sort, created), see
+        derivative_reference; items without images get the default image.
+        """
+        item_ids = list(item_ids)
+        if not item_ids:
+            return {}
+        paths = dict(zip(item_ids, local_redis.hmget(ITEM_COVER, item_ids)))
+        missing = [item_id for item_id in item_ids if paths[item_id] is None]
+        if missing:
+            resolved = {item_id: '' for item_id in missing}
+            query = ItemImage.query.filter(ItemImage.item_id.in_(missing), ItemImage.is_deleted == False).\
+                order_by(ItemImage.item_id, ItemImage.sort, ItemImage.created)
+            for image in query:
+                if not resolved[image.item_id]:
+                    resolved[image.item_id] = derivative_reference(image.path, 'list')
+            pipe = local_redis.pipeline()
+            pipe.hmset(ITEM_COVER, resolved)
+            pipe.expire(ITEM_COVER, current_app.config['ITEM_COVER_DURATION'])
+            pipe.execute()
+            paths.update(resolved)
+        default_url = url_for('static', filename='img/user/item_default_img.jpg')
+        covers = {}
+        for item_id, path in paths.items():
+            if isinstance(path, bytes):
+                path = path.decode()
+            path, _, query = path.partition('?')
+            covers[item_id] = '%s%s' % (url_for('static', filename=path), '?' + query if query else '') \
+                if path else default_url
+        return covers
+
+    @staticmethod
+    def invalidate_cover(item_id):
+        local_redis.hdel(ITEM_COVER, item_id)
+
+
+class ImageBlob(db.Model):
+    """
+    One stored image file per distinct content, ItemImage rows with the same hash share its path.
+    reference_count counts the non-deleted ItemImage rows using it.
+    """
+    __tablename__ = 'image_blobs'
+    id = db.Column(db.Integer, primary_key=True)
+    # 内容 md5
+    hash = db.Column(db.CHAR(32), unique=True, nullable=False)
+    path = db.Column(db.String(255), nullable=False)
+    reference_count = db.Column(db.Integer, default=0, nullable=False)
+    created = db.Column(db.Integer, default=time.time, nullable=False)
+
+    def __init__(self, image_hash, path):
+        self.hash = image_hash
+        self.path = path
+        self.reference_count = 1
+
+    @staticmethod
+    def acquire(image_hash, path):
+        """
+        Count a new reference to the content, registering path as its file if it is new.
+        Returns the path every reference should use, None if the content is new and path is None.
+        """
+        while True:
+            # the update reads the latest row, it waits for a concurrent release and misses a deleted blob
+            if ImageBlob.query.filter_by(hash=image_hash).\
+                    update({ImageBlob.reference_count: ImageBlob.reference_count + 1}, synchronize_session=False):
+                return ImageBlob.query.filter_by(hash=image_hash).with_for_update().first().path
+            if path is None:
+                return None
+            try:
+                with db.session.begin_nested():
+                    db.session.add(ImageBlob(image_hash, path))
+                return path
+            except IntegrityError:
+                # a concurrent upload of the same content inserted it first, count our reference on that one
+                continue
+
+    @staticmethod
+    def release(image_hash):
+        """
+        Drop a reference to the content. Returns the path of its file once nothing uses it any more, the blob
+        is then deleted with the transaction and the file is for cleanup() after the commit.
+        """
+        ImageBlob.query.filter(ImageBlob.hash == image_hash, ImageBlob.reference_count > 0).\
+            update({ImageBlob.reference_count: ImageBlob.reference_count - 1}, synchronize_session=False)
+        blob = ImageBlob.query.filter_by(hash=image_hash, reference_count=0).with_for_update().first()
+        if blob is None:
+            return None
+        db.session.delete(blob)
+        return blob.path
+
+    @staticmethod
+    def cleanup(image_hash, path):
+        """
+        Delete the stored copy of the content at path unless an image still uses it, call once the releasing
+        transaction committed.
+        """
+        if ImageBlob.query.filter_by(hash=image_hash, path=path).first() is None and \
+                ItemImage.query.filter_by(hash=image_hash, path=path, is_deleted=False).first() is None:
+            delete_image_file(path)
+
 
 class Stock(db.Model):
     __tablename__ = 'stocks'
@@ -936,7 +1218,7 @@ class Stock(db.Model):
         self.stock = stock
 
 
-class Style(db.Model):
+class Style(db.Model, LookupTable):
     __tablename__ = 'styles'
     id = db.Column(db.Integer, primary_key=True)
     style = db.Column(db.Unicode(10), nullable=False)
@@ -949,7 +1231,7 @@ class Style(db.Model):
         db.session.commit()
 
 
-class Category(db.Model, Property):
+class Category(db.Model, Property, LookupTable):
     __tablename__ = 'categories'
     id = db.Column(db.Integer, primary_key=True)
     category = db.Column(db.Unicode(20), nullable=False)
@@ -983,7 +1265,7 @@ class Category(db.Model, Property):
                 db.session.commit()
 
 
-class Scene(db.Model, Property):
+class Scene(db.Model, Property, LookupTable):
     __tablename__ = 'scenes'
     id = db.Column(db.Integer, primary_key=True)
     scene = db.Column(db.Unicode(20), nullable=False)
@@ -1016,7 +1298,7 @@ class Scene(db.Model, Property):
             db.session.commit()
 
 
-class FirstMaterial(db.Model):
+class FirstMaterial(db.Model, LookupTable):
     __tablename__ = 'first_materials'
     id = db.Column(db.Integer, primary_key=True)
     first_material = db.Column(db.Unicode(20), nullable=False)
@@ -1029,7 +1311,7 @@ class FirstMaterial(db.Model):
         db.session.commit()
 
 
-class SecondMaterial(db.Model):
+class SecondMaterial(db.Model, LookupTable):
     __tablename__ = 'second_materials'
     id = db.Column(db.Integer, primary_key=True)
     first_material_id = db.Column(db.Integer, nullable=False)
@@ -1093,9 +1375,16 @@ class Area(db.Model, Property):
     distributor_amount = db.Column(db.Integer, nullable=False)
 
     _flush = {
-        'father': lambda x: Area.query.get(x.id) if x.level > 1 else None
+        'father': lambda x: Area.query.get(x.father_id) if x.level > 1 else None
     }
     _father = None
+    _tree = None
+
+    @staticmethod
+    def tree():
+        if Area._tree is None:
+            Area._tree = AreaTree(Area.query.order_by(Area.id))
+        return Area._tree
 
     @staticmethod
     def generate_fake():
@@ -1103,53 +1392,80 @@ class Area(db.Model, Property):
             area = Area(id=area[0], cn_id=area[1], area=area[2], father_id=area[3], level=area[4], pinyin=area[5], pinyin_index=area[6], distributor_amount=area[7])
             db.session.add(area)
         db.session.commit()
+        Area._tree = None
 
     def area_address(self):
-        areas = []
-        area = self
-        while area is not None:
-            if area.area not in ['北京市', '上海市', '天津市', '重庆市']:
-                areas.append(area.area)
-            area = Area.query.get(area.father_id)
-        areas.reverse()
-        return ''.join(areas)
+        return Area.tree().get(self.id).address
 
     def grade(self):
-        grades = []
-        area = self
-        while area is not None:
-            grades.append(area)
-            area = Area.query.get(area.father_id)
-        grades.reverse()
-        return grades
+        return Area.tree().grade(self.id)
 
     @property
     def father(self):
         return self.get_or_flush('father')
 
     def children(self):
-        if self.level < 3:
-            return Area.query.filter_by(father_id=self.id).all()
-        return []
+        return Area.tree().children(self.id)
 
     def city(self):
         if self.level == 2:
             return self
         return self.father
 
-    def experience_dict(self, distributor_id):
-        if self.level == 3:
-            third_area = self
-            second_area = self.father
-            first_area = second_area.father
-        else:
-            third_area = second_area = self
-            first_area = second_area.father
-        return {first_area.cn_id: {'area': first_area.area, 'children': {
-            second_area.cn_id: {'area': second_area.area, 'children': {
-                third_area.cn_id: {'area': third_area.area, 'distributors': [distributor_id]}
-            }}
-        }}}
+
+AreaNode = namedtuple('AreaNode', ('id', 'cn_id', 'area', 'father_id', 'level', 'pinyin', 'pinyin_index',
+                                   'address', 'ancestors', 'children'))
+
+
+class AreaTree(object):
+    """
+    The areas table loaded once into a list of immutable nodes, indexed by id and cn_id.
+    Every node carries its display address, the positions of its ancestors (province first, itself last) and of
+    its children, so walking the hierarchy never touches the database.
+
+    tree = Area.tree()
+    tree.by_cn_id(110101).address  # 北京东城区
+    [area.cn_id for area in tree.grade(area_id)]
+
+    distributor_amount changes at runtime and is not kept here, read it from Area.
+    """
+
+    municipalities = ('北京市', '上海市', '天津市', '重庆市')
+
+    def __init__(self, areas):
+        rows = [(area.id, area.cn_id, area.area, area.father_id, area.level, area.pinyin, area.pinyin_index)
+                for area in areas]
+        self.ids = {row[0]: position for position, row in enumerate(rows)}
+        self.cn_ids = {}
+        children = [[] for _ in rows]
+        for position, row in enumerate(rows):
+            self.cn_ids.setdefault(row[1], position)
+            if row[3] in self.ids:
+                children[self.ids[row[3]]].append(position)
+        nodes = []
+        for position, row in enumerate(rows):
+            ancestors = [position]
+            while rows[ancestors[-1]][3] in self.ids and len(ancestors) < 3:
+                ancestors.append(self.ids[rows[ancestors[-1]][3]])
+            ancestors.reverse()
+            address = ''.join(rows[ancestor][2] for ancestor in ancestors
+                              if rows[ancestor][2] not in self.municipalities)
+            nodes.append(AreaNode(*row + (address, tuple(ancestors), tuple(children[position]))))
+        self.nodes = tuple(nodes)
+
+    def get(self, id_):
+        position = self.ids.get(id_)
+        return self.nodes[position] if position is not None else None
+
+    def by_cn_id(self, cn_id):
+        position = self.cn_ids.get(cn_id)
+        return self.nodes[position] if position is not None else None
+
+    def grade(self, id_):
+        return [self.nodes[ancestor] for ancestor in self.get(id_).ancestors]
+
+    def children(self, id_):
+        return [self.nodes[child] for child in self.get(id_).children]
 
 
 class Address(Property):
@@ -1165,6 +1481,9 @@ class Address(Property):
     _flush = {
         'area': lambda x: Area.query.filter_by(cn_id=x.cn_id).limit(1).first()
     }
+    _prefetch = {
+        'area': ('cn_id', lambda ids: {area.cn_id: area for area in Area.query.filter(Area.cn_id.in_(ids))})
+    }
     _area = None
 
     @property
@@ -1172,7 +1491,8 @@ class Address(Property):
         return self.get_or_flush('area')
 
     def vague_address(self):
-        return self.area.area_address() if self.area else ''
+        area = Area.tree().by_cn_id(self.cn_id)
+        return area.address if area else ''
 
     def precise_address(self):
         return '%s%s' % (self.vague_address(), self.address)
@@ -1209,8 +1529,7 @@ class DistributorAddress(Address, db.Model):
 
     def update_distributor_amount(self):
         city = self.area.city()
-        districts = city.children()
-        cn_ids = [district.cn_id for district in districts]
+        cn_ids = [district.cn_id for district in city.children()]
         cn_ids.append(city.cn_id)
         city.distributor_amount = DistributorAddress.query.filter(DistributorAddress.cn_id.in_(cn_ids),
                                                                   Distributor.id == DistributorAddress.distributor_id,
@@ -1218,7 +1537,7 @@ class DistributorAddress(Address, db.Model):
         db.session.commit()
 
 
-class Stove(db.Model):
+class Stove(db.Model, LookupTable):
     __tablename__ = 'stoves'
     id = db.Column(db.Integer, primary_key=True)
     stove = db.Column(db.Unicode(10), nullable=False)
@@ -1230,7 +1549,7 @@ class Stove(db.Model):
         db.session.commit()
 
 
-class Carve(db.Model):
+class Carve(db.Model, LookupTable):
     __tablename__ = 'carves'
     id = db.Column(db.Integer, primary_key=True)
     carve = db.Column(db.Unicode(10), nullable=False)
@@ -1242,7 +1561,7 @@ class Carve(db.Model):
         db.session.commit()
 
 
-class CarveType(db.Model):
+class CarveType(db.Model, LookupTable):
     __tablename__ = 'carve_types'
     id = db.Column(db.Integer, primary_key=True)
     carve_type = db.Column(db.Unicode(10), nullable=False)
@@ -1254,7 +1573,7 @@ class CarveType(db.Model):
         db.session.commit()
 
 
-class Sand(db.Model):
+class Sand(db.Model, LookupTable):
     __tablename__ = 'sands'
     id = db.Column(db.Integer, primary_key=True)
     sand = db.Column(db.Integer, nullable=False)
@@ -1266,7 +1585,7 @@ class Sand(db.Model):
         db.session.commit()
 
 
-class Paint(db.Model):
+class Paint(db.Model, LookupTable):
     __tablename__ = 'paints'
     id = db.Column(db.Integer, primary_key=True)
     paint = db.Column(db.Unicode(10), nullable=False)
@@ -1278,7 +1597,7 @@ class Paint(db.Model):
         db.session.commit()
 
 
-class Decoration(db.Model):
+class Decoration(db.Model, LookupTable):
     __tablename__ = 'decorations'
     id = db.Column(db.Integer, primary_key=True)
     decoration = db.Column(db.Unicode(10), nullable=False)
@@ -1290,7 +1609,7 @@ class Decoration(db.Model):
         db.session.commit()
 
 
-class Tenon(db.Model):
+class Tenon(db.Model, LookupTable):
     __tablename__ = 'tenons'
     id = db.Column(db.Integer, primary_key=True)
     tenon = db.Column(db.Unicode(20), nullable=False)
@@ -1348,6 +1667,7 @@ def generate_fake_data(num=100):
     Tenon.generate_fake()
     Scene.generate_fake()
     Style.generate_fake()
+    LookupTable.invalidate()
     Area.generate_fake()
     # Vendor.generate_fake()
     # Privilege.generate_fake()
@@ -8,7 +8,7 @@ from flask.ext.principal import identity_changed, Identity
 from wtforms import StringField, PasswordField, IntegerField, BooleanField
 from wtforms.validators import ValidationError, DataRequired, Length
 
-from app import db
+from app import db, statisitc
 from app.constants import VENDOR_REMINDS_SUCCESS, VENDOR_REMINDS_REJECTED
 from app.forms import Form
 from app.models import Vendor, DistributorRevocation, Privilege
@@ -68,6 +68,7 @@ class VendorConfirmForm(Form):
         sms_generator(VENDOR_ACCEPT_TEMPLATE, self.vendor.mobile)
         db.session.add(self.vendor)
         db.session.commit()
+        statisitc.vendor_confirmed(self.vendor.id)
 
 
 class VendorConfirmRejectForm(VendorConfirmForm):
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import datetime
+import os
 from flask import request, render_template, current_app, jsonify, redirect, abort
 from flask.ext.cdn import url_for
 from flask.ext.login import current_user, logout_user
@@ -9,6 +10,7 @@ from app.constants import ACCESS_GRANTED
 from app.models import Vendor, DistributorRevocation, Item, Distributor
 from app.permission import privilege_permission
 from app.utils import data_table_params, DataTableHandler
+from app.utils.redis import redis_latency, local_cache
 from app.vendor.forms import ComponentForm
 from . import privilege as privilege_blueprint
 from .forms import LoginForm, VendorDetailForm, VendorConfirmForm, VendorConfirmRejectForm, DistributorRevocationForm,\
@@ -47,6 +49,14 @@ def index():
     return render_template('admin/index.html', statistic=statistic, privilege=current_user)
 
 
+@privilege_blueprint.route('/redis')
+@privilege_permission.require(404)
+def redis_statistic():
+    # counters are kept per worker process, pid tells the workers apart
+    return jsonify({'pid': os.getpid(), 'latency': redis_latency(),
+                    'local_cache': {'hits': local_cache.hits, 'misses': local_cache.misses}})
+
+
 @privilege_blueprint.route('/items')
 @privilege_permission.require(404)
 def item_list():
@@ -59,12 +69,12 @@ def items_data_table():
     params = {
         'id': {'orderable': False, 'data': lambda x: x.id},
         'item': {'orderable': False, 'data': lambda x: x.item},
-        'vendor': {'orderable': False, 'data': lambda x: x.vendor.name},
+        'vendor': {'orderable': False, 'prefetch': 'vendor', 'data': lambda x: x.vendor.name},
         'scene_id': {'orderable': False, 'data': lambda x: x.scene},
         'price': {'orderable': True, 'order_key': Item.price, 'data': lambda x: x.price},
         'size': {'orderable': False, 'data': lambda x: x.size}
     }
-    data_table_handler = DataTableHandler(params)
+    data_table_handler = DataTableHandler(params, key=Item.id)
     query = Item.query.filter_by(is_deleted=False, is_component=False)
     data = data_table_handler.query_params(query)
     return jsonify(data)
@@ -108,12 +118,12 @@ def vendors_data_table():
     params = {
         'id': {'orderable': False, 'data': lambda x: x.id},
         'name': {'orderable': False, 'data': lambda x: x.name},
-        'address': {'orderable': False, 'data': lambda x: x.address.precise_address()},
+        'address': {'orderable': False, 'prefetch': 'address', 'data': lambda x: x.address.precise_address()},
         'license_limit': {'orderable': False, 'data': lambda x: x.license_limit},
         'mobile': {'orderable': False, 'data': lambda x: x.mobile},
         'telephone': {'orderable': False, 'data': lambda x: x.telephone}
     }
-    data_table_handler = DataTableHandler(params)
+    data_table_handler = DataTableHandler(params, key=Vendor.id)
     query = Vendor.query.filter_by(confirmed=True)
     data = data_table_handler.query_params(query)
     return jsonify(data)
@@ -138,7 +148,8 @@ def vendor_confirm():
 @privilege_permission.require(404)
 def vendors_confirm_data_table():
     draw, start, length = data_table_params()
-    vendors = Vendor.query.filter_by(confirmed=False, rejected=False).offset(start).limit(length)
+    vendors = Vendor.prefetch(Vendor.query.filter_by(confirmed=False, rejected=False).offset(start).limit(length),
+                              'address')
     count = Vendor.query.filter_by(confirmed=False, rejected=False).count()
     data = {'draw': draw, 'recordsTotal': count, 'recordsFiltered': count, 'data': []}
     for vendor in vendors:
@@ -183,7 +194,8 @@ def distributor_list():
 @privilege_permission.require(404)
 def distributors_data_table():
     draw, start, length = data_table_params()
-    distributors = Distributor.query.filter_by(is_revoked=False).offset(start).limit(length)
+    distributors = Distributor.prefetch(Distributor.query.filter_by(is_revoked=False).offset(start).limit(length),
+                                        'revocation', 'address')
     count = Distributor.query.filter_by(is_revoked=False).count()
     data = {'draw': draw, 'recordsTotal': count, 'recordsFiltered': count, 'data': []}
     for distributor in distributors:
@@ -209,7 +221,9 @@ def distributors_revocation():
 @privilege_permission.require(404)
 def distributors_revocation_data_table():
     draw, start, length = data_table_params()
-    revocations = DistributorRevocation.query.filter_by(pending=True).offset(start).limit(length)
+    revocations = DistributorRevocation.prefetch(
+        DistributorRevocation.query.filter_by(pending=True).offset(start).limit(length), 'distributor')
+    Distributor.prefetch([revocation.distributor for revocation in revocations], 'address', 'vendor')
     count = DistributorRevocation.query.filter_by(is_revoked=False).count()
     data = {'draw': draw, 'recordsTotal': count, 'recordsFiltered': count, 'data': []}
     for revocation in revocations:
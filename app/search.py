@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+import heapq
+import math
+import re
+from bisect import bisect_right
+
+import numpy as np
+
+price_list = ((1, 9999), (10000, 49999), (50000, 99999), (100000, 249999), (250000, 499999), (500000, 2147483647))
+price_text = ('1万以下', '1万 - 5万', '5万 - 10万', '10万 - 25万', '25万 - 50万', '50万以上')
+
+
+def price_bucket(price):
+    for index, (low, high) in enumerate(price_list):
+        if low <= price <= high:
+            return index
+    return None
+
+
+word_pattern = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text, query=False):
+    """
+    Character unigrams and bigrams of every word, which works for Chinese without a dictionary.
+    A query only uses the bigrams of words longer than one character, so it matches documents containing every
+    adjacent pair of its characters.
+    """
+    tokens = set()
+    for word in word_pattern.findall(text.lower()):
+        bigrams = [word[i:i + 2] for i in range(len(word) - 1)]
+        if query and bigrams:
+            tokens.update(bigrams)
+        else:
+            tokens.update(word)
+            tokens.update(bigrams)
+    return tokens
+
+
+class TextIndex(object):
+    """
+    Weighted full-text index. A document is a list of (text, weight) fields, a token found in several fields
+    scores the sum of their weights.
+
+    text_index.add(1, [(u'圆后背交椅', 4), (u'明式', 2)])
+    text_index.search(u'交椅')  # {1: 8}
+    """
+
+    def __init__(self):
+        self.documents = {}
+        self.postings = {}
+
+    def add(self, id_, fields):
+        self.remove(id_)
+        weights = {}
+        for text, weight in fields:
+            for token in tokenize(text or ''):
+                weights[token] = weights.get(token, 0) + weight
+        self.documents[id_] = weights
+        for token, weight in weights.items():
+            self.postings.setdefault(token, {})[id_] = weight
+
+    def remove(self, id_):
+        weights = self.documents.pop(id_, None)
+        if weights is None:
+            return
+        for token in weights:
+            posting = self.postings[token]
+            del posting[id_]
+            if not posting:
+                del self.postings[token]
+
+    def search(self, keyword):
+        tokens = tokenize(keyword, query=True)
+        # a bigram whose characters are both indexed but never adjacent spans two fields (u'明式交椅' against a
+        # 明式 item named 交椅), it is left out instead of failing the query
+        tokens = [token for token in tokens if token in self.postings or
+                  not all(character in self.postings for character in token)]
+        postings = sorted([self.postings.get(token, {}) for token in tokens], key=len)
+        if not postings:
+            return {}
+        scores = dict(postings[0])
+        for posting in postings[1:]:
+            scores = {id_: score + posting[id_] for id_, score in scores.items() if id_ in posting}
+        return scores
+
+
+class FacetColumns(object):
+    """
+    Facet values of the indexed items as numpy columns, for counting every facet option at once.
+
+    Each facet keeps the sorted distinct values it takes and, per item (in item id order), the position of the
+    item's value among them. A filter becomes a boolean table over the values, indexed by the column, and the
+    counts of a facet are one bincount of its column under the mask of the other facets' filters.
+    """
+
+    def __init__(self, items, facets):
+        self.ids = np.array(sorted(items), dtype=np.int64)
+        self.prices = np.array([items[id_]['price'] for id_ in self.ids.tolist()], dtype=np.int64)
+        # positions of the items ordered by (price, id), and their prices in that order for binary searches
+        self.by_price = np.lexsort((self.ids, self.prices))
+        self.sorted_prices = self.prices[self.by_price]
+        self.values = {}
+        self.codes = {}
+        for facet in facets:
+            column = np.array([-1 if items[id_]['facets'][facet] is None else items[id_]['facets'][facet]
+                               for id_ in self.ids.tolist()], dtype=np.int64)
+            self.values[facet] = np.unique(column)
+            self.codes[facet] = np.searchsorted(self.values[facet], column)
+
+    @staticmethod
+    def _lookup(sorted_values, wanted):
+        # boolean array over sorted_values, True where the value is in wanted
+        table = np.zeros(len(sorted_values), dtype=bool)
+        wanted = np.array(list(wanted), dtype=np.int64)
+        positions = np.searchsorted(sorted_values, wanted)
+        found = positions < len(sorted_values)
+        positions = positions[found]
+        table[positions[sorted_values[positions] == wanted[found]]] = True
+        return table
+
+    def mask(self, facet, values):
+        return self._lookup(self.values[facet], values)[self.codes[facet]]
+
+    def base(self, ids=None):
+        return np.ones(len(self.ids), dtype=bool) if ids is None else self._lookup(self.ids, ids)
+
+    def price_range(self, low=None, high=None):
+        """
+        Ids of the items priced within [low, high], either bound may be None.
+        """
+        start = 0 if low is None else np.searchsorted(self.sorted_prices, low, 'left')
+        stop = len(self.sorted_prices) if high is None else np.searchsorted(self.sorted_prices, high, 'right')
+        return set(self.ids[self.by_price[start:stop]].tolist())
+
+    def sort_by_price(self, ids, descending=False):
+        positions = self.by_price[self.base(ids)[self.by_price]]
+        if descending:
+            positions = positions[::-1]
+        return self.ids[positions].tolist()
+
+    def price_buckets(self, facets, ids=None, buckets=6):
+        """
+        Up to `buckets` price ranges holding about as many items each, at quantiles of the prices of the items
+        selected by every filter but the price: [{'min', 'max', 'amount'}]. The ranges start at actual prices, so
+        none of them is empty however skewed the prices are.
+        """
+        mask = self.base(ids)
+        for facet, values in facets.items():
+            if facet != 'price' and values is not None:
+                mask = mask & self.mask(facet, values)
+        prices = self.sorted_prices[mask[self.by_price]]
+        if not len(prices):
+            return []
+        # each range starts at the price found at the start of one of `buckets` equal slices of the sorted prices
+        # and stops right before the next start, the last one at the highest price
+        starts = np.unique(prices[np.linspace(0, len(prices), buckets, endpoint=False).astype(np.int64)])
+        stops = np.append(starts[1:], prices[-1] + 1)
+        amounts = np.searchsorted(prices, stops, 'left') - np.searchsorted(prices, starts, 'left')
+        ranges = []
+        for low, high, amount in zip(starts.tolist(), stops.tolist(), amounts.tolist()):
+            if amount:
+                ranges.append({'min': low, 'max': high - 1, 'amount': amount})
+        return ranges
+
+    def counts(self, facets, ids=None):
+        """
+        {facet: {value: items}} for every facet, each counted under the filters of all the other facets (and
+        restricted to ids when given), so a count is what selecting that value would add to the result.
+        """
+        if not len(self.ids):
+            return {facet: {} for facet in self.codes}
+        base = self.base(ids)
+        masks = {facet: self.mask(facet, values) for facet, values in facets.items() if values is not None}
+        result = {}
+        for facet, codes in self.codes.items():
+            mask = base
+            for other, other_mask in masks.items():
+                if other != facet:
+                    mask = mask & other_mask
+            counts = np.bincount(codes[mask], minlength=len(self.values[facet]))
+            result[facet] = {int(value): int(count) for value, count in zip(self.values[facet], counts)
+                             if count and value != -1}
+        return result
+
+
+class SortKeys(object):
+    """
+    The keys of ids, sorted by ItemIndex.sort, as a sequence computing each key only when it is read, so bisecting
+    a page start costs O(log n) keys instead of building all of them.
+    """
+
+    def __init__(self, index, ids, order=None, scores=None):
+        self.index = index
+        self.ids = ids
+        self.order = order
+        self.scores = scores
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, position):
+        return self.index.key(self.ids[position], self.order, self.scores)
+
+
+class ItemIndex(object):
+    """
+    Inverted index over the items shown in /item/filter.
+
+    Every facet keeps a posting list (a set of item ids) per value, so any combination of filters is answered
+    with set unions and intersections. Price ranges, price ordering and counts go through FacetColumns.
+
+    index = ItemIndex()
+    index.build(statisitc.item_query)
+    ids = index.filter(vendor_id=[1, 2], price=[0])
+    page = index.page(index.sort(ids, 'asc'), 1, 40)
+    page, next_key = index.seek(index.sort(ids, 'asc'), 'asc', None, 40)
+
+    Keyword search goes through a TextIndex over name, brand, material, style, scene and story. Its scores rank
+    the result when no price order is given: scores = index.search(ids, u'交椅'); index.sort(scores, None, scores)
+
+    index.counts({'vendor_id': [1, 2]}) counts the items of every facet value, index.price_range(3000, 8000) and
+    index.price_buckets({'vendor_id': [1, 2]}) answer arbitrary and quantile price ranges, see FacetColumns.
+    """
+
+    facets = ('vendor_id', 'second_material_id', 'category_id', 'scene_id', 'style_id', 'price')
+
+    def __init__(self):
+        self.items = {}
+        self.postings = {facet: {} for facet in self.facets}
+        self.text = TextIndex()
+        self.columns = None
+
+    def build(self, query):
+        self.__init__()
+        for item in query:
+            self.add(item)
+
+    @staticmethod
+    def facet_values(item):
+        return {
+            'vendor_id': item.vendor_id,
+            'second_material_id': item.second_material_id,
+            'category_id': item.category_id,
+            'scene_id': item.scene_id,
+            'style_id': item.style_id,
+            'price': price_bucket(item.price)
+        }
+
+    @staticmethod
+    def document(item):
+        return [(item.item, 4), (item.vendor.brand, 2), (item.second_material, 2), (item.style, 2),
+                (item.scene, 2), (item.story, 1)]
+
+    def add(self, item):
+        self.remove(item.id)
+        self.columns = None
+        values = self.facet_values(item)
+        self.items[item.id] = {'id': item.id, 'item': item.item, 'price': item.price, 'is_suite': item.is_suite,
+                               'facets': values}
+        for facet in self.facets:
+            self.postings[facet].setdefault(values[facet], set()).add(item.id)
+        self.text.add(item.id, self.document(item))
+
+    def remove(self, item_id):
+        record = self.items.pop(item_id, None)
+        if record is None:
+            return
+        self.columns = None
+        for facet in self.facets:
+            posting = self.postings[facet][record['facets'][facet]]
+            posting.discard(item_id)
+            if not posting:
+                del self.postings[facet][record['facets'][facet]]
+        self.text.remove(item_id)
+
+    def posting(self, facet, values):
+        postings = self.postings[facet]
+        return set().union(*[postings[value] for value in values if value in postings])
+
+    def filter(self, **facets):
+        postings = sorted([self.posting(facet, values) for facet, values in facets.items() if values is not None],
+                          key=len)
+        if not postings:
+            return set(self.items)
+        ids = postings[0]
+        for posting in postings[1:]:
+            if not ids:
+                break
+            ids = ids & posting
+        return ids
+
+    def facet_columns(self):
+        # rebuilt on first use after the index changed, snapshots pickled before columns existed have none
+        columns = getattr(self, 'columns', None)
+        if columns is None:
+            columns = self.columns = FacetColumns(self.items, self.facets)
+        return columns
+
+    def counts(self, facets, ids=None):
+        return self.facet_columns().counts(facets, ids)
+
+    def price_range(self, low=None, high=None):
+        return self.facet_columns().price_range(low, high)
+
+    def price_buckets(self, facets, ids=None, buckets=6):
+        return self.facet_columns().price_buckets(facets, ids, buckets)
+
+    def search(self, ids, keyword):
+        return {id_: score for id_, score in self.text.search(keyword).items() if id_ in ids}
+
+    def sort(self, ids, order=None, scores=None):
+        if order in ('asc', 'desc'):
+            return self.facet_columns().sort_by_price(ids, order == 'desc')
+        elif scores is not None:
+            return sorted(ids, key=lambda id_: (-scores[id_], id_))
+        return sorted(ids)
+
+    def page(self, ids, page, per_page):
+        if page < 1:
+            return []
+        return [self.items[id_] for id_ in ids[(page - 1) * per_page:page * per_page]]
+
+    def key(self, id_, order=None, scores=None):
+        # ascending in the same order as sort(ids, order, scores)
+        if order == 'asc':
+            return self.items[id_]['price'], id_
+        elif order == 'desc':
+            return -self.items[id_]['price'], -id_
+        elif scores is not None:
+            return -scores[id_], id_
+        return id_,
+
+    def seek(self, ids, order, after, per_page, scores=None):
+        """
+        Page of sort(ids, order) starting after the item whose key is `after` (None for the first page).
+        Returns the page and the key to continue from, None on the last page.
+        """
+        start = 0
+        if after is not None:
+            start = bisect_right(SortKeys(self, ids, order, scores), after)
+        page_ids = ids[start:start + per_page]
+        next_key = self.key(page_ids[-1], order, scores) if page_ids and start + per_page < len(ids) else None
+        return [self.items[id_] for id_ in page_ids], next_key
+
+
+EARTH_RADIUS = 6371.0  # km
+
+
+def distance(lat1, lng1, lat2, lng2):
+    """
+    Great circle distance in km.
+    """
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GeoIndex(object):
+    """
+    Points bucketed in a grid of `cell` degree squares. Nearest neighbours are searched ring by ring around the
+    query cell, until the k-th distance found is within the distance no point outside the rings can beat.
+
+    index = GeoIndex()
+    index.add(1, 39.91, 116.40)
+    index.nearest(39.90, 116.39, 5)  # [(1.40..., 1)]
+    """
+
+    def __init__(self, cell=0.5):
+        self.cell = cell
+        self.points = {}
+        self.cells = {}
+
+    def cell_of(self, lat, lng):
+        return int(math.floor(lat / self.cell)), int(math.floor(lng / self.cell))
+
+    def add(self, id_, lat, lng):
+        self.remove(id_)
+        self.points[id_] = (lat, lng)
+        self.cells.setdefault(self.cell_of(lat, lng), set()).add(id_)
+
+    def remove(self, id_):
+        point = self.points.pop(id_, None)
+        if point is None:
+            return
+        cell = self.cell_of(*point)
+        self.cells[cell].discard(id_)
+        if not self.cells[cell]:
+            del self.cells[cell]
+
+    def _ring(self, row, col, ring):
+        if ring == 0:
+            yield row, col
+            return
+        for offset in range(-ring, ring + 1):
+            yield row - ring, col + offset
+            yield row + ring, col + offset
+        for offset in range(-ring + 1, ring):
+            yield row + offset, col - ring
+            yield row + offset, col + ring
+
+    def _bound(self, lat, ring):
+        # a point outside `ring` rings is at least this far: ring cells north or south, or ring cells of
+        # longitude east or west, which shrink towards the poles
+        degrees = ring * self.cell
+        shrink = math.cos(math.radians(min(90.0, abs(lat) + degrees)))
+        return EARTH_RADIUS * math.radians(degrees) * shrink
+
+    def nearest(self, lat, lng, k, ids=None):
+        """
+        [(distance in km, id)] of the k points nearest to (lat, lng), among ids when given.
+        """
+        if ids is not None:
+            ids = [id_ for id_ in ids if id_ in self.points]
+            if len(ids) <= 64:
+                # a handful of candidates, measuring them all is cheaper than walking the grid
+                return heapq.nsmallest(k, [(distance(lat, lng, *self.points[id_]), id_) for id_ in ids])
+            ids = set(ids)
+        if k <= 0 or not self.points:
+            return []
+        row, col = self.cell_of(lat, lng)
+        last_ring = max(max(abs(r - row), abs(c - col)) for r, c in self.cells)
+        found = []
+        for ring in range(last_ring + 1):
+            for cell in self._ring(row, col, ring):
+                for id_ in self.cells.get(cell, ()):
+                    if ids is None or id_ in ids:
+                        found.append((distance(lat, lng, *self.points[id_]), id_))
+            if len(found) >= k and heapq.nsmallest(k, found)[-1][0] <= self._bound(lat, ring):
+                break
+        return heapq.nsmallest(k, found)
@@ -1,7 +1,18 @@
 # -*- coding: utf-8 -*-
-from app import db
+import pickle
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app
+
+from app import db, local_redis
+from app.constants import STATISTIC_SNAPSHOT, STATISTIC_VERSION, STATISTIC_SERIAL, STATISTIC_LOCK, \
+    STATISTIC_PATCHES
 from app.models import Category, Item, Vendor, SecondMaterial, \
     Style, Scene, Distributor, Stock, DistributorAddress, Area
+from app.search import ItemIndex, GeoIndex
 
 materials = None
 categories = None
@@ -9,41 +20,123 @@ styles = None
 brands = None
 scenes = None
 item_query = None
-items = None
+availability = None
 distributors = None
+store_index = None
+item_index = None
+category_list = None
+category_closure = None
+base = None
+version = None
+# name -> patch function, replayed by load() in the order they were published
+patches = {}
+
+snapshot_attrs = ('materials', 'categories', 'styles', 'brands', 'scenes', 'availability', 'distributors',
+                  'item_index', 'category_list', 'category_closure', 'store_index')
+
+
+class ReadWriteLock(object):
+    """
+    Any number of readers or a single writer. A waiting writer holds back new readers, a thread already reading
+    or writing may enter again.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.local = threading.local()
+        self.readers = 0
+        self.writer = None
+        self.writes = 0
+        self.waiting_writers = 0
+
+    @contextmanager
+    def reading(self):
+        me = threading.get_ident()
+        depth = getattr(self.local, 'reads', 0)
+        with self.condition:
+            if not depth and self.writer != me:
+                while self.writer is not None or self.waiting_writers:
+                    self.condition.wait()
+            self.readers += 1
+        self.local.reads = depth + 1
+        try:
+            yield
+        finally:
+            self.local.reads = depth
+            with self.condition:
+                self.readers -= 1
+                self.condition.notify_all()
+
+    @contextmanager
+    def writing(self):
+        me = threading.get_ident()
+        with self.condition:
+            if self.writer == me:
+                self.writes += 1
+            else:
+                self.waiting_writers += 1
+                while self.writer is not None or self.readers:
+                    self.condition.wait()
+                self.waiting_writers -= 1
+                self.writer = me
+                self.writes = 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writes -= 1
+                if not self.writes:
+                    self.writer = None
+                    self.condition.notify_all()
+
+
+# loading, replaying and patching mutate the statistics in place, request threads iterating them read under
+# lock.reading()
+lock = ReadWriteLock()
+
+CategoryRow = namedtuple('CategoryRow', ('id', 'category', 'level'))
+# path: CategoryRows from the first level category down to this one, leaves: ids of the available categories
+# items are filed under in its subtree (itself when it is one)
+CategoryClosure = namedtuple('CategoryClosure', ('path', 'leaves'))
 
 
 def materials_statistic():
     global materials
     materials = {'available': {}, 'available_set': set()}
     second_material_ids = [item.second_material_id for item in item_query.group_by(Item.second_material_id)]
-    query = SecondMaterial.query.filter(SecondMaterial.id.in_(second_material_ids))
-    for second_material in query:
+    for second_material in filter(None, map(SecondMaterial.cached, second_material_ids)):
         materials['available'][second_material.id] = {'material': second_material.second_material}
     materials['available_set'] = set(materials['available'].keys())
 
 
 def categories_statistic():
+    global category_list
+    category_list = [CategoryRow(category.id, category.category, category.level)
+                     for category in Category.cached_all()]
+    category_ids = [item.category_id for item in item_query.filter_by(is_suite=False).group_by(Item.category_id)]
+    build_categories(category_ids)
+
+
+def build_categories(category_ids):
     global categories
     categories = {'available': {}}
-    category_list = Category.query.order_by(Category.id).all()
-    category_ids = [item.category_id for item in item_query.filter_by(is_suite=False).group_by(Item.category_id)]
+    available_list = list(category_list)
 
     del_list = []
-    length = len(category_list)
+    length = len(available_list)
     for index in range(length):
         if index < length - 1:
-            if category_list[index].level >= category_list[index + 1].level:
-                if category_list[index].id not in category_ids:
-                    del_list.append(category_list[index])
+            if available_list[index].level >= available_list[index + 1].level:
+                if available_list[index].id not in category_ids:
+                    del_list.append(available_list[index])
         else:
-            if category_list[index].id not in category_ids:
-                del_list.append(category_list[index])
+            if available_list[index].id not in category_ids:
+                del_list.append(available_list[index])
     for category in del_list:
-        category_list.remove(category)
+        available_list.remove(category)
 
     first_category = second_category = None
-    for category in category_list:
+    for category in available_list:
         if category.level == 1:
             categories['available'][category.id] = {'category': category.category, 'children': {}}
             first_category = categories['available'][category.id]
@@ -52,14 +145,35 @@ def categories_statistic():
             second_category = first_category['children'][category.id]
         else:
             second_category['children'][category.id] = {'category': category.category}
+    build_category_closure()
+
+
+def build_category_closure():
+    global category_closure
+    closure = {}
+    path = []
+    for category in category_list:
+        del path[category.level - 1:]
+        path.append(category)
+        closure[category.id] = CategoryClosure(tuple(path), set())
+
+    def collect(nodes):
+        leaves = set()
+        for category_id, node in nodes.items():
+            subtree = collect(node['children']) if node.get('children') else {category_id}
+            closure[category_id].leaves.update(subtree)
+            leaves |= subtree
+        return leaves
+
+    collect(categories['available'])
+    category_closure = closure
 
 
 def style_statistic():
     global styles
     styles = {'available': {}, 'available_set': set()}
     style_ids = [item.style_id for item in item_query.group_by(Item.style_id)]
-    query = db.session.query(Style).filter(Style.id.in_(style_ids))
-    for style in query:
+    for style in filter(None, map(Style.cached, style_ids)):
         styles['available'][style.id] = {'style': style.style}
     styles['available_set'] = set(styles['available'].keys())
 
@@ -68,7 +182,8 @@ def brands_statistic():
     global brands
     brands = {'available': {}, 'available_set': set()}
     query = Vendor.query.filter(Vendor.confirmed == True)
-    vendor_ids = db.session.query(Item.vendor_id).group_by(Item.vendor_id)
+    vendor_ids = db.session.query(Item.vendor_id).filter(Item.is_deleted == False, Item.is_component == False).\
+        group_by(Item.vendor_id)
     query = query.filter(Vendor.id.in_(vendor_ids))
     for vendor in query:
         brands['available'][vendor.id] = {'brand': vendor.brand}
@@ -79,137 +194,354 @@ def scenes_statistic():
     global scenes
     scenes = {'available': {}, 'available_set': set()}
     scene_ids = [item.scene_id for item in item_query.group_by(Item.scene_id)]
-    query = db.session.query(Scene).filter(Scene.id.in_(scene_ids))
-    for scene in query:
+    for scene in filter(None, map(Scene.cached, scene_ids)):
         scenes['available'][scene.id] = {'scene': scene.scene}
     scenes['available_set'] = set(scenes['available'].keys())
 
 
-class DistributorAreaTree(object):
-    def __init__(self):
-        self.children = []
-
-    @staticmethod
-    def add_node(root, *nodes):
-        for node in nodes:
-            for child in root.children:
-                if child.id == node.id:
-                    if node.children:
-                        root.add_node(child, *node.children)
-                        break
-                    elif root.father is not None:
-                        child.distributors = child.distributors + node.distributors
-                        break
-            else:
-                root.children.append(node)
-                node.father = root
-
-    def dumps(self):
-        data = {}
-        for child in self.children:
-            dumps = child.dumps()
-            for k in dumps:
-                data[k] = dumps[k]
-        return data
-
-
-class DistributorAreaNode(DistributorAreaTree):
-    def __init__(self, id, area, father):
-        self.id = id
-        self.area = area
-        self.father = father
-        self.distributors = None
-        super(DistributorAreaNode, self).__init__()
-
-    @staticmethod
-    def _dict_key(node_dict):
-        return list(node_dict.keys())[0]
-
-    @staticmethod
-    def build_from_dict(node_dict):
-        key = DistributorAreaNode._dict_key(node_dict)
-        node = DistributorAreaNode(key, node_dict[key]['area'], None)
-        node.add_child_from_dict(node_dict[key]['children'])
-        return node
-
-    def add_child_from_dict(self, node_dict):
-        key = self._dict_key(node_dict)
-        node = DistributorAreaNode(key, node_dict[key]['area'], father=self)
-        self.children.append(node)
-        if 'children' in node_dict[key]:
-            return node.add_child_from_dict(node_dict[key]['children'])
-        node.distributors = node_dict[key]['distributors']
-
-    def dumps(self):
-        if self.children:
-            data = {self.id: {'area': self.area, 'children': {}}}
-            for child in self.children:
-                dumps = child.dumps()
-                for k in dumps:
-                    data[self.id]['children'][k] = dumps[k]
-            return data
-
-        distributor_dict = {}
-        self.distributors = sorted(list(set(self.distributors)))
-        if len(self.distributors) == 1:
-            distributor = distributors[self.distributors[0]]
-            distributor_dict = {distributor.id: {'name': '%s体验馆' % self.area, 'ext_number': distributor.ext_number}}
-        else:
-            for index, key in zip(range(1, len(self.distributors) + 1), self.distributors):
-                distributor = distributors[key]
-                distributor_dict[key] = {'name': '%s体验馆%d' % (self.area, index), 'ext_number': distributor.ext_number}
-        return {self.id: {'area': self.area, 'distributors': distributor_dict}}
-
-
-def distributors_statistic(item_id=None):
-    global items, distributors
-    items = {}
-    if item_id is not None:
-        query = [Item.query.get(item_id)]
-        stock_query = Stock.query.filter(Stock.stock > 0, Stock.item_id == item_id)
-        distributors = query[0].in_stock_distributors()
+def item_index_statistic():
+    global item_index
+    item_index = ItemIndex()
+    item_index.build(Item.prefetch(item_query.all(), 'vendor'))
+
+
+def distributors_statistic(item_ids=None):
+    """
+    Availability index: item id -> district (or city) cn_id -> ids of the distributors there which have the item
+    in stock. distributors maps every distributor found to its (cn_id, ext_number), provinces and cities come
+    from the area tree when an item is rendered.
+    """
+    global availability, distributors
+    query = db.session.query(Stock.item_id, Distributor.id, Distributor.ext_number, DistributorAddress.cn_id).\
+        filter(Stock.stock > 0, Stock.distributor_id == Distributor.id, Distributor.is_revoked == False,
+               DistributorAddress.distributor_id == Distributor.id)
+    if item_ids is None:
+        availability = {}
+        distributors = {}
     else:
-        query = item_query
-        stock_query = Stock.query.filter(Stock.stock > 0)
-        distributors = {distributor.id: distributor for distributor in Distributor.query.all()}
-    area_list = Area.query.all()
-    cn_areas = {area.cn_id: area for area in area_list}
-    areas = {area.id: area for area in area_list}
-    for address in DistributorAddress.query.all():
-        if address.distributor_id in distributors:
-            distributor = distributors[address.distributor_id]
-            distributor._address = address
-            area = distributor.address._area = cn_areas[distributor.address.cn_id]
-            while area.level > 1:
-                area._father = areas[area.father_id]
-                area = area.father
-    stocks = {}
-    for stock in stock_query.all():
-        try:
-            stocks[stock.item_id].add(stock.distributor_id)
-        except KeyError:
-            stocks[stock.item_id] = {stock.distributor_id}
-    for item in query:
-        if item.id in stocks:
-            root = DistributorAreaTree()
-            for distributor_id in stocks[item.id]:
-                distributor = distributors[distributor_id]
-                area = distributor.address.area
-                root.add_node(root, DistributorAreaNode.build_from_dict(area.experience_dict(distributor.id)))
-            items[item.id] = root.dumps()
-    distributors = None
+        item_ids = list(item_ids)
+        for item_id in item_ids:
+            availability.pop(item_id, None)
+        query = query.filter(Stock.item_id.in_(item_ids))
+    for item_id, distributor_id, ext_number, cn_id in query:
+        if item_id in item_index.items:
+            distributors[distributor_id] = (cn_id, ext_number)
+            availability.setdefault(item_id, {}).setdefault(cn_id, set()).add(distributor_id)
 
 
-def init_statistic():
-    brands_statistic()
+def _store_query():
+    return db.session.query(DistributorAddress.distributor_id, DistributorAddress.latitude,
+                            DistributorAddress.longitude).\
+        filter(DistributorAddress.distributor_id == Distributor.id, Distributor.is_revoked == False,
+               DistributorAddress.latitude != 0, DistributorAddress.longitude != 0)
+
+
+def stores_statistic():
+    """
+    Spatial index of the geocoded experience stores. Whether a store has an item comes from availability, so
+    only address changes touch the index.
+    """
+    global store_index
+    store_index = GeoIndex()
+    for distributor_id, latitude, longitude in _store_query():
+        store_index.add(distributor_id, latitude, longitude)
+
+
+def nearby_stores(item_id, latitude, longitude, k):
+    """
+    The k stores nearest to (latitude, longitude) which have the item in stock:
+    [{'id', 'distance' (km), 'latitude', 'longitude', 'area', 'ext_number'}]
+    """
+    tree = Area.tree()
+    stores = []
+    with lock.reading():
+        candidates = set().union(*availability.get(item_id, {}).values())
+        for km, distributor_id in store_index.nearest(latitude, longitude, k, candidates):
+            cn_id, ext_number = distributors[distributor_id]
+            area = tree.by_cn_id(cn_id)
+            store_latitude, store_longitude = store_index.points[distributor_id]
+            stores.append({'id': distributor_id, 'distance': round(km, 2), 'latitude': store_latitude,
+                           'longitude': store_longitude, 'area': area.address if area else '',
+                           'ext_number': ext_number})
+    return stores
+
+
+def item_distributors(item_id):
+    """
+    {province cn_id: {'area', 'children': {city cn_id: {'area', 'children': {district cn_id: {'area',
+    'distributors': {id: {'name', 'ext_number'}}}}}}}}, a distributor registered at city level sits under the
+    city itself.
+    """
+    tree = Area.tree()
+    data = {}
+    with lock.reading():
+        leaves = [(cn_id, sorted(distributor_ids)) for cn_id, distributor_ids in availability.get(item_id, {}).items()]
+        ext_numbers = {distributor_id: distributors[distributor_id][1]
+                       for cn_id, distributor_ids in leaves for distributor_id in distributor_ids}
+    for cn_id, distributor_ids in leaves:
+        area = tree.by_cn_id(cn_id)
+        if area is None or area.level < 2:
+            continue
+        grades = tree.grade(area.id)
+        first_area, second_area, third_area = grades[0], grades[1], grades[-1]
+        node = data.setdefault(first_area.cn_id, {'area': first_area.area, 'children': {}})
+        node = node['children'].setdefault(second_area.cn_id, {'area': second_area.area, 'children': {}})
+        if len(distributor_ids) == 1:
+            names = ['%s体验馆' % third_area.area]
+        else:
+            names = ['%s体验馆%d' % (third_area.area, index) for index in range(1, len(distributor_ids) + 1)]
+        node['children'][third_area.cn_id] = {'area': third_area.area, 'distributors': {
+            distributor_id: {'name': name, 'ext_number': ext_numbers[distributor_id]}
+            for distributor_id, name in zip(distributor_ids, names)
+        }}
+    return data
+
+
+def build_item_query():
     global item_query
     item_query = db.session.query(Item).\
         filter(Item.vendor_id.in_(brands['available_set']), Item.is_deleted == False, Item.is_component == False)
+
+
+def init_statistic():
+    brands_statistic()
+    build_item_query()
     materials_statistic()
     categories_statistic()
     style_statistic()
     scenes_statistic()
+    item_index_statistic()
     distributors_statistic()
+    stores_statistic()
+
+
+def snapshot():
+    return {attr: globals()[attr] for attr in snapshot_attrs}
+
+
+def _keys(snapshot_base):
+    return '%s:%s' % (STATISTIC_SNAPSHOT, snapshot_base), '%s:%s' % (STATISTIC_PATCHES, snapshot_base)
+
+
+def published():
+    """
+    (base, version) of the latest statistics: the full snapshot `base` with the first version - base patches of
+    its log applied on top. None when there is none, or it was written by an older release.
+    """
+    value = local_redis.get(STATISTIC_VERSION)
+    if value is None or b':' not in value:
+        return None
+    return tuple(int(part) for part in value.split(b':'))
+
+
+def publish():
+    """
+    Store the statistics of this process as a new full snapshot in redis, other processes pick it up on their
+    next refresh(). The previous snapshot and its patches are dropped shortly after.
+    """
+    global base, version
+    previous = published()
+    base = version = local_redis.incr(STATISTIC_SERIAL)
+    snapshot_key, patches_key = _keys(base)
+    pipe = local_redis.pipeline()
+    pipe.set(snapshot_key, pickle.dumps(snapshot(), pickle.HIGHEST_PROTOCOL), current_app.config['STATISTIC_DURATION'])
+    pipe.set(STATISTIC_VERSION, '%d:%d' % (base, version))
+    if previous is not None and previous[0] != base:
+        # a process may be loading it right now
+        for key in _keys(previous[0]):
+            pipe.expire(key, 60)
+    pipe.execute()
+
+
+def publish_patch(name, args):
+    """
+    Append a patch to the log of the current snapshot instead of storing the whole statistics again, other
+    processes replay it on their next refresh().
+    """
+    global version
+    snapshot_key, patches_key = _keys(base)
+    if local_redis.llen(patches_key) >= current_app.config['STATISTIC_MAX_PATCHES']:
+        return publish()
+    version = base + local_redis.rpush(patches_key, pickle.dumps((name, args), pickle.HIGHEST_PROTOCOL))
+    pipe = local_redis.pipeline()
+    pipe.expire(snapshot_key, current_app.config['STATISTIC_DURATION'])
+    pipe.expire(patches_key, current_app.config['STATISTIC_DURATION'])
+    pipe.set(STATISTIC_VERSION, '%d:%d' % (base, version))
+    pipe.execute()
+
+
+def load(target):
+    global base, version
+    target_base, target_version = target
+    if (target_base, target_version) == (base, version):
+        return True
+    snapshot_key, patches_key = _keys(target_base)
+    if target_base != base or target_version < version:
+        data = local_redis.get(snapshot_key)
+        if data is None:
+            return False
+        data = pickle.loads(data)
+        if not all(attr in data for attr in snapshot_attrs):
+            # published by an older release, recompute it
+            return False
+        globals().update(data)
+        base = version = target_base
+        build_item_query()
+    entries = local_redis.lrange(patches_key, version - base, target_version - base - 1)
+    if len(entries) != target_version - version:
+        return False
+    for entry in entries:
+        name, args = pickle.loads(entry)
+        patches[name](*args)
+        version += 1
+    return True
+
+
+def _refresh():
+    target = published()
+    if target is None or not load(target):
+        init_statistic()
+        publish()
+
+
+def refresh():
+    """
+    Bring this process up to the latest published statistics, by replaying the patches published since its
+    version or loading a newer snapshot. Only the first process to find nothing usable computes the
+    statistics, the others wait for the lock and then load its result.
+    """
+    target = published()
+    if target is not None and target == (base, version):
+        return
+    with lock.writing():
+        if target is None or not load(target):
+            with local_redis.lock(STATISTIC_LOCK, timeout=current_app.config['STATISTIC_LOCK_TIMEOUT']):
+                _refresh()
+
+
+def shared(f):
+    """
+    A patch of the statistics: run under the statistics lock on top of the latest version and published as
+    (name, args), so its arguments are plain ids and it reads everything else from the database.
+    """
+    patches[f.__name__] = f
+
+    @wraps(f)
+    def wrapped(*args):
+        with lock.writing(), \
+                local_redis.lock(STATISTIC_LOCK, timeout=current_app.config['STATISTIC_LOCK_TIMEOUT']):
+            _refresh()
+            result = f(*args)
+            publish_patch(f.__name__, args)
+        return result
+    return wrapped
+
+
+def _patch_statistic(statistic, facet, values, entry):
+    for value in values:
+        if value in item_index.postings[facet]:
+            if value not in statistic['available']:
+                statistic['available'][value] = entry(value)
+                statistic['available_set'].add(value)
+        elif value in statistic['available']:
+            del statistic['available'][value]
+            statistic['available_set'].discard(value)
+
+
+def _patch_facets(*records):
+    """
+    Add or remove the filter entries touched by the given item index records (facet values before and after a
+    change), so only the affected brands, materials, styles, scenes and categories are recomputed.
+    """
+    values = {facet: {record['facets'][facet] for record in records} for facet in ItemIndex.facets}
+    brand_ids = set(brands['available_set'])
+    _patch_statistic(brands, 'vendor_id', values['vendor_id'],
+                     lambda id_: {'brand': Vendor.query.get(id_).brand})
+    _patch_statistic(materials, 'second_material_id', values['second_material_id'],
+                     lambda id_: {'material': SecondMaterial.cached(id_).second_material})
+    _patch_statistic(styles, 'style_id', values['style_id'], lambda id_: {'style': Style.cached(id_).style})
+    _patch_statistic(scenes, 'scene_id', values['scene_id'], lambda id_: {'scene': Scene.cached(id_).scene})
+    if brand_ids != brands['available_set']:
+        build_item_query()
+    build_categories(item_index.postings['category_id'])
+
+
+@shared
+def item_changed(item_id):
+    """
+    Patch the statistics after an item or a suite has been created, updated or deleted.
+    Components are not listed, their suite carries the facets.
+    """
+    item = Item.query.get(item_id)
+    if item is not None and item.is_component:
+        return
+    records = []
+    if item_id in item_index.items:
+        records.append(item_index.items[item_id])
+    if item is None or item.is_deleted or (item.vendor_id not in brands['available_set'] and
+                                           not Vendor.query.get(item.vendor_id).confirmed):
+        item_index.remove(item_id)
+        availability.pop(item_id, None)
+    else:
+        item_index.add(item)
+        records.append(item_index.items[item.id])
+    _patch_facets(*records)
+
+
+@shared
+def stock_changed(distributor_id, item_ids):
+    """
+    Move one distributor in or out of the availability of the given items after their stock rows have been
+    written.
+    """
+    item_ids = [item_id for item_id in item_ids if item_id in item_index.items]
+    if not item_ids:
+        return
+    rows = {row.item_id: row for row in
+            db.session.query(Stock.item_id, Distributor.ext_number, DistributorAddress.cn_id).
+            filter(Distributor.id == distributor_id, Distributor.is_revoked == False,
+                   DistributorAddress.distributor_id == Distributor.id, Stock.distributor_id == Distributor.id,
+                   Stock.item_id.in_(item_ids), Stock.stock > 0)}
+    for item_id in item_ids:
+        leaves = availability.setdefault(item_id, {})
+        if item_id in rows:
+            row = rows[item_id]
+            distributors[distributor_id] = (row.cn_id, row.ext_number)
+            leaves.setdefault(row.cn_id, set()).add(distributor_id)
+        elif distributor_id in distributors:
+            cn_id = distributors[distributor_id][0]
+            leaf = leaves.get(cn_id, set())
+            leaf.discard(distributor_id)
+            if not leaf:
+                leaves.pop(cn_id, None)
+        if not leaves:
+            del availability[item_id]
+
+
+@shared
+def address_changed(*distributor_ids):
+    """
+    Move stores in the spatial index once their addresses have been geocoded, or drop those without
+    coordinates or revoked.
+    """
+    rows = {row.distributor_id: row for row in _store_query().filter(Distributor.id.in_(distributor_ids))}
+    for distributor_id in distributor_ids:
+        if distributor_id in rows:
+            store_index.add(distributor_id, rows[distributor_id].latitude, rows[distributor_id].longitude)
+        else:
+            store_index.remove(distributor_id)
+
+
+@shared
+def vendor_confirmed(vendor_id):
+    vendor = Vendor.query.get(vendor_id)
+    records = []
+    for item in Item.query.filter_by(vendor_id=vendor.id, is_deleted=False, is_component=False):
+        item._vendor = vendor
+        item_index.add(item)
+        records.append(item_index.items[item.id])
+    _patch_facets(*records)
+    distributors_statistic(record['id'] for record in records)
 
 
 def selected(statistic, id_list):
@@ -1,20 +1,19 @@
 # -*- coding: utf-8 -*-
-import json
 import requests
 
+from flask import current_app
 from flask.ext.celery3 import make_celery
 
 from app import db, mail, create_celery_app
-from app.models import Distributor, DistributorAddress
+from app.models import Distributor, DistributorAddress, Item, ItemImage
+from app.geocoding import geocode_many, save_poi, GeoCodingError
+from app.utils import chunked
+from app.utils.image import write_atomically
 
 
 celery_app = create_celery_app()
 celery = make_celery(celery_app)
 
-geo_coding_url = 'http://api.map.baidu.com/geocoder/v2/?address=%s&output=json&ak=sdp9qCbToS7E23nDRxaAAwbh'
-create_poi_url = 'http://api.map.baidu.com/geodata/v3/poi/create'
-update_poi_url = 'http://api.map.baidu.com/geodata/v3/poi/update'
-
 
 @celery.task(name='send_email')
 def send_email(msg):
@@ -27,31 +26,90 @@ def send_sms(url):
     print(response.content)
 
 
+@celery.task(name='image_derivative')
+def image_derivative(image_path, derivative_path, size, item_id=None):
+    """
+    JPEG copy of the image fitting in size x size, or of full size without size. derivative_path may be
+    image_path itself, to convert an upload in place.
+    """
+    from PIL import Image
+    im = Image.open(image_path)
+    im.load()
+    if size:
+        im.thumbnail((size, size), Image.ANTIALIAS)
+    if im.mode != 'RGB':
+        im = im.convert('RGB')
+    write_atomically(derivative_path, lambda f: im.save(f, format='jpeg', quality=85, optimize=True))
+    im.close()
+    if item_id is not None:
+        # the cover switches to the list derivative, the cached detail and compare payloads embed it
+        Item.invalidate_dumps(item_id)
+        ItemImage.invalidate_cover(item_id)
+
+
+def geo_code_addresses(distributor_addresses, workers=None):
+    """
+    Geocode the addresses, concurrently and through the cache, and store the coordinates and baidu pois of
+    those which moved. An address whose poi cannot be saved is logged and kept where it was, so it is tried
+    again next time. Returns the ids of the distributors which moved.
+    """
+    precise_addresses = {address.id: address.precise_address() for address in distributor_addresses}
+    locations = geocode_many(precise_addresses.values(), workers)
+    moved = []
+    for address in distributor_addresses:
+        location = locations.get(precise_addresses[address.id])
+        if location is None:
+            continue
+        # the columns are single precision, anything closer than about a metre is the same place
+        if address.poi_id and abs(address.longitude - location[0]) < 1e-5 and \
+                abs(address.latitude - location[1]) < 1e-5:
+            continue
+        moved.append((address, location))
+    if not moved:
+        return []
+    distributors = {distributor.id: distributor for distributor in
+                    Distributor.query.filter(Distributor.id.in_([address.distributor_id for address, _ in moved]))}
+    saved = []
+    for address, location in moved:
+        distributor = distributors[address.distributor_id]
+        try:
+            poi_id = save_poi(distributor.name, precise_addresses[address.id], location[0], location[1],
+                              distributor.id, address.poi_id)
+        except GeoCodingError as e:
+            current_app.logger.warning('saving the poi of distributor address %d failed: %s', address.id, e)
+            continue
+        address.longitude, address.latitude = location
+        address.poi_id = poi_id
+        saved.append(address)
+    if not saved:
+        return []
+    db.session.commit()
+    from app import statisitc
+    distributor_ids = [address.distributor_id for address in saved]
+    statisitc.address_changed(*distributor_ids)
+    return distributor_ids
+
+
 @celery.task(name='distributor_geo_coding')
 def distributor_geo_coding(distributor_id, distributor_address_id):
-    distributor = Distributor.query.get(distributor_id)
-    distributor_address = DistributorAddress.query.get(distributor_address_id)
-    url = geo_coding_url % distributor_address.precise_address()
-    response = requests.get(url)
-    response = json.loads(response.content.decode('utf8'))
-    if response['status'] == 0:
-        distributor_address.longitude = response['result']['location']['lng']
-        distributor_address.latitude = response['result']['location']['lat']
-        data = {
-            'title': distributor.name,
-            'address': distributor_address.precise_address(),
-            'longitude': distributor_address.longitude,
-            'latitude': distributor_address.latitude,
-            'coord_type': 1,
-            'geotable_id': '121763',
-            'ak': 'sdp9qCbToS7E23nDRxaAAwbh',
-            'distributor_id': distributor.id
-        }
-        if not distributor_address.poi_id:
-            response = requests.post(create_poi_url, data=data)
-            response = json.loads(response.content.decode('utf8'))
-            distributor_address.poi_id = response['id']
-        else:
-            data['id'] = distributor_address.poi_id
-            requests.post(update_poi_url, data=data)
-        db.session.commit()
+    geo_code_addresses([DistributorAddress.query.get(distributor_address_id)])
+
+
+@celery.task(name='batch_geo_coding')
+def batch_geo_coding(distributor_address_ids=None, workers=None):
+    """
+    Geocode many distributor addresses, all those of non revoked distributors by default. Addresses already
+    geocoded to the same place cost neither an api call nor a write.
+    """
+    query = DistributorAddress.query.filter(DistributorAddress.distributor_id == Distributor.id,
+                                            Distributor.is_revoked == False)
+    if distributor_address_ids is not None:
+        query = query.filter(DistributorAddress.id.in_(distributor_address_ids))
+    # every chunk commits, which expires loaded rows, so each chunk is loaded on its own
+    address_ids = [address_id for address_id, in query.with_entities(DistributorAddress.id).
+                   order_by(DistributorAddress.id)]
+    moved = 0
+    for chunk in chunked(address_ids, 500):
+        moved += len(geo_code_addresses(DistributorAddress.query.filter(DistributorAddress.id.in_(chunk)).all(),
+                                        workers))
+    return moved
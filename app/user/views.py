@@ -8,7 +8,7 @@ from app import db
 from app.models import Collection, Item
 from app.constants import *
 from app.permission import user_permission
-from app.utils import items_json
+from app.utils import items_json, encode_cursor, decode_cursor
 from . import user as user_blueprint
 from .forms import LoginForm, RegistrationDetailForm, MobileRegistrationForm, ResetPasswordDetailForm, \
     SettingForm, ResetPasswordForm
@@ -121,12 +121,27 @@ def profile():
 def collection():
     if request.method == 'GET':
         page = request.args.get('page', 1, type=int)
+        cursor = request.args.get('cursor', None, type=str)
         per_page = 10
         query = Collection.query.filter_by(user_id=current_user.id)
         amount = query.count()
-        collections = query.paginate(page, per_page, False).items
+        query = query.order_by(Collection.created, Collection.id)
+        if cursor is not None:
+            after = decode_cursor(cursor, 2) if cursor else None
+            if after is not None:
+                query = query.filter(db.or_(Collection.created > after[0],
+                                            db.and_(Collection.created == after[0], Collection.id > after[1])))
+            collections = query.limit(per_page + 1).all()
+            more = len(collections) > per_page
+            collections = collections[:per_page]
+        else:
+            pagination = query.paginate(page, per_page, False)
+            collections = pagination.items
+            more = pagination.has_next
+        collections = Collection.prefetch(collections, 'item')
         collection_dict = {'collections': items_json([collection.item for collection in collections]),
-                           'amount': amount, 'page': page, 'pages': ceil(amount / per_page)}
+                           'amount': amount, 'page': page, 'pages': ceil(amount / per_page),
+                           'next': encode_cursor(collections[-1].created, collections[-1].id) if more else None}
         return jsonify(collection_dict)
 
     item_id = request.form.get('item', 0, type=int)
@@ -1,3 +1,4 @@
 # -*- coding: utf-8 -*-
 from ._compat import PY3, IO
-from ._utils import md5, md5_with_salt, md5_with_time_salt, data_table_params, DataTableHandler, items_json
+from ._utils import md5, md5_with_salt, md5_with_time_salt, data_table_params, DataTableHandler, items_json, \
+    encode_cursor, decode_cursor, chunked, chunked_query, stream_json
@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 import hashlib
+import json
 import random
 import time
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from itertools import islice
 
-from flask import current_app, request
-from flask.ext.cdn import url_for
+from flask import current_app, request, Response, stream_with_context
 
 from ._compat import PY3
 
@@ -23,6 +25,24 @@ def md5_with_time_salt(*data):
     return md5(_data_convert(data + (current_app.config['MD5_SALT'], time.time())))
 
 
+def encode_cursor(*key):
+    return urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, length):
+    """
+    Returns the key tuple of a cursor made by encode_cursor, or None if it is malformed or not `length` numbers long.
+    """
+    try:
+        key = json.loads(urlsafe_b64decode((cursor + '=' * (-len(cursor) % 4)).encode()).decode())
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(key, list) or len(key) != length or \
+            not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in key):
+        return None
+    return tuple(key)
+
+
 def _data_convert(args):
     data = ''.join(list(map(str, args)))
     if PY3:
@@ -31,10 +51,24 @@ def _data_convert(args):
 
 
 class DataTableHandler(object):
-    def __init__(self, params):
+    """
+    Serves a DataTables page with one count, one page query and one query per prefetched attribute.
+
+    A column may declare what its data lambda needs through 'prefetch': an attribute path (or a tuple of them)
+    loaded with Property.prefetch, e.g. 'vendor' or 'address.area', or a callable which receives the page's
+    records and loads whatever the lambda reads.
+
+    Given a key column, DataTableHandler(params, key=Item.id) also pages by seek: a request carrying last_id
+    (and no explicit ordering) reads the rows after it instead of skipping `start` rows, and every response
+    carries the last_id of its page.
+    """
+
+    def __init__(self, params, key=None):
         self.params = params
+        self.key = key
         self.start = None
         self.length = None
+        self.last_id = None
         self.data = {'data': []}
         self.parse_request_params()
 
@@ -44,10 +78,10 @@ class DataTableHandler(object):
         length = request.args.get('length', 10, type=int)
         valid_length = [10, 25, 50, 100]
         self.length = length if length in valid_length else valid_length[0]
+        self.last_id = request.args.get('last_id', None, type=int)
 
     def query_params(self, query):
-        self.data['recordsTotal'] = query.count()
-        self.data['recordsFiltered'] = query.count()
+        self.data['recordsTotal'] = self.data['recordsFiltered'] = query.order_by(None).count()
         order_column = request.args.get('order[0][column]', '')
         order_key = request.args.get('columns[%s][data]' % order_column, '')
         order_dir = request.args.get('order[0][dir]')
@@ -56,14 +90,45 @@ class DataTableHandler(object):
                 query = query.order_by(-self.params[order_key]['order_key'])
             else:
                 query = query.order_by(self.params[order_key]['order_key'])
-        query = query.offset(self.start).limit(self.length)
-        for record in query:
+            query = query.offset(self.start)
+        elif self.key is not None:
+            query = query.order_by(self.key)
+            if self.last_id is not None:
+                query = query.filter(self.key > self.last_id)
+            else:
+                query = query.offset(self.start)
+        else:
+            query = query.offset(self.start)
+        records = self.prefetch(query.limit(self.length).all())
+        for record in records:
             data = {}
             for param in self.params:
                 data[param] = self.params[param]['data'](record)
             self.data['data'].append(data)
+        if self.key is not None:
+            self.data['last_id'] = getattr(records[-1], self.key.key) if records else self.last_id
         return self.data
 
+    def prefetch(self, records):
+        if not records:
+            return records
+        for param in self.params.values():
+            prefetch = param.get('prefetch')
+            if prefetch is None:
+                continue
+            elif callable(prefetch):
+                prefetch(records)
+                continue
+            for path in (prefetch,) if isinstance(prefetch, str) else prefetch:
+                instances = records
+                for attr in path.split('.'):
+                    instances = [instance for instance in instances if instance is not None]
+                    if not instances:
+                        break
+                    type(instances[0]).prefetch(instances, attr)
+                    instances = [getattr(instance, attr) for instance in instances]
+        return records
+
 
 def data_table_params():
     draw = request.args.get('draw', 1, type=int)
@@ -74,23 +139,63 @@ def data_table_params():
     return draw, start, length
 
 
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def chunked_query(query, column, size=500):
+    """
+    Rows of query in chunks of `size` ordered by the unique column, each chunk read with its own
+    `column > last ORDER BY column LIMIT size`. PyMySQL buffers whole result sets (yield_per does not change
+    that), so this is what keeps a full table walk at one chunk in memory.
+    """
+    last = None
+    while True:
+        page = query if last is None else query.filter(column > last)
+        rows = page.order_by(column).limit(size).all()
+        if not rows:
+            return
+        yield rows
+        last = getattr(rows[-1], column.key)
+
+
+def stream_json(rows, **fields):
+    """
+    Response writing {"field": value, ..., "data": [row, ...]} while rows is consumed, so a generator over
+    chunked_query() is never held in memory as a whole.
+    """
+    def generate():
+        head = json.dumps(fields)
+        yield '%s%s"data": [' % (head[:-1], ', ' if fields else '')
+        separator = ''
+        for chunk in chunked(rows, 100):
+            yield separator + ','.join(json.dumps(row) for row in chunk)
+            separator = ','
+        yield ']}'
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
 def items_json(items):
-    from app.models import Item
+    from app.models import Item, ItemImage
     if not items:
         return []
     elif isinstance(items[0], Item):
         item_query = items
     else:
-        item_query = Item.query.filter(Item.id.in_(items))
+        order = {int(item_id): index for index, item_id in enumerate(items)}
+        item_query = sorted(Item.query.filter(Item.id.in_(items)), key=lambda item: order[item.id])
+    covers = ItemImage.covers(item.id for item in item_query)
     item_list = []
     for item in item_query:
-        image = item.images.first()
-        image_url = image.url if image else url_for('static', filename='img/user/item_default_img.jpg')
         item_list.append({
             'id': item.id,
             'item': item.item,
             'price': item.price,
-            'image_url': image_url,
+            'image_url': covers[item.id],
             'is_suite': item.is_suite
         })
     return item_list
@@ -3,11 +3,15 @@ import base64
 import datetime
 import hashlib
 import hmac
+import io
 import json
 import os
+import tempfile
 import time
 import urllib
+from email.utils import formatdate
 
+import requests
 from PIL import Image
 from flask import current_app, url_for
 
@@ -20,7 +24,64 @@ def _generate_dir_path(id_, dir_name):
     return dir_path
 
 
+JPEG_MAGIC = b'\xff\xd8\xff'
+
+
+def derivative_path(image_path, derivative):
+    return '%s_%s.jpg' % (image_path.rsplit('.', 1)[0], derivative)
+
+
+# resize done by OSS when the object is fetched, for images uploaded straight to the bucket
+OSS_RESIZE = 'x-oss-process=image/resize,m_lfit,w_%d,h_%d'
+
+
+def derivative_reference(image_path, derivative):
+    """
+    Path, possibly with a query, serving the derivative of an item image. Images stored here (save_image_blob)
+    use the file generated by the image_derivative task, or the original until it exists. Images uploaded to
+    OSS (image_callback) have no local file, OSS resizes them on the fly.
+    """
+    image_dir = current_app.config['IMAGE_DIR']
+    if os.path.exists(os.path.join(image_dir, image_path)):
+        local_path = derivative_path(image_path, derivative)
+        return local_path if os.path.exists(os.path.join(image_dir, local_path)) else image_path
+    size = current_app.config['IMAGE_DERIVATIVES'][derivative]
+    return '%s?%s' % (image_path, OSS_RESIZE % (size, size))
+
+
+def write_atomically(path, write):
+    """
+    write(f) into a temporary file next to path, then rename it over path, readers never see a partial file.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def verify_image(fp):
+    """
+    Whether the file is an image PIL can read, checked without decoding the pixels. fp is left at its start.
+    """
+    try:
+        Image.open(fp).verify()
+    except Exception:  # PIL raises whatever its parser trips on for a corrupt file
+        return False
+    finally:
+        fp.seek(0)
+    return True
+
+
 def save_image(id_, dir_name, field, img_stream):
+    """
+    Uploads are stored as they are once PIL can read them, anything but JPEG is converted to JPEG in place by
+    the image_derivative task.
+    """
     path = current_app.config['IMAGE_DIR']
     relative_path = _generate_dir_path(id_, dir_name)
     dir_path = os.path.join(path, relative_path)
@@ -31,15 +92,70 @@ def save_image(id_, dir_name, field, img_stream):
     image_name = '%s.%s' % (image_hash, 'jpg')
     image_path = os.path.join(dir_path, image_name)
 
-    im = Image.open(img_stream)
-    im.save(image_path, format='jpeg')
-    im.close()
+    data = img_stream.read()
+    if not verify_image(io.BytesIO(data)):
+        raise ValueError('%s is not an image' % field.name)
+    write_atomically(image_path, lambda f: f.write(data))
+    if data[:3] != JPEG_MAGIC:
+        from app.tasks import image_derivative
+        image_derivative.delay(image_path, image_path, None)
     return relative_path + image_name, image_hash
 
 
-def _oss_signature_generator(policy):
+def _copy_hashing(src, dst, chunk_size=65536):
+    md5 = hashlib.md5()
+    for chunk in iter(lambda: src.read(chunk_size), b''):
+        md5.update(chunk)
+        dst.write(chunk)
+    return md5.hexdigest()
+
+
+def save_image_blob(item_id, img_stream):
+    """
+    Content-addressed storage for item images: the upload is streamed to disk while its md5 is computed and kept
+    once as images/blobs/<md5[:2]>/<md5[2:4]>/<md5>.jpg, whoever uploads the same bytes again gets the same
+    file. The md5 is the one of the upload, like an OSS etag, even when the image_derivative task later converts
+    the file to JPEG in place. Returns (relative path, md5), the tasks are queued only when the content is new.
+    """
+    image_dir = current_app.config['IMAGE_DIR']
+    temp_dir = os.path.join(image_dir, 'images/blobs')
+    if not os.path.exists(temp_dir):
+        os.makedirs(temp_dir)
+    fd, temp_path = tempfile.mkstemp(dir=temp_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            image_hash = _copy_hashing(img_stream, f)
+        with open(temp_path, 'rb') as f:
+            if not verify_image(f):
+                raise ValueError('upload is not an image')
+            is_jpeg = f.read(3) == JPEG_MAGIC
+
+        relative_path = 'images/blobs/%s/%s/%s.jpg' % (image_hash[:2], image_hash[2:4], image_hash)
+        image_path = os.path.join(image_dir, relative_path)
+        if os.path.exists(image_path):
+            os.remove(temp_path)
+            return relative_path, image_hash
+        if not os.path.exists(os.path.dirname(image_path)):
+            os.makedirs(os.path.dirname(image_path))
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, image_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    from app.tasks import image_derivative
+    if not is_jpeg:
+        image_derivative.delay(image_path, image_path, None)
+    for derivative, size in current_app.config['IMAGE_DERIVATIVES'].items():
+        image_derivative.delay(image_path, derivative_path(image_path, derivative), size,
+                               item_id if derivative == 'list' else None)
+    return relative_path, image_hash
+
+
+def _oss_signature_generator(string_to_sign):
     return base64.encodebytes(hmac.new(current_app.config['OSS_ACCESS_SECRET'].encode(),
-                                       policy.encode(), hashlib.sha1).digest()).strip().decode()
+                                       string_to_sign.encode(), hashlib.sha1).digest()).strip().decode()
 
 
 def _oss_policy_generator(callback):
@@ -52,6 +168,31 @@ def _oss_policy_generator(callback):
     }
 
 
+def delete_image_file(image_path):
+    """
+    Deletes a stored image: the file and its derivatives when it is kept here, the OSS object otherwise.
+    A failed OSS request is logged, the object is only wasted space.
+    """
+    local_path = os.path.join(current_app.config['IMAGE_DIR'], image_path)
+    if os.path.exists(local_path):
+        for path in [local_path] + [derivative_path(local_path, derivative)
+                                    for derivative in current_app.config['IMAGE_DERIVATIVES']]:
+            if os.path.exists(path):
+                os.remove(path)
+        return
+    date = formatdate(usegmt=True)
+    signature = _oss_signature_generator('DELETE\n\n\n%s\n/%s/%s' % (date, current_app.config['OSS_BUCKET_NAME'],
+                                                                        image_path))
+    headers = {'Date': date, 'Authorization': 'OSS %s:%s' % (current_app.config['OSS_ACCESS_ID'], signature)}
+    try:
+        response = requests.delete('http://%s/%s' % (current_app.config['OSS_HOST'], image_path), headers=headers,
+                                   timeout=10)
+        if response.status_code not in (204, 404):
+            current_app.logger.warning('deleting OSS object %s: HTTP %d', image_path, response.status_code)
+    except requests.RequestException as e:
+        current_app.logger.warning('deleting OSS object %s: %s', image_path, e)
+
+
 def oss_authorization(item_id, filename):
     dir_path = _generate_dir_path(item_id, 'item')
     image_hash = md5_with_time_salt(item_id, 'image')
@@ -1,31 +1,306 @@
 # -*- coding: utf-8 -*-
 import json
+import math
+import random
+import os
+import threading
+import time
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from uuid import uuid4
 
-from flask import current_app
+from flask import current_app, copy_current_request_context, has_request_context
+
+from redis.exceptions import ConnectionError
 
 from app import local_redis
 from app.constants import CONFIRM_EMAIL, REGISTER_ACTION, IMAGE_CAPTCHA
 
+INVALIDATE_CHANNEL = 'cache:invalidate'
+
+# command -> [calls, seconds] of this process, see redis_latency()
+latency = defaultdict(lambda: [0, 0.0])
+latency_lock = threading.Lock()
+
+_getdel = local_redis.register_script("""
+local value = redis.call('GET', KEYS[1])
+if value then
+    redis.call('DEL', KEYS[1])
+end
+return value
+""")
+
+_release = local_redis.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+
+@contextmanager
+def timed(command):
+    started = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - started
+        # request and background refresh threads time their commands concurrently
+        with latency_lock:
+            counter = latency[command]
+            counter[0] += 1
+            counter[1] += elapsed
+
+
+def redis_latency():
+    with latency_lock:
+        counters = [(command, calls, seconds) for command, (calls, seconds) in latency.items() if calls]
+    return {command: {'calls': calls, 'avg_ms': seconds * 1000 / calls} for command, calls, seconds in counters}
+
+
+def _key(content_type, key):
+    return '%s:%s' % (content_type, key)
+
+
+def _expire(content_type, expire):
+    return expire if expire else current_app.config['%s_DURATION' % content_type]
+
+
+def _load(value, serialize):
+    if value is None:
+        return None
+    value = value.decode()
+    return json.loads(value) if serialize is True else value
+
 
 def redis_set(content_type, key, value, expire=None, serialize=False):
     if serialize is True:
         value = json.dumps(value)
-    key = '%s:%s' % (content_type, key)
-    expire = expire if expire else current_app.config['%s_DURATION' % content_type]
-    local_redis.set(key, value, expire)
+    with timed('set'):
+        local_redis.set(_key(content_type, key), value, _expire(content_type, expire))
 
 
 def redis_get(content_type, key, delete=False, serialize=False):
-    key = '%s:%s' % (content_type, key)
-    value = local_redis.get(key)
-    if value:
-        value = value.decode()
-        if delete:
-            local_redis.delete(key)
-    if serialize is True and value is not None:
-        value = json.loads(value)
-    return value
+    key = _key(content_type, key)
+    if delete:
+        # GET and DEL in one script so a token or captcha can only be consumed once
+        with timed('getdel'):
+            value = _getdel(keys=[key])
+    else:
+        with timed('get'):
+            value = local_redis.get(key)
+    return _load(value or None, serialize)
+
+
+def redis_mget(content_type, keys, serialize=False):
+    """
+    {key: value} for every key, None where missing, in one round trip.
+    """
+    keys = list(keys)
+    if not keys:
+        return {}
+    with timed('mget'):
+        values = local_redis.mget([_key(content_type, key) for key in keys])
+    return {key: _load(value, serialize) for key, value in zip(keys, values)}
+
+
+def redis_mset(content_type, mapping, expire=None, serialize=False):
+    """
+    Sets every key of mapping with the same expiry, in one round trip.
+    """
+    if not mapping:
+        return
+    expire = _expire(content_type, expire)
+    pipe = local_redis.pipeline(transaction=False)
+    for key, value in mapping.items():
+        pipe.set(_key(content_type, key), json.dumps(value) if serialize is True else value, expire)
+    with timed('mset'):
+        pipe.execute()
+
+
+def redis_delete(content_type, *keys):
+    if keys:
+        with timed('delete'):
+            local_redis.delete(*[_key(content_type, key) for key in keys])
 
 
 def redis_verify(content_type, key, value, delete=False):
     return value == redis_get(content_type, key, delete)
+
+
+def _rebuild(key, lock, token, build, args, ttl, stale, local_ttl=None):
+    try:
+        started = time.time()
+        value = build(*args)
+        now = time.time()
+        pipe = local_redis.pipeline()
+        pipe.hmset(key, {'value': value, 'delta': now - started, 'expiry': now + ttl})
+        pipe.expire(key, ttl + stale)
+        with timed('cache_store'):
+            pipe.execute()
+        if local_ttl:
+            # the other workers drop their copy and pick this one up from redis
+            local_cache.invalidate(key)
+            local_cache.set(key, value, local_ttl)
+        return value
+    finally:
+        _release(keys=[lock], args=[token])
+
+
+class LocalCache(object):
+    """
+    Bounded LRU with a per entry TTL, private to the worker process. Keys published on INVALIDATE_CHANNEL are
+    evicted from every other process by a subscriber thread started on first use.
+    """
+
+    def __init__(self, maxsize=256, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+        self.listener_pid = None
+        # tags what this process publishes, so its own listener does not evict what it has just stored
+        self.origin = None
+
+    def get(self, key):
+        self.listen()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] < time.time():
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.entries[key] = (value, time.time() + (ttl or self.ttl))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def evict(self, key=None):
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    def invalidate(self, key):
+        """
+        Evicts key here and, through pub/sub, in every other process.
+        """
+        self.listen()
+        self.evict(key)
+        with timed('publish'):
+            local_redis.publish(INVALIDATE_CHANNEL, '%s:%s' % (self.origin, key))
+
+    def listen(self):
+        # one subscriber per process, started again in children forked after the first use
+        if self.listener_pid == os.getpid():
+            return
+        with self.lock:
+            if self.listener_pid == os.getpid():
+                return
+            self.listener_pid = os.getpid()
+            self.origin = uuid4().hex
+        listener = threading.Thread(target=self._listen, name='local-cache-invalidation')
+        listener.daemon = True
+        listener.start()
+
+    def _listen(self):
+        while True:
+            pubsub = local_redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(INVALIDATE_CHANNEL)
+                # whatever was published while we were not subscribed is lost, start clean
+                self.evict()
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        origin, key = message['data'].decode().split(':', 1)
+                        if origin != self.origin:
+                            self.evict(key)
+            except ConnectionError:
+                time.sleep(1)
+            finally:
+                pubsub.close()
+
+
+local_cache = LocalCache()
+
+
+def cached(content_type, ttl=86400, stale=3600, lock_timeout=60, wait=2, beta=1.0, local_ttl=None):
+    """
+    Caches the string returned by the decorated function under cache:content_type:<args>, without stampedes:
+
+    - a miss is rebuilt by a single caller holding a lock, the others wait up to `wait` seconds for its result
+      and then build it themselves, without storing it;
+    - a hit may be refreshed early, with a probability growing as the expiry approaches and with the time the
+      last rebuild took (XFetch), so popular keys are rebuilt before they expire;
+    - for `stale` seconds past the expiry the old value is still served while one caller rebuilds it in the
+      background;
+    - with local_ttl, hits are also kept in local_cache for that many seconds, and every rebuild or
+      invalidate() evicts the local copies of all processes.
+
+    @cached('BRAND_ITEMS')
+    def vendor_items(vendor_id):
+        return json.dumps(...)
+
+    vendor_items.invalidate(vendor_id)
+    """
+    def decorator(build):
+        def cache_key(args):
+            return 'cache:%s' % _key(content_type, ':'.join(str(arg) for arg in args) or 'ITEMS')
+
+        @wraps(build)
+        def wrapper(*args):
+            key = cache_key(args)
+            if local_ttl:
+                value = local_cache.get(key)
+                if value is not None:
+                    return value
+            value = fetch(key, args)
+            if local_ttl:
+                local_cache.set(key, value, local_ttl)
+            return value
+
+        def invalidate(*args):
+            key = cache_key(args)
+            with timed('delete'):
+                local_redis.delete(key)
+            local_cache.invalidate(key)
+
+        def fetch(key, args):
+            lock = '%s:lock' % key
+            with timed('cache_get'):
+                value, delta, expiry = local_redis.hmget(key, 'value', 'delta', 'expiry')
+            if value is not None:
+                # -log(u) for u in (0, 1] is exponentially distributed, long rebuilds start earlier
+                refresh_at = float(expiry) + float(delta) * beta * math.log(1 - random.random())
+                if time.time() >= refresh_at:
+                    token = uuid4().hex
+                    if local_redis.set(lock, token, ex=lock_timeout, nx=True):
+                        if has_request_context():
+                            refresh = copy_current_request_context(_rebuild)
+                            threading.Thread(target=refresh,
+                                             args=(key, lock, token, build, args, ttl, stale, local_ttl)).start()
+                        else:
+                            return _rebuild(key, lock, token, build, args, ttl, stale, local_ttl)
+                return value.decode()
+            token = uuid4().hex
+            deadline = time.time() + wait
+            while not local_redis.set(lock, token, ex=lock_timeout, nx=True):
+                time.sleep(0.05)
+                value = local_redis.hget(key, 'value')
+                if value is not None:
+                    return value.decode()
+                if time.time() > deadline:
+                    return build(*args)
+            return _rebuild(key, lock, token, build, args, ttl, stale, local_ttl)
+
+        wrapper.invalidate = invalidate
+        return wrapper
+    return decorator
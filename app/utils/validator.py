@@ -3,11 +3,11 @@ import re
 from base64 import b64decode
 from flask import session
 from wtforms.validators import Regexp, Email as BaseEmail, ValidationError
-from PIL import Image as BaseImage
 
 from app.models import User, Vendor, Area
 from app.constants import IMAGE_CAPTCHA
 from app.utils import IO
+from app.utils.image import verify_image
 from app.utils.redis import redis_verify
 
 
@@ -72,8 +72,11 @@ class AreaValidator(object):
         self.message = message
 
     def __call__(self, form, field):
-        area = Area.query.filter_by(cn_id=field.data).limit(1).first()
-        if not area or Area.query.filter_by(father_id=area.id).count() > 0:
+        try:
+            area = Area.tree().by_cn_id(int(field.data))
+        except (TypeError, ValueError):
+            area = None
+        if not area or area.children:
             raise ValidationError(self.message)
 
 
@@ -82,17 +85,18 @@ class QueryID(object):
         self.model = model
         self.required = required
         self.message = message
+        self.get = model.cached if hasattr(model, 'cached') else model.query.get
 
     def __call__(self, form, field):
         if self.required or field.data:
             if not isinstance(field.data, (list, tuple)):
-                if field.data is None or not self.model.query.get(field.data):
+                if field.data is None or not self.get(field.data):
                     raise ValidationError(self.message)
             else:
                 if not field.data:
                     raise ValidationError(self.message)
                 for data in field.data:
-                    if field.data is None or not self.model.query.get(data):
+                    if field.data is None or not self.get(data):
                         raise ValidationError(self.message)
 
 
@@ -127,9 +131,8 @@ class Image(object):
                 image_str = IO(b64decode(field.data[23:]))
             else:
                 image_str = field.data.stream
-            try:
-                BaseImage.open(image_str)
-            except OSError:
+            # verify_image rewinds the stream for the form to save it
+            if not verify_image(image_str):
                 raise ValidationError(self.message)
 
 
@@ -19,11 +19,36 @@ class Config(object):
     SMS_CAPTCHA_DURATION = 600
     IMAGE_CAPTCHA_DURATION = 600
     ITEM_PER_PAGE = 40
+    REDIS_URL = 'redis://localhost:6379/0'
+    # connections per process, callers wait up to REDIS_POOL_TIMEOUT seconds for a free one
+    REDIS_MAX_CONNECTIONS = 32
+    REDIS_POOL_TIMEOUT = 5
+    STATISTIC_DURATION = 86400 * 7
+    STATISTIC_LOCK_TIMEOUT = 300
+    # patches replayed on top of a snapshot before a full snapshot is published again
+    STATISTIC_MAX_PATCHES = 500
+    ITEM_DUMPS_DURATION = 86400
+    ITEM_COMPARE_DURATION = 86400
+    ITEM_COVER_DURATION = 86400
+    # longest edge in pixels of the derivatives generated for item images
+    IMAGE_DERIVATIVES = {'thumb': 160, 'list': 400, 'detail': 1080}
+    # baidu map api, point GEO_CODING_URL at a local stub in tests
+    GEO_CODING_URL = 'http://api.map.baidu.com'
+    GEO_CODING_AK = 'sdp9qCbToS7E23nDRxaAAwbh'
+    GEO_CODING_GEOTABLE_ID = '121763'
+    GEO_CODING_CONCURRENCY = 8
+    GEO_CODING_RETRIES = 3
+    GEO_CODING_BACKOFF = 0.5  # seconds, doubled on every retry
+    GEO_CODING_TIMEOUT = 5
+    # addresses the api could not place are asked again after this many seconds
+    GEO_CODING_MISS_DURATION = 86400 * 7
     CDN_DOMAIN = 'static.wanmujia.com'
     CDN_TIMESTAMP = False
     CONFIG_PATH = os.path.join(basedir, 'config.json')
 
     ADMIN_EMAILS = []
+    # partners allowed to pull /item/export?token=
+    EXPORT_TOKENS = []
     WMJ_MAIL_SENDER = (u'万木家', 'notification@wanmujia.com')
 
     @classmethod
@@ -89,6 +114,7 @@ class ProductionConfig(Config):
         cls.OSS_BUCKET_NAME = config_dict['OSS_BUCKET_NAME']
         cls.OSS_HOST = config_dict['OSS_HOST']
         cls.ITEMS = config_dict['ITEMS']
+        cls.EXPORT_TOKENS = config_dict.get('EXPORT_TOKENS', [])
         cls.FEEDBACK_EMAILS = config_dict['FEEDBACK_EMAILS']
         cls.SMS_ACCOUNT = config_dict['SMS_ACCOUNT']
         cls.SMS_PASSWORD = config_dict['SMS_PASSWORD']
@@ -45,5 +45,23 @@ def test(coverage=False):
         COV.erase()
 
 
+@manager.option('-o', '--output', dest='output', default=None, help='dump directory, IMAGE_DIR/raw_images by default')
+@manager.option('-w', '--workers', dest='workers', type=int, default=8, help='copy threads')
+def images_dump(output, workers):
+    """Copy every item's images into brand/item folders, resuming an interrupted dump."""
+    from app.export import ImagesDump
+
+    def report(dump):
+        elapsed = max(dump.elapsed, 0.001)
+        print('%d/%d items, %d files, %.1f MB, %.1f MB/s, %.1f items/s' % (
+            dump.items_done, dump.items_total, dump.files_copied, dump.bytes_copied / 1048576,
+            dump.bytes_copied / 1048576 / elapsed, dump.items_done / elapsed))
+
+    dump = ImagesDump(output, workers)
+    if dump.finished_items():
+        print('resuming, %d items already dumped' % len(dump.finished_items()))
+    dump.run(report=report)
+
+
 if __name__ == '__main__':
     manager.run()
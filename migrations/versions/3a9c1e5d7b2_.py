@@ -0,0 +1,32 @@
+"""image blobs
+
+Revision ID: 3a9c1e5d7b2
+Revises: 1364179233d
+Create Date: 2026-10-18 10:12:31.508214
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3a9c1e5d7b2'
+down_revision = '1364179233d'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('image_blobs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('hash', sa.CHAR(length=32), nullable=False),
+    sa.Column('path', sa.String(length=255), nullable=False),
+    sa.Column('reference_count', sa.Integer(), nullable=False),
+    sa.Column('created', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('hash')
+    )
+    op.create_index(op.f('ix_item_images_hash'), 'item_images', ['hash'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_item_images_hash'), table_name='item_images')
+    op.drop_table('image_blobs')
@@ -2,9 +2,29 @@
 import json
 import redis
 import unittest
+from contextlib import contextmanager
 from hashlib import md5
+from sqlalchemy import event
+
 from app import create_app, db
-from app.models import generate_fake_data
+from app.models import generate_fake_data, Vendor, Distributor, DistributorAddress
+
+
+@contextmanager
+def queries():
+    """
+    Collects the SQL statements run inside the block.
+    """
+    statements = []
+
+    def collect(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', collect)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', collect)
 
 
 class WMJTestCase(unittest.TestCase):
@@ -61,3 +81,26 @@ class WMJTestCase(unittest.TestCase):
 
     def load_json(self, response):
         return json.loads(response.data.decode('utf8'))
+
+    def add_vendors(self, num):
+        vendors = []
+        for index in range(num):
+            vendor = Vendor(self.twice_md5(b'123456'), '1830000000%d' % index, 'vendor%d@wanmujia.com' % index,
+                            u'万木家', '12345678901234567%d' % index, u'万木家%d' % index, '2035/09/11',
+                            '01012345678', u'品牌%d' % index)
+            vendor.confirmed = True
+            db.session.add(vendor)
+            vendors.append(vendor)
+        db.session.commit()
+        return vendors
+
+    def add_distributor(self, vendor_id, username, latitude=0, longitude=0, cn_id=110101):
+        distributor = Distributor(username, self.twice_md5(b'123456'), vendor_id, u'体验馆', '13000000000',
+                                  '01012345678', u'联系人')
+        db.session.add(distributor)
+        db.session.commit()
+        address = DistributorAddress(distributor.id, cn_id, u'东城区')
+        address.latitude, address.longitude = latitude, longitude
+        db.session.add(address)
+        db.session.commit()
+        return distributor
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import csv
+import io
+import json
+from flask import url_for
+
+from tests import WMJTestCase
+from app import statisitc
+from app.models import Item, Stock
+
+
+class DistributorTestCase(WMJTestCase):
+    def setUp(self):
+        super(DistributorTestCase, self).setUp()
+        self.vendor, self.other_vendor = self.add_vendors(2)
+        Item.generate_fake(2)
+        statisitc.init_statistic()
+        statisitc.publish()
+        self.distributor = self.add_distributor(self.vendor.id, u'stock')
+        response = self.client.post(url_for('distributor.login'),
+                                    data={'username': u'stock', 'password': self.twice_md5(b'123456')})
+        self.assertTrue(self.load_json(response)['accessGranted'])
+        self.item_ids = [item.id for item in Item.query.filter_by(vendor_id=self.vendor.id, is_component=False).
+                         order_by(Item.id)]
+
+    def import_stocks(self, **kwargs):
+        response = self.assert_ok_json(self.client.post(url_for('distributor.items_stock_bulk'), **kwargs))
+        return self.load_json(response)
+
+    def stocks(self):
+        return {stock.item_id: stock.stock for stock in Stock.query.filter_by(distributor_id=self.distributor.id)}
+
+    def test_export_round_trip(self):
+        response = self.assert_ok(self.client.get(url_for('distributor.items_stock_bulk')))
+        rows = list(csv.reader(io.StringIO(response.data.decode('utf-8'))))
+        self.assertEqual(['item_id', 'item', 'stock'], rows[0])
+        self.assertEqual(self.item_ids, [int(row[0]) for row in rows[1:]])
+        self.assertEqual({'0'}, {row[2] for row in rows[1:]})
+
+        # the export, edited and sent back as is
+        for row in rows[1:3]:
+            row[2] = '1'
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        data = self.import_stocks(data={'stocks': buffer.getvalue()})
+        self.assertTrue(data['success'])
+        self.assertEqual(len(self.item_ids), data['amount'])
+        self.assertEqual({item_id: 1 if item_id in self.item_ids[:2] else 0 for item_id in self.item_ids},
+                         self.stocks())
+        self.assertEqual(set(self.item_ids[:2]), set(statisitc.availability) & set(self.item_ids))
+
+        response = self.client.get(url_for('distributor.items_stock_bulk'))
+        rows = list(csv.reader(io.StringIO(response.data.decode('utf-8'))))
+        self.assertEqual(['1', '1'] + ['0'] * (len(self.item_ids) - 2), [row[2] for row in rows[1:]])
+
+    def test_import_formats(self):
+        first, second = self.item_ids[:2]
+        # no header, item_id first and stock last
+        data = self.import_stocks(data={'stocks': '%d,1\n\n%d,%s,0\n' % (first, second, u'圈椅')})
+        self.assertTrue(data['success'])
+        self.assertEqual({first: 1, second: 0}, self.stocks())
+        # columns picked by the header
+        data = self.import_stocks(data={'stocks': 'item_id,stock,item\n%d,0,a\n%d,1,b\n' % (first, second)})
+        self.assertTrue(data['success'])
+        self.assertEqual({first: 0, second: 1}, self.stocks())
+        # an uploaded file, with the byte order mark spreadsheets write
+        upload = io.BytesIO(('\ufeffitem_id,item,stock\n%d,%s,1\n' % (first, u'圈椅')).encode('utf-8'))
+        data = self.import_stocks(data={'file': (upload, 'stocks.csv')})
+        self.assertTrue(data['success'])
+        self.assertEqual({first: 1, second: 1}, self.stocks())
+        # a json list
+        data = self.import_stocks(data=json.dumps([{'item_id': first, 'stock': 0}]), content_type='application/json')
+        self.assertTrue(data['success'])
+        self.assertEqual({first: 0, second: 1}, self.stocks())
+        self.assertEqual({second}, set(statisitc.availability) & {first, second})
+
+    def test_import_errors(self):
+        first = self.item_ids[0]
+        other = Item.query.filter_by(vendor_id=self.other_vendor.id, is_component=False).first().id
+        for stocks in ('', '%d,2' % first, '%d,x' % first, 'item_id,item\n%d,a' % first, '[{"item_id": 1}]',
+                       '%d,1\n%d,1' % (first, other)):
+            data = self.import_stocks(data={'stocks': stocks})
+            self.assertFalse(data['success'], stocks)
+            self.assertIn('message', data)
+        self.assertIn(str(other), self.import_stocks(data={'stocks': '%d,1' % other})['message'])
+        self.assertEqual({}, self.stocks())
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+
+from tests import WMJTestCase
+from app import db
+from app.export import ImagesDump, copy_file
+from app.models import Item, ItemImage
+
+
+class ImagesDumpTestCase(WMJTestCase):
+    def setUp(self):
+        super(ImagesDumpTestCase, self).setUp()
+        self.image_dir = tempfile.mkdtemp()
+        self.app.config['IMAGE_DIR'] = self.image_dir
+        self.add_vendors(1)
+        Item.generate_fake(1)
+        self.items = Item.query.filter_by(is_deleted=False).order_by(Item.id).all()
+        os.makedirs(os.path.join(self.image_dir, 'images'))
+        self.contents = {}
+        for item in self.items:
+            for sort in (1, 2):
+                path = 'images/%d_%d.jpg' % (item.id, sort)
+                self.contents[path] = os.urandom(1000 * sort)
+                with open(os.path.join(self.image_dir, path), 'wb') as f:
+                    f.write(self.contents[path])
+                db.session.add(ItemImage(item.id, path, '%032d' % item.id, '%d.jpg' % sort, sort))
+        db.session.commit()
+        self.dump_dir = os.path.join(self.image_dir, 'dump')
+
+    def tearDown(self):
+        shutil.rmtree(self.image_dir)
+        super(ImagesDumpTestCase, self).tearDown()
+
+    def item_dir(self, item):
+        return os.path.join(self.dump_dir, '%s_%d' % (item.vendor.brand, item.vendor.id),
+                            '%s_%d' % (item.item.replace('/', ''), item.id))
+
+    def test_copy_file(self):
+        src = os.path.join(self.image_dir, 'images/%d_2.jpg' % self.items[0].id)
+        dst = os.path.join(self.image_dir, 'copy.jpg')
+        self.assertEqual(2000, copy_file(src, dst))
+        with open(dst, 'rb') as f:
+            self.assertEqual(self.contents['images/%d_2.jpg' % self.items[0].id], f.read())
+        open(src, 'wb').close()
+        self.assertEqual(0, copy_file(src, dst))
+        self.assertEqual(0, os.path.getsize(dst))
+
+    def test_dump(self):
+        reports = []
+        dump = ImagesDump(self.dump_dir, workers=4).run(report=lambda progress: reports.append(progress.items_done),
+                                                        report_every=2)
+        self.assertEqual((len(self.items), len(self.items), 0), (dump.items_total, dump.items_done, dump.items_skipped))
+        self.assertEqual((len(self.contents), sum(len(data) for data in self.contents.values())),
+                         (dump.files_copied, dump.bytes_copied))
+        self.assertEqual(len(self.items), reports[-1])
+        for item in self.items:
+            item_dir = self.item_dir(item)
+            self.assertEqual({'%d_1.jpg' % item.id, '%d_2.jpg' % item.id, '商品信息.txt'}, set(os.listdir(item_dir)))
+            with open(os.path.join(item_dir, '%d_1.jpg' % item.id), 'rb') as f:
+                self.assertEqual(self.contents['images/%d_1.jpg' % item.id], f.read())
+            with open(os.path.join(item_dir, '商品信息.txt'), encoding='utf8') as f:
+                self.assertIn('尺寸(cm): %s\n' % item.size, f.read())
+
+        # a second run only does what the first one did not finish
+        self.assertEqual(0, ImagesDump(self.dump_dir).run().items_total)
+        with open(dump.checkpoint_path) as f:
+            finished = f.readlines()
+        with open(dump.checkpoint_path, 'w') as f:
+            f.writelines(finished[:2])
+        unfinished = [item for item in self.items if '%d\n' % item.id not in finished[:2]]
+        shutil.rmtree(self.item_dir(unfinished[0]))
+        dump = ImagesDump(self.dump_dir).run()
+        self.assertEqual((len(unfinished), 2), (dump.items_total, dump.items_skipped))
+        self.assertTrue(os.path.exists(os.path.join(self.item_dir(unfinished[0]), '%d_2.jpg' % unfinished[0].id)))
+        self.assertEqual(len(self.items), len(ImagesDump(self.dump_dir).finished_items()))
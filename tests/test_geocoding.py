@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from tests import WMJTestCase
+from app import statisitc
+from app.constants import GEO_CODING, GEO_CODING_MISS
+from app.geocoding import geocode, geocode_many, save_poi, GeoCodingError
+from app.models import DistributorAddress
+from app.tasks import geo_code_addresses
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Stands in for the baidu geocoder: 北京 is found, 火星 is not, 天津 fails once, 上海 always fails and 冥王星 is
+    refused over the quota. Saving the poi of a distributor in poi_failures is refused too.
+    """
+    calls = {}
+    poi_failures = set()
+
+    def do_GET(self):
+        address = parse_qs(urlparse(self.path).query)['address'][0]
+        calls = self.calls[address] = self.calls.get(address, 0) + 1
+        if address == '上海' or (address == '天津' and calls == 1):
+            self.send_response(502)
+            self.end_headers()
+            return
+        if address == '火星':
+            body = {'status': 1, 'msg': 'Internal Service Error:无相关结果'}
+        elif address == '冥王星':
+            body = {'status': 302, 'msg': '天配额超限，限制访问'}
+        else:
+            body = {'status': 0, 'result': {'location': {'lng': 116.4, 'lat': 39.9}}}
+        self.send_json(body)
+
+    def do_POST(self):
+        data = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        distributor_id = int(data['distributor_id'][0])
+        if distributor_id in self.poi_failures:
+            body = {'status': 3, 'message': 'geotable not found'}
+        elif self.path.endswith('/create'):
+            body = {'status': 0, 'id': 1000 + distributor_id}
+        else:
+            body = {'status': 0}
+        self.send_json(body)
+
+    def send_json(self, body):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class GeoCodingTestCase(WMJTestCase):
+    def setUp(self):
+        super(GeoCodingTestCase, self).setUp()
+        StubHandler.calls = {}
+        StubHandler.poi_failures = set()
+        self.server = HTTPServer(('127.0.0.1', 0), StubHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.app.config['GEO_CODING_URL'] = 'http://127.0.0.1:%d' % self.server.server_port
+        self.app.config['GEO_CODING_RETRIES'] = 2
+        self.app.config['GEO_CODING_BACKOFF'] = 0
+        self.clear_cache()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.clear_cache()
+        super(GeoCodingTestCase, self).tearDown()
+
+    def clear_cache(self):
+        self.redis.delete(GEO_CODING, *self.redis.keys('%s:*' % GEO_CODING_MISS))
+
+    def test_cache(self):
+        self.assertEqual((116.4, 39.9), geocode('北京'))
+        self.assertIsNone(geocode('火星'))
+        # found and not found answers are both cached, not found ones for a while only
+        self.assertEqual({'北京': (116.4, 39.9)}, geocode_many(['北京', '火星']))
+        self.assertEqual({'北京': 1, '火星': 1}, StubHandler.calls)
+        self.assertTrue(0 < self.redis.ttl('%s:火星' % GEO_CODING_MISS) <= self.app.config['GEO_CODING_MISS_DURATION'])
+
+    def test_error_status(self):
+        # an exhausted quota is not a missing address, it is asked again next time
+        self.assertIsNone(geocode('冥王星'))
+        self.assertIsNone(geocode('冥王星'))
+        self.assertEqual(2, StubHandler.calls['冥王星'])
+        self.assertFalse(self.redis.exists('%s:冥王星' % GEO_CODING_MISS))
+        self.assertFalse(self.redis.hexists(GEO_CODING, '冥王星'))
+
+    def test_retry(self):
+        self.assertEqual((116.4, 39.9), geocode('天津'))
+        self.assertEqual(2, StubHandler.calls['天津'])
+
+    def test_failure_does_not_abort_batch(self):
+        self.assertEqual({'北京': (116.4, 39.9), '天津': (116.4, 39.9)}, geocode_many(['北京', '上海', '天津']))
+        self.assertEqual(3, StubHandler.calls['上海'])
+        # failures are not cached, the next batch asks again
+        geocode_many(['北京', '上海', '天津'])
+        self.assertEqual(6, StubHandler.calls['上海'])
+        self.assertEqual(1, StubHandler.calls['北京'])
+
+    def test_poi(self):
+        vendor, = self.add_vendors(1)
+        saved = self.add_distributor(vendor.id, u'saved')
+        failed = self.add_distributor(vendor.id, u'failed')
+        statisitc.init_statistic()
+        statisitc.publish()
+        StubHandler.poi_failures = {failed.id}
+        with self.assertRaises(GeoCodingError):
+            save_poi(u'体验馆', '北京', 116.4, 39.9, failed.id)
+        self.assertEqual(1000 + saved.id, save_poi(u'体验馆', '北京', 116.4, 39.9, saved.id))
+
+        # a poi that cannot be saved does not stop the others, its address stays put and is tried again
+        addresses = DistributorAddress.query.filter(DistributorAddress.distributor_id.in_([saved.id, failed.id]))
+        self.assertEqual([saved.id], geo_code_addresses(addresses.all()))
+        address = DistributorAddress.query.filter_by(distributor_id=saved.id).first()
+        self.assertEqual(1000 + saved.id, address.poi_id)
+        self.assertAlmostEqual(116.4, address.longitude, places=4)
+        address = DistributorAddress.query.filter_by(distributor_id=failed.id).first()
+        self.assertEqual((0, 0), (address.poi_id, address.longitude))
+        StubHandler.poi_failures = set()
+        self.assertEqual([failed.id], geo_code_addresses(addresses.all()))
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from io import BytesIO
+from types import SimpleNamespace
+from PIL import Image
+from flask import url_for
+
+from tests import WMJTestCase
+from app import db
+from app.models import Item, ItemImage, ImageBlob
+from app.tasks import celery
+from app.utils.image import derivative_path, save_image, JPEG_MAGIC
+
+
+def jpeg(color='red', size=(800, 600), format='jpeg'):
+    buffer = BytesIO()
+    Image.new('RGB', size, color).save(buffer, format=format)
+    return buffer.getvalue()
+
+
+class ImageTestCase(WMJTestCase):
+    def setUp(self):
+        super(ImageTestCase, self).setUp()
+        celery.conf.CELERY_ALWAYS_EAGER = True
+        self.image_dir = tempfile.mkdtemp()
+        self.app.config.update(IMAGE_DIR=self.image_dir, OSS_ACCESS_ID='id', OSS_ACCESS_SECRET='secret',
+                               OSS_BUCKET_NAME='bucket', OSS_HOST='127.0.0.1:9')
+        self.vendor, = self.add_vendors(1)
+        self.vendor.item_permission = True
+        db.session.commit()
+        Item.generate_fake(2)
+        self.item_ids = [item.id for item in Item.query.filter_by(vendor_id=self.vendor.id, is_component=False).
+                         order_by(Item.id).limit(2)]
+        response = self.client.post(url_for('vendor.login'),
+                                    data={'mobile': self.vendor.mobile, 'password': self.twice_md5(b'123456')})
+        self.assertTrue(self.load_json(response)['accessGranted'])
+
+    def tearDown(self):
+        shutil.rmtree(self.image_dir)
+        celery.conf.CELERY_ALWAYS_EAGER = False
+        super(ImageTestCase, self).tearDown()
+
+    def upload(self, item_id, data, filename='test.jpg'):
+        response = self.client.put(url_for('vendor.upload_item_image', item_id=item_id),
+                                   data={'file': (BytesIO(data), filename)})
+        data = self.load_json(self.assert_ok_json(response))
+        self.assertTrue(data['success'])
+        return data['image']
+
+    def delete(self, item_id, image_hash):
+        response = self.client.delete(url_for('vendor.upload_item_image'),
+                                      data={'item_id': item_id, 'image_hash': image_hash})
+        return self.load_json(self.assert_ok_json(response))['success']
+
+    def test_upload_once(self):
+        first, second = self.item_ids
+        data = jpeg()
+        image = self.upload(first, data)
+        self.assertEqual(hashlib.md5(data).hexdigest(), image['hash'])
+        # the same content uploaded again, to the same item or to another, is stored once
+        self.assertEqual(image, self.upload(first, data))
+        self.assertEqual(image['hash'], self.upload(second, data)['hash'])
+        blob = ImageBlob.query.filter_by(hash=image['hash']).one()
+        self.assertEqual(2, blob.reference_count)
+        path = os.path.join(self.image_dir, blob.path)
+        derivatives = [derivative_path(path, derivative) for derivative in self.app.config['IMAGE_DERIVATIVES']]
+        self.assertTrue(all(os.path.exists(derivative) for derivative in [path] + derivatives))
+
+        # the file goes with its last image
+        self.assertTrue(self.delete(first, image['hash']))
+        self.assertFalse(self.delete(first, image['hash']))
+        self.assertEqual(1, ImageBlob.query.filter_by(hash=image['hash']).one().reference_count)
+        self.assertTrue(os.path.exists(path))
+        self.assertTrue(self.delete(second, image['hash']))
+        self.assertIsNone(ImageBlob.query.filter_by(hash=image['hash']).first())
+        self.assertFalse(any(os.path.exists(derivative) for derivative in [path] + derivatives))
+
+        # and comes back with the next upload
+        self.upload(first, data)
+        self.assertTrue(os.path.exists(path))
+
+    def test_convert(self):
+        first = self.item_ids[0]
+        data = jpeg(size=(2000, 1000), format='png')
+        image = self.upload(first, data, 'test.png')
+        # the hash is the one of the upload, the stored file and its derivatives are JPEG
+        self.assertEqual(hashlib.md5(data).hexdigest(), image['hash'])
+        path = os.path.join(self.image_dir, ImageBlob.query.filter_by(hash=image['hash']).one().path)
+        with open(path, 'rb') as f:
+            self.assertEqual(JPEG_MAGIC, f.read(3))
+        with Image.open(derivative_path(path, 'list')) as im:
+            self.assertEqual(('JPEG', (400, 200)), (im.format, im.size))
+
+        # an upload which is not an image is refused before anything is stored
+        response = self.client.put(url_for('vendor.upload_item_image', item_id=first),
+                                   data={'file': (BytesIO(JPEG_MAGIC + b'not an image'), 'test.jpg')})
+        self.assertFalse(self.load_json(response)['success'])
+        self.assertEqual(1, ImageBlob.query.count())
+
+        # vendor images too
+        field = SimpleNamespace(name='logo')
+        path, _ = save_image(self.vendor.id, 'vendor', field, BytesIO(jpeg(format='png')))
+        with open(os.path.join(self.image_dir, path), 'rb') as f:
+            self.assertEqual(JPEG_MAGIC, f.read(3))
+        with self.assertRaises(ValueError):
+            save_image(self.vendor.id, 'vendor', field, BytesIO(JPEG_MAGIC + b'not an image'))
+
+    def test_signature_hash(self):
+        first, second = self.item_ids
+        data = jpeg()
+        image = self.upload(first, data)
+
+        def signature(**params):
+            response = self.client.get(url_for('vendor.oss_signature', item_id=second, filename='test.jpg', **params))
+            return self.load_json(self.assert_ok_json(response))
+
+        # content stored before needs no upload
+        response = signature(hash=image['hash'].upper())
+        self.assertEqual(image['hash'], response['image']['hash'])
+        self.assertNotIn('params', response)
+        self.assertEqual(2, ImageBlob.query.filter_by(hash=image['hash']).one().reference_count)
+        self.assertIn('params', signature(hash=hashlib.md5(b'unknown').hexdigest()))
+        self.assertIn('params', signature())
+
+    def test_callback(self):
+        first, second = self.item_ids
+        etag = hashlib.md5(b'oss content').hexdigest()
+
+        def callback(item_id):
+            key = self.client.get(url_for('vendor.oss_signature', item_id=item_id, filename='test.jpg'))
+            key = self.load_json(key)['params']['key']
+            response = self.client.post(url_for('vendor.image_callback'),
+                                        data={'object': key, 'etag': '"%s"' % etag.upper()})
+            return key, self.load_json(self.assert_ok_json(response))['image']
+
+        key, image = callback(first)
+        self.assertEqual(etag, image['hash'])
+        # a second upload of the content is dropped in favour of the first object
+        other_key, other_image = callback(second)
+        self.assertNotEqual(key, other_key)
+        self.assertEqual(etag, other_image['hash'])
+        self.assertEqual({key}, {item_image.path for item_image in ItemImage.query.filter_by(hash=etag)})
+        self.assertEqual(2, ImageBlob.query.filter_by(hash=etag).one().reference_count)
+
+    def test_acquire_race(self):
+        image_hash = hashlib.md5(b'race').hexdigest()
+        barrier = threading.Barrier(4)
+        paths = []
+
+        def acquire(index):
+            with self.app.app_context():
+                barrier.wait()
+                paths.append(ImageBlob.acquire(image_hash, 'images/blobs/%d.jpg' % index))
+                db.session.commit()
+                db.session.remove()
+
+        threads = [threading.Thread(target=acquire, args=(index,)) for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # every reference is counted on the one blob which won the insert
+        blob = ImageBlob.query.filter_by(hash=image_hash).one()
+        self.assertEqual(4, blob.reference_count)
+        self.assertEqual([blob.path] * 4, paths)
+        self.assertIsNone(ImageBlob.acquire(hashlib.md5(b'new').hexdigest(), None))
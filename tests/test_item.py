@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+from flask import url_for
+
+from tests import WMJTestCase, queries
+from app import db, statisitc
+from app.models import Item, Category, Stock, DistributorAddress, Privilege
+from app.utils import chunked_query
+
+
+class ItemTestCase(WMJTestCase):
+    def setUp(self):
+        super(ItemTestCase, self).setUp()
+        self.vendors = self.add_vendors(3)
+        Item.generate_fake(3)
+        statisitc.init_statistic()
+        statisitc.publish()
+
+    def item_filter(self, **params):
+        return self.load_json(self.assert_ok_json(self.client.get(url_for('item.item_filter', **params))))
+
+    def walk_pages(self, **params):
+        ids, page = [], 1
+        while True:
+            data = self.item_filter(page=page, **params)['items']
+            ids.extend(item['id'] for item in data['query'])
+            if page >= data['pages']:
+                return ids, data['amount']
+            page += 1
+
+    def walk_cursor(self, **params):
+        ids, cursor = [], ''
+        while cursor is not None:
+            data = self.item_filter(cursor=cursor, **params)['items']
+            ids.extend(item['id'] for item in data['query'])
+            cursor = data['next']
+        return ids
+
+    def test_filter(self):
+        self.app.config['ITEM_PER_PAGE'] = 4
+        ids, amount = self.walk_pages()
+        self.assertEqual(18, amount)
+        self.assertEqual(sorted(ids), ids)
+
+        vendor = self.vendors[0]
+        ids, amount = self.walk_pages(brand=[vendor.id])
+        expected = Item.query.filter_by(vendor_id=vendor.id, is_deleted=False, is_component=False).all()
+        self.assertEqual(sorted(item.id for item in expected), ids)
+        self.assertEqual({str(vendor.id): {'brand': vendor.brand}}, self.item_filter(brand=[vendor.id])[
+            'filters']['selected']['brand'])
+
+        prices = {item.id: item.price for item in Item.query}
+        ids, amount = self.walk_pages(order='asc')
+        self.assertEqual(sorted(ids, key=lambda id_: (prices[id_], id_)), ids)
+        ids, amount = self.walk_pages(order='desc')
+        self.assertEqual(sorted(ids, key=lambda id_: (-prices[id_], -id_)), ids)
+
+        # an unknown brand matches nothing, a page past the end is empty
+        self.assertEqual(0, self.item_filter(brand=[0])['items']['amount'])
+        self.assertEqual([], self.item_filter(page=100)['items']['query'])
+
+    def test_filter_cursor(self):
+        self.app.config['ITEM_PER_PAGE'] = 4
+        keyword = Item.query.filter_by(is_component=False).first().item
+        for params in ({}, {'order': 'asc'}, {'order': 'desc'}, {'brand': [self.vendors[0].id, self.vendors[1].id]},
+                       {'search': keyword}, {'search': keyword, 'order': 'desc'}, {'min_price': 1000000}):
+            ids, amount = self.walk_pages(**params)
+            self.assertEqual(amount, len(ids))
+            self.assertEqual(len(ids), len(set(ids)))
+            # the cursor walks the same items in the same order as the pages
+            self.assertEqual(ids, self.walk_cursor(**params), params)
+
+        # a malformed cursor starts over
+        self.assertEqual(self.item_filter(cursor='')['items'], self.item_filter(cursor='bm90IGEgY3Vyc29y')['items'])
+
+    def test_filter_counts(self):
+        vendor = self.vendors[0]
+        data = self.item_filter(brand=[vendor.id])
+        counts = data['filters']['counts']
+        # the brand filter does not narrow the brand counts
+        self.assertEqual({str(vendor.id): 6 for vendor in self.vendors}, counts['brand'])
+        self.assertEqual(6, data['items']['amount'])
+        # the other facets are counted under the brand filter
+        self.assertEqual(6, sum(counts['style'].values()))
+        self.assertEqual(6, sum(counts['scene'].values()))
+
+    def test_price_filter(self):
+        prices = {item.id: item.price for item in Item.query.filter_by(is_component=False)}
+        ordered = sorted(prices.values())
+        low, high = ordered[3], ordered[12]
+        data = self.item_filter(min_price=low, max_price=high)
+        self.assertEqual(len([price for price in prices.values() if low <= price <= high]), data['items']['amount'])
+        # the buckets cover the items of the other filters, whatever the price range
+        buckets = data['filters']['price_buckets']
+        self.assertEqual(18, sum(bucket['amount'] for bucket in buckets))
+        self.assertEqual(ordered[0], buckets[0]['min'])
+        self.assertEqual(ordered[-1], buckets[-1]['max'])
+
+    def test_category_filter(self):
+        items = Item.query.filter_by(is_component=False, is_suite=False).all()
+        leaf_ids = {item.category_id for item in items}
+        path = statisitc.category_closure[items[0].category_id].path
+        self.assertEqual(items[0].category_id, path[-1].id)
+        first = path[0]
+        closure = statisitc.category_closure[first.id]
+        self.assertTrue(closure.leaves <= leaf_ids)
+        # a first level category matches the items of every available leaf below it
+        data = self.item_filter(category=first.id)
+        self.assertEqual(len([item for item in items if item.category_id in closure.leaves]), data['items']['amount'])
+        self.assertIn(str(first.id), data['filters']['selected']['category'])
+
+        # a category without available items, or an unknown one, matches nothing
+        unused = Category.query.filter(Category.level == 3, ~Category.id.in_(leaf_ids)).first()
+        if unused is not None:
+            self.assertEqual(0, self.item_filter(category=unused.id)['items']['amount'])
+        self.assertEqual(0, self.item_filter(category=0)['items']['amount'])
+
+    def test_nearby(self):
+        vendor = self.vendors[0]
+        item, other = Item.query.filter_by(vendor_id=vendor.id, is_component=False).limit(2).all()
+        near = self.add_distributor(vendor.id, u'near', 39.91, 116.40)
+        far = self.add_distributor(vendor.id, u'far', 31.23, 121.47)
+        closest = self.add_distributor(vendor.id, u'closest', 39.90, 116.39)
+        for distributor in (near, far):
+            db.session.add(Stock(item.id, distributor.id, 1))
+        db.session.add(Stock(item.id, closest.id, 0))
+        db.session.commit()
+        statisitc.init_statistic()
+        statisitc.publish()
+
+        def nearby(item_id, **params):
+            response = self.client.get(url_for('item.nearby', item_id=item_id, **params))
+            return response, response.status_code == 200 and self.load_json(response)['stores']
+
+        # only stores which have the item in stock, nearest first
+        response, stores = nearby(item.id, lat=39.90, lng=116.39)
+        self.assert_ok_json(response)
+        self.assertEqual([near.id, far.id], [store['id'] for store in stores])
+        self.assertTrue(stores[0]['distance'] < 2 < 1000 < stores[1]['distance'])
+        self.assertEqual([near.id], [store['id'] for store in nearby(item.id, lat=39.90, lng=116.39, k=1)[1]])
+        self.assertEqual([far.id, near.id], [store['id'] for store in nearby(item.id, lat=31.2, lng=121.5)[1]])
+        self.assertEqual([], nearby(other.id, lat=39.90, lng=116.39)[1])
+        self.assert_status_code(nearby(item.id)[0], 400)
+        self.assert_status_code(nearby(item.id, lat=91, lng=116.39)[0], 400)
+        self.assert_not_found(nearby(0, lat=39.90, lng=116.39)[0])
+
+        # a store moves next to the query
+        address = DistributorAddress.query.filter_by(distributor_id=far.id).first()
+        address.latitude, address.longitude = 39.901, 116.391
+        db.session.commit()
+        statisitc.address_changed(far.id)
+        self.assertEqual([far.id, near.id], [store['id'] for store in nearby(item.id, lat=39.90, lng=116.39)[1]])
+
+    def test_export(self):
+        self.app.config['EXPORT_TOKENS'] = ['secret']
+        self.assert_status_code(self.client.get(url_for('item.export')), 403)
+        self.assert_status_code(self.client.get(url_for('item.export', token='wrong')), 403)
+        response = self.assert_ok_json(self.client.get(url_for('item.export', token='secret')))
+        self.assertTrue(response.is_streamed)
+        data = self.load_json(response)
+        self.assertEqual(sorted(statisitc.item_index.items), [row['id'] for row in data['data']])
+        self.assertEqual(len(data['data']), data['amount'])
+        brands = {vendor.id: vendor.brand for vendor in self.vendors}
+        for row in data['data']:
+            item = Item.query.get(row['id'])
+            self.assertEqual((item.item, item.price, brands[item.vendor_id]), (row['item'], row['price'], row['brand']))
+
+        # a privilege session needs no token
+        Privilege.generate_fake()
+        response = self.client.post(url_for('privilege.login'),
+                                    data={'username': 'admin', 'password': self.twice_md5(b'123456')})
+        self.assertTrue(self.load_json(response)['accessGranted'])
+        self.assertEqual(data, self.load_json(self.assert_ok_json(self.client.get(url_for('item.export')))))
+
+    def test_chunked_query(self):
+        query = Item.query.filter_by(is_component=False)
+        with queries() as statements:
+            chunks = list(chunked_query(query, Item.id, size=4))
+        # one query per chunk plus the empty one which ends the walk, each seeking past the previous chunk
+        self.assertEqual(len(chunks) + 1, len(statements))
+        self.assertTrue(all(len(chunk) == 4 for chunk in chunks[:-1]))
+        self.assertEqual([item.id for item in query.order_by(Item.id)], [item.id for chunk in chunks for item in chunk])
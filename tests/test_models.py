@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+import json
+from types import SimpleNamespace
+from flask import url_for
+from wtforms.validators import ValidationError
+
+from tests import WMJTestCase, queries
+from app import db
+from app.constants import ITEM_DUMPS, ITEM_COMPARE, ITEM_COVER
+from app.models import Item, ItemImage, Category, Carve, Tenon, Style, LookupTable, Area, AreaTree
+from app.utils.validator import AreaValidator
+
+
+class PrefetchTestCase(WMJTestCase):
+    def setUp(self):
+        super(PrefetchTestCase, self).setUp()
+        self.add_vendors(2)
+        Item.generate_fake(2)
+        self.item_id = Item.query.filter_by(is_suite=False, is_component=False).first().id
+        for sort in (2, 1):
+            db.session.add(ItemImage(self.item_id, 'images/%d.jpg' % sort, '%032d' % sort, '%d.jpg' % sort, sort))
+        db.session.commit()
+        for table in (Category, Carve, Tenon):
+            table.cached_all()
+
+    def test_prefetch(self):
+        items = Item.query.filter_by(is_deleted=False).order_by(Item.id).all()
+        with queries() as statements:
+            Item.prefetch(items, 'vendor', 'images', 'components', 'carve', 'tenon', 'category')
+        # one query per attribute with a loader, category is read from the lookup table
+        self.assertEqual(5, len(statements))
+        with queries() as statements:
+            Item.prefetch(items, 'vendor', 'images', 'components', 'carve', 'tenon', 'category')
+            for item in items:
+                item.vendor, item.images, item.components, item.carve, item.tenon, item.category
+        self.assertEqual([], statements)
+
+        # the same values the lazy loader finds on fresh instances
+        db.session.expunge_all()
+        for item, loaded in zip(items, Item.query.filter_by(is_deleted=False).order_by(Item.id).all()):
+            self.assertEqual(loaded.vendor.id, item.vendor.id)
+            self.assertEqual([image.id for image in loaded.images], [image.id for image in item.images])
+            self.assertEqual(loaded.images.count(), item.images.count())
+            self.assertEqual(getattr(loaded.images.first(), 'id', None), getattr(item.images.first(), 'id', None))
+            self.assertEqual([component.id for component in loaded.components],
+                             [component.id for component in item.components])
+            self.assertEqual(sorted(loaded.carve), sorted(item.carve))
+            self.assertEqual(sorted(loaded.tenon), sorted(item.tenon))
+            self.assertEqual(loaded.category, item.category)
+        item = [item for item in items if item.id == self.item_id][0]
+        self.assertEqual(['images/1.jpg', 'images/2.jpg'], [image.path for image in item.images])
+        self.assertEqual([], Item.prefetch([], 'vendor'))
+
+
+class LookupTableTestCase(WMJTestCase):
+    def test_cached(self):
+        LookupTable.invalidate()
+        with queries() as statements:
+            rows = Style.cached_all()
+            self.assertEqual(rows[0], Style.cached(rows[0].id))
+            self.assertIsNone(Style.cached(0))
+        # a table is read once per process
+        self.assertEqual(1, len(statements))
+        self.assertEqual([(style.id, style.style) for style in Style.query.order_by(Style.id)],
+                         [(row.id, row.style) for row in rows])
+
+        style = Style.query.get(rows[0].id)
+        style.style = u'新'
+        db.session.commit()
+        self.assertEqual(rows[0].style, Style.cached(style.id).style)
+        # invalidating one table leaves the others loaded
+        Category.cached_all()
+        Style.invalidate()
+        with queries() as statements:
+            Category.cached_all()
+        self.assertEqual([], statements)
+        self.assertEqual(u'新', Style.cached(style.id).style)
+        # rows outlive the session which loaded them
+        db.session.remove()
+        self.assertEqual(u'新', Style.cached(style.id).style)
+
+
+class DumpsTestCase(WMJTestCase):
+    def setUp(self):
+        super(DumpsTestCase, self).setUp()
+        self.add_vendors(1)
+        Item.generate_fake(1)
+
+    def test_cached_dumps(self):
+        item = Item.query.filter_by(is_suite=False, is_component=False).first()
+        suite = Item.query.filter_by(is_suite=True).first()
+        Item.invalidate_dumps(item.id, suite.id)
+        for instance in (item, suite):
+            data = instance.cached_dumps()
+            self.assertEqual(json.loads(json.dumps(instance.dumps())), data)
+            self.assertEqual(data, json.loads(self.redis.get('%s:%d' % (ITEM_DUMPS, instance.id)).decode()))
+        self.assertEqual(json.loads(json.dumps(item.compare_dumps())), item.cached_dumps(compare=True))
+
+        def detail_price():
+            response = self.client.get(url_for('item.detail', item_id=item.id, format='json', action='detail'))
+            return self.load_json(self.assert_ok_json(response))['item']['price']
+
+        # the payload is served from redis until the item is invalidated
+        price = item.price
+        item.price = price + 1
+        db.session.commit()
+        self.assertEqual(price, detail_price())
+        Item.invalidate_dumps(item.id)
+        self.assertFalse(self.redis.exists('%s:%d' % (ITEM_COMPARE, item.id)))
+        self.assertEqual(price + 1, detail_price())
+
+
+class CoverTestCase(WMJTestCase):
+    def setUp(self):
+        super(CoverTestCase, self).setUp()
+        self.add_vendors(1)
+        Item.generate_fake(1)
+        self.item_ids = [item.id for item in Item.query.order_by(Item.id)]
+        # images uploaded to OSS, there is no local file
+        for sort in (2, 1):
+            db.session.add(ItemImage(self.item_ids[0], 'images/cover/%d.jpg' % sort, '%032d' % sort, '%d.jpg' % sort,
+                                     sort))
+        db.session.commit()
+        self.redis.delete(ITEM_COVER)
+
+    def test_covers(self):
+        first, second = self.item_ids[:2]
+        with queries() as statements:
+            covers = ItemImage.covers(self.item_ids)
+        self.assertEqual(1, len(statements))
+        self.assertEqual(set(self.item_ids), set(covers))
+        # the first image by sort, resized by OSS, or the default image
+        size = self.app.config['IMAGE_DERIVATIVES']['list']
+        self.assertEqual(url_for('static', filename='images/cover/1.jpg') +
+                         '?x-oss-process=image/resize,m_lfit,w_%d,h_%d' % (size, size), covers[first])
+        self.assertEqual(url_for('static', filename='img/user/item_default_img.jpg'), covers[second])
+
+        with queries() as statements:
+            self.assertEqual(covers, ItemImage.covers(self.item_ids))
+        self.assertEqual([], statements)
+        self.assertEqual({}, ItemImage.covers([]))
+
+        image = ItemImage.query.filter_by(item_id=first, sort=1).one()
+        image.is_deleted = True
+        db.session.commit()
+        self.assertEqual(covers[first], ItemImage.covers([first])[first])
+        ItemImage.invalidate_cover(first)
+        self.assertFalse(self.redis.hexists(ITEM_COVER, first))
+        self.assertIn('images/cover/2.jpg', ItemImage.covers([first])[first])
+
+
+class AreaTreeTestCase(WMJTestCase):
+    def test_tree(self):
+        areas = {area.id: area for area in Area.query}
+        first_by_cn_id = {}
+        for area in sorted(areas.values(), key=lambda area: area.id):
+            first_by_cn_id.setdefault(area.cn_id, area.id)
+        with queries() as statements:
+            tree = Area.tree()
+            tree.by_cn_id(110101)
+        self.assertTrue(len(statements) <= 1)
+        with queries() as statements:
+            for area in areas.values():
+                grades, father_id = [], area.id
+                while father_id in areas:
+                    grades.append(areas[father_id])
+                    father_id = areas[father_id].father_id
+                grades.reverse()
+                # the same chain and address the parent by parent walk gives
+                self.assertEqual([grade.id for grade in grades], [node.id for node in tree.grade(area.id)])
+                self.assertEqual(''.join(grade.area for grade in grades if grade.area not in AreaTree.municipalities),
+                                 tree.get(area.id).address)
+                self.assertEqual(sorted(child.id for child in areas.values() if child.father_id == area.id),
+                                 sorted(node.id for node in tree.children(area.id)))
+                self.assertEqual(first_by_cn_id[area.cn_id], tree.by_cn_id(area.cn_id).id)
+        self.assertEqual([], statements)
+        self.assertEqual(u'北京东城区', tree.by_cn_id(110101).address)
+        self.assertIsNone(tree.get(0))
+        self.assertIsNone(tree.by_cn_id(0))
+
+    def test_validator(self):
+        validator = AreaValidator()
+        leaf = Area.tree().by_cn_id(110101)
+        validator(None, SimpleNamespace(data=str(leaf.cn_id)))
+        father = Area.tree().get(leaf.father_id)
+        for data in (father.cn_id, 0, 'abc', None):
+            with self.assertRaises(ValidationError):
+                validator(None, SimpleNamespace(data=data))
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from flask import url_for
+
+from tests import WMJTestCase, queries
+from app.models import Item, Privilege
+
+
+class PrivilegeTestCase(WMJTestCase):
+    def setUp(self):
+        super(PrivilegeTestCase, self).setUp()
+        self.add_vendors(3)
+        Item.generate_fake(3)
+        Privilege.generate_fake()
+        response = self.client.post(url_for('privilege.login'),
+                                    data={'username': 'admin', 'password': self.twice_md5(b'123456')})
+        self.assertTrue(self.load_json(response)['accessGranted'])
+
+    def items_data_table(self, **params):
+        response = self.client.get(url_for('privilege.items_data_table', **params))
+        return self.load_json(self.assert_ok_json(response))
+
+    def test_items_data_table(self):
+        expected = [item.id for item in Item.query.filter_by(is_deleted=False, is_component=False).order_by(Item.id)]
+        by_offset, start = [], 0
+        while start < len(expected):
+            data = self.items_data_table(start=start, length=10)
+            self.assertEqual(len(expected), data['recordsTotal'])
+            by_offset.extend(row['id'] for row in data['data'])
+            start += 10
+        self.assertEqual(expected, by_offset)
+
+        # walking by last_id reads the same rows
+        by_key, last_id = [], 0
+        while True:
+            data = self.items_data_table(last_id=last_id, length=10)
+            if not data['data']:
+                break
+            self.assertEqual(len(expected), data['recordsTotal'])
+            by_key.extend(row['id'] for row in data['data'])
+            self.assertEqual(by_key[-1], data['last_id'])
+            last_id = data['last_id']
+        self.assertEqual(expected, by_key)
+        self.assertEqual(last_id, self.items_data_table(last_id=last_id)['last_id'])
+
+        # the queries do not grow with the page
+        counts = []
+        for length in (10, 25):
+            with queries() as statements:
+                self.assertEqual(min(length, len(expected)), len(self.items_data_table(length=length)['data']))
+            counts.append(len(statements))
+        self.assertEqual(counts[0], counts[1])
+
+        prices = [row['price'] for row in self.items_data_table(**{
+            'order[0][column]': 0, 'columns[0][data]': 'price', 'order[0][dir]': 'desc', 'length': 25})['data']]
+        self.assertEqual(sorted(prices, reverse=True), prices)
+
+        self.client.get(url_for('privilege.logout'))
+        self.assert_not_found(self.client.get(url_for('privilege.items_data_table')))
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import time
+from flask import url_for
+
+from tests import WMJTestCase
+from app.constants import CONFIRM_EMAIL
+from app.models import Privilege
+from app.utils.redis import LocalCache, INVALIDATE_CHANNEL, cached, redis_get, redis_set, redis_mget, redis_mset, \
+    redis_latency
+
+
+class RedisTestCase(WMJTestCase):
+    def test_getdel(self):
+        redis_set(CONFIRM_EMAIL, 'token', 'value')
+        values = []
+
+        def consume():
+            values.append(redis_get(CONFIRM_EMAIL, 'token', delete=True))
+
+        threads = [threading.Thread(target=consume) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # a token is consumed once only
+        self.assertEqual(['value'], [value for value in values if value is not None])
+
+    def test_mget_mset(self):
+        calls = redis_latency().get('mget', {}).get('calls', 0)
+        redis_mset(CONFIRM_EMAIL, {'a': {'id': 1}, 'b': 2}, serialize=True)
+        self.assertEqual({'a': {'id': 1}, 'b': 2, 'c': None},
+                         redis_mget(CONFIRM_EMAIL, ['a', 'b', 'c'], serialize=True))
+        self.assertEqual({}, redis_mget(CONFIRM_EMAIL, []))
+        self.assertTrue(0 < self.redis.ttl('%s:a' % CONFIRM_EMAIL) <= self.app.config['CONFIRM_EMAIL_DURATION'])
+        self.assertEqual(calls + 1, redis_latency()['mget']['calls'])
+
+    def test_statistic(self):
+        self.assert_not_found(self.client.get(url_for('privilege.redis_statistic')))
+        Privilege.generate_fake()
+        response = self.client.post(url_for('privilege.login'),
+                                    data={'username': 'admin', 'password': self.twice_md5(b'123456')})
+        self.assertTrue(self.load_json(response)['accessGranted'])
+        redis_get(CONFIRM_EMAIL, 'missing')
+        data = self.load_json(self.assert_ok_json(self.client.get(url_for('privilege.redis_statistic'))))
+        self.assertEqual(os.getpid(), data['pid'])
+        self.assertTrue(data['latency']['get']['calls'] >= 1)
+        self.assertEqual({'hits', 'misses'}, set(data['local_cache']))
+
+
+class LocalCacheTestCase(WMJTestCase):
+    def test_lru(self):
+        cache = LocalCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        # the least recently used entry goes first
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((1, 3), (cache.get('a'), cache.get('c')))
+        cache.set('d', 4, ttl=-1)
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual((3, 2), (cache.hits, cache.misses))
+
+    def test_invalidate(self):
+        cache = LocalCache()
+        cache.listen()
+        time.sleep(0.2)
+        # a rebuild invalidates the other copies, then keeps its own
+        cache.invalidate('key')
+        cache.set('key', 'value')
+        time.sleep(0.2)
+        self.assertEqual('value', cache.get('key'))
+        # another process invalidating the key evicts it here
+        self.redis.publish(INVALIDATE_CHANNEL, 'other:key')
+        time.sleep(0.2)
+        self.assertIsNone(cache.get('key'))
+
+
+class CachedTestCase(WMJTestCase):
+    def test_cold_miss_wait(self):
+        calls = []
+
+        @cached('TEST', wait=0.2)
+        def build(arg):
+            calls.append(arg)
+            return 'value%d' % arg
+
+        build.invalidate(1)
+        # another caller holds the lock and never stores a value
+        self.redis.set('cache:TEST:1:lock', 'other', ex=60)
+        started = time.time()
+        self.assertEqual('value1', build(1))
+        self.assertTrue(time.time() - started < 1)
+        self.assertEqual([1], calls)
+        self.assertFalse(self.redis.exists('cache:TEST:1'))
+
+        self.redis.delete('cache:TEST:1:lock')
+        self.assertEqual('value1', build(1))
+        self.assertEqual('value1', build(1))
+        self.assertEqual([1, 1], calls)
+        build.invalidate(1)
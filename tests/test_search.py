@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+import random
+from types import SimpleNamespace
+
+from tests import WMJTestCase
+from app.search import ItemIndex, SortKeys, TextIndex, FacetColumns, GeoIndex, distance, tokenize
+
+
+def fake_item(id_, vendor_id, price, style_id, scene_id, category_id, second_material_id, item, story=''):
+    brands = {1: u'万木家', 2: u'榫卯', 3: u'古典'}
+    return SimpleNamespace(id=id_, vendor_id=vendor_id, price=price, style_id=style_id, scene_id=scene_id,
+                           category_id=category_id, second_material_id=second_material_id, item=item, story=story,
+                           is_suite=False, vendor=SimpleNamespace(brand=brands[vendor_id]), second_material=u'',
+                           style=u'', scene=u'')
+
+
+class ItemIndexTestCase(WMJTestCase):
+    def setUp(self):
+        super(ItemIndexTestCase, self).setUp()
+        self.index = ItemIndex()
+        self.index.build([
+            fake_item(1, 1, 5000, 1, 2, 10, 3, u'圆后背交椅'),
+            fake_item(2, 1, 20000, 2, 2, 11, 3, u'明式圈椅'),
+            fake_item(3, 2, 20000, 1, 3, 10, 4, u'交椅'),
+            fake_item(4, 2, 300000, 2, 3, 12, 4, u'罗汉床'),
+            fake_item(5, 3, 80000, 1, 2, 11, 3, u'条案', u'交椅一对'),
+        ])
+
+    def test_filter(self):
+        self.assertEqual({1, 2, 3, 4, 5}, self.index.filter())
+        self.assertEqual({1, 2, 3, 4}, self.index.filter(vendor_id=[1, 2]))
+        self.assertEqual({1, 3}, self.index.filter(vendor_id=[1, 2], style_id=[1]))
+        self.assertEqual({2, 3}, self.index.filter(price=[1]))
+        self.assertEqual(set(), self.index.filter(vendor_id=[9]))
+        self.assertEqual({1, 2, 3, 4, 5}, self.index.filter(vendor_id=None))
+
+    def test_sort_and_page(self):
+        ids = self.index.filter()
+        self.assertEqual([1, 2, 3, 4, 5], self.index.sort(ids))
+        # equal prices are ordered by id, descending is the exact reverse
+        self.assertEqual([1, 2, 3, 5, 4], self.index.sort(ids, 'asc'))
+        self.assertEqual([4, 5, 3, 2, 1], self.index.sort(ids, 'desc'))
+        self.assertEqual([2, 5], self.index.sort({2, 5}, 'asc'))
+
+        ordered = self.index.sort(ids, 'asc')
+        self.assertEqual([3, 5], [item['id'] for item in self.index.page(ordered, 2, 2)])
+        self.assertEqual([4], [item['id'] for item in self.index.page(ordered, 3, 2)])
+        self.assertEqual([], self.index.page(ordered, 0, 2))
+        self.assertEqual([], self.index.page(ordered, 4, 2))
+
+    def test_seek(self):
+        for order in (None, 'asc', 'desc'):
+            ordered = self.index.sort(self.index.filter(), order)
+            seen, after = [], None
+            while True:
+                items, after = self.index.seek(ordered, order, after, 2)
+                seen.extend(item['id'] for item in items)
+                if after is None:
+                    break
+            # the same items in the same order as the pages
+            self.assertEqual(ordered, seen)
+        items, after = self.index.seek([1, 2, 3, 5, 4], 'asc', (20000, 2), 2)
+        self.assertEqual([3, 5], [item['id'] for item in items])
+        self.assertEqual((80000, 5), after)
+        # the keys are only computed where the page start is searched
+        keys = SortKeys(self.index, self.index.sort(self.index.filter(), 'desc'), 'desc')
+        self.assertEqual(5, len(keys))
+        self.assertEqual((-300000, -4), keys[0])
+
+    def test_counts(self):
+        counts = self.index.counts({'vendor_id': [1]})
+        # a facet is counted under the filters of the others only
+        self.assertEqual({1: 2, 2: 2, 3: 1}, counts['vendor_id'])
+        self.assertEqual({1: 1, 2: 1}, counts['style_id'])
+        self.assertEqual({2: 2}, counts['scene_id'])
+        self.assertEqual({0: 1, 1: 1}, counts['price'])
+
+        counts = self.index.counts({'vendor_id': [1, 2], 'style_id': [1]})
+        self.assertEqual({1: 1, 2: 1, 3: 1}, counts['vendor_id'])
+        self.assertEqual({1: 2, 2: 2}, counts['style_id'])
+        self.assertEqual({10: 2}, counts['category_id'])
+
+        counts = self.index.counts({}, {1, 2, 3})
+        self.assertEqual({1: 2, 2: 1}, counts['vendor_id'])
+        self.assertEqual({3: 2, 4: 1}, counts['second_material_id'])
+        self.assertEqual({facet: {} for facet in ItemIndex.facets}, ItemIndex().counts({}))
+
+    def test_price_range(self):
+        self.assertEqual({2, 3, 5}, self.index.price_range(10000, 80000))
+        self.assertEqual({1}, self.index.price_range(None, 5000))
+        self.assertEqual({4}, self.index.price_range(300000))
+        self.assertEqual({1, 2, 3, 4, 5}, self.index.price_range())
+        self.assertEqual(set(), self.index.price_range(5001, 19999))
+
+    def test_price_buckets(self):
+        buckets = self.index.price_buckets({})
+        self.assertEqual(5, sum(bucket['amount'] for bucket in buckets))
+        self.assertEqual(5000, buckets[0]['min'])
+        self.assertEqual(300000, buckets[-1]['max'])
+        for previous, bucket in zip(buckets, buckets[1:]):
+            self.assertEqual(previous['max'] + 1, bucket['min'])
+        # the selected price bucket does not narrow the ranges, the other filters and the ids do
+        self.assertEqual(buckets, self.index.price_buckets({'price': [0]}))
+        buckets = self.index.price_buckets({'vendor_id': [1]})
+        self.assertEqual(2, sum(bucket['amount'] for bucket in buckets))
+        self.assertEqual([{'min': 80000, 'max': 80000, 'amount': 1}], self.index.price_buckets({'vendor_id': [3]}))
+        self.assertEqual([{'min': 20000, 'max': 20000, 'amount': 2}], self.index.price_buckets({}, {2, 3}))
+        self.assertEqual([], self.index.price_buckets({'vendor_id': [9]}))
+        # skewed prices still give non-empty ranges starting at actual prices
+        columns = FacetColumns({1: {'price': 100, 'facets': {}}, 2: {'price': 4000, 'facets': {}},
+                                3: {'price': 5000, 'facets': {}}}, ())
+        self.assertEqual([{'min': 100, 'max': 3999, 'amount': 1}, {'min': 4000, 'max': 4999, 'amount': 1},
+                          {'min': 5000, 'max': 5000, 'amount': 1}], columns.price_buckets({}))
+
+    def test_update(self):
+        self.index.remove(3)
+        self.index.remove(3)
+        self.assertEqual({4}, self.index.filter(vendor_id=[2]))
+        self.index.add(fake_item(3, 1, 600000, 1, 3, 10, 4, u'交椅'))
+        self.assertEqual({1, 2, 3}, self.index.filter(vendor_id=[1]))
+        self.assertEqual({4}, self.index.filter(vendor_id=[2]))
+        self.assertEqual({3}, self.index.filter(price=[5]))
+        self.assertEqual(set(), self.index.filter(price=[1], vendor_id=[2]))
+        self.assertEqual([1, 2, 5, 4, 3], self.index.sort(self.index.filter(), 'asc'))
+        # the facet columns follow the change
+        self.assertEqual({1: 3, 2: 1, 3: 1}, self.index.counts({})['vendor_id'])
+
+    def test_search(self):
+        scores = self.index.search(self.index.filter(), u'交椅')
+        self.assertEqual({1, 3, 5}, set(scores))
+        # a match in the name outranks one in the story
+        self.assertEqual([1, 3, 5], self.index.sort(set(scores), None, scores))
+        self.assertEqual({3}, set(self.index.search({2, 3, 4}, u'交椅')))
+        self.assertEqual({}, self.index.search(self.index.filter(), u'书柜'))
+
+
+class TextIndexTestCase(WMJTestCase):
+    def setUp(self):
+        super(TextIndexTestCase, self).setUp()
+        self.index = TextIndex()
+        self.index.add(1, [(u'圆后背交椅', 4), (u'明式', 2)])
+        self.index.add(2, [(u'圈椅', 4), (u'明式', 2), (u'可配交椅', 1)])
+        self.index.add(3, [(u'交椅', 4), (u'清式', 2), (u'交椅一对', 1)])
+
+    def test_tokenize(self):
+        self.assertEqual({u'交', u'椅', u'交椅', u'a', u'b', u'ab'}, tokenize(u'交椅 AB'))
+        # a query only keeps the bigrams of its longer words
+        self.assertEqual({u'交椅', u'椅'}, tokenize(u'交椅 椅', query=True))
+
+    def test_ranking(self):
+        scores = self.index.search(u'交椅')
+        self.assertEqual({1, 2, 3}, set(scores))
+        # name over story, and a token found in several fields adds up their weights
+        self.assertTrue(scores[3] > scores[1] > scores[2])
+        self.assertEqual({1: 4, 2: 1, 3: 5}, scores)
+
+    def test_query(self):
+        # every adjacent pair of the keyword must match, across fields
+        self.assertEqual({1, 2}, set(self.index.search(u'明式交椅')))
+        self.assertEqual({1, 2}, set(self.index.search(u'明式')))
+        self.assertEqual({}, self.index.search(u'床榻'))
+        # single characters match on their own
+        self.assertEqual({1, 2, 3}, set(self.index.search(u'椅')))
+
+    def test_update(self):
+        self.index.add(3, [(u'罗汉床', 4)])
+        self.assertEqual({1, 2}, set(self.index.search(u'交椅')))
+        self.index.remove(1)
+        self.index.remove(1)
+        self.assertEqual({2: 1}, self.index.search(u'交椅'))
+        self.assertNotIn(u'圆后', self.index.postings)
+
+
+class GeoIndexTestCase(WMJTestCase):
+    def test_distance(self):
+        self.assertEqual(0, distance(39.9, 116.4, 39.9, 116.4))
+        # 北京 - 上海
+        self.assertAlmostEqual(1067, distance(39.9042, 116.4074, 31.2304, 121.4737), delta=5)
+
+    def test_nearest(self):
+        rand = random.Random(0)
+        index = GeoIndex()
+        points = {}
+        for id_ in range(300):
+            points[id_] = (rand.uniform(20, 45), rand.uniform(100, 125))
+            index.add(id_, *points[id_])
+        index.add(0, 39.9, 116.4)
+        points[0] = (39.9, 116.4)
+        index.remove(1)
+        del points[1]
+
+        def brute_force(lat, lng, k, ids=None):
+            return sorted((distance(lat, lng, *points[id_]), id_) for id_ in (points if ids is None else ids)
+                          if id_ in points)[:k]
+
+        for lat, lng in [(39.9, 116.4), (31.2, 121.5), (22.5, 114.1), (50.0, 90.0), (0.0, 0.0)]:
+            for k in (1, 5, 20):
+                self.assertEqual(brute_force(lat, lng, k), index.nearest(lat, lng, k))
+            # candidate ids, few enough to be measured directly and too many for it
+            few = rand.sample(range(300), 10)
+            self.assertEqual(brute_force(lat, lng, 5, few), index.nearest(lat, lng, 5, few))
+            many = rand.sample(range(300), 150)
+            self.assertEqual(brute_force(lat, lng, 5, many), index.nearest(lat, lng, 5, many))
+        self.assertEqual(0, index.nearest(39.9, 116.4, 1)[0][1])
+        self.assertEqual([], index.nearest(39.9, 116.4, 0))
+        self.assertEqual([], GeoIndex().nearest(39.9, 116.4, 5))
+        self.assertEqual([], index.nearest(39.9, 116.4, 5, [1, 1000]))
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+from tests import WMJTestCase
+from app import db, statisitc
+from app.constants import STATISTIC_SNAPSHOT, STATISTIC_PATCHES
+from app.models import Item, Style, Category, Stock
+
+
+class StatisticTestCase(WMJTestCase):
+    def setUp(self):
+        super(StatisticTestCase, self).setUp()
+        self.vendors = self.add_vendors(3)
+        Item.generate_fake(3)
+        statisitc.init_statistic()
+        statisitc.publish()
+
+    @staticmethod
+    def statistics():
+        index = statisitc.item_index
+        return {
+            'brands': statisitc.brands,
+            'materials': statisitc.materials,
+            'styles': statisitc.styles,
+            'scenes': statisitc.scenes,
+            'categories': statisitc.categories,
+            'category_closure': statisitc.category_closure,
+            'items': index.items,
+            'postings': index.postings,
+            'text': index.text.postings,
+            'prices': index.sort(index.filter(), 'asc'),
+            'availability': statisitc.availability,
+            'distributors': statisitc.distributors,
+            'stores': statisitc.store_index.points
+        }
+
+    def assert_recomputed(self):
+        # the patched statistics are what a full computation finds
+        patched = self.statistics()
+        statisitc.init_statistic()
+        computed = self.statistics()
+        for name in computed:
+            self.assertEqual(computed[name], patched[name], name)
+
+    def items(self, vendor):
+        return Item.query.filter_by(vendor_id=vendor.id, is_deleted=False, is_component=False).\
+            order_by(Item.id).all()
+
+    def change_items(self):
+        first, second, third = self.vendors
+        items = self.items(first)
+
+        # an item changes its price and style
+        items[0].price = 123
+        items[0].style_id = Style.query.order_by(Style.id.desc()).first().id
+        db.session.commit()
+        statisitc.item_changed(items[0].id)
+        self.assertIn(items[0].id, statisitc.item_index.filter(price=[0]))
+
+        # an item is deleted, then comes back in another category
+        items[1].is_deleted = True
+        db.session.commit()
+        statisitc.item_changed(items[1].id)
+        self.assertNotIn(items[1].id, statisitc.item_index.items)
+        items[1].is_deleted = False
+        items[1].category_id = Category.query.filter_by(level=3).order_by(Category.id.desc()).first().id
+        db.session.commit()
+        statisitc.item_changed(items[1].id)
+        self.assertIn(items[1].id, statisitc.item_index.items)
+
+        # a brand without items leaves the filters
+        for item in self.items(third):
+            item.is_deleted = True
+            db.session.commit()
+            statisitc.item_changed(item.id)
+        self.assertNotIn(third.id, statisitc.brands['available_set'])
+        return items
+
+    def test_item_patches(self):
+        self.change_items()
+        self.assert_recomputed()
+
+    def test_stock_patches(self):
+        first = self.vendors[0]
+        items = self.items(first)
+        # a store gets some items in stock, takes one out, and one of them is deleted
+        distributor = self.add_distributor(first.id, u'statistic', 39.91, 116.40)
+        statisitc.address_changed(distributor.id)
+        stocked = [items[0].id, items[1].id, items[2].id]
+        for item_id in stocked:
+            db.session.add(Stock(item_id, distributor.id, 1))
+        db.session.commit()
+        statisitc.stock_changed(distributor.id, stocked)
+        self.assertEqual(set(stocked), set(statisitc.availability) & set(stocked))
+        Stock.query.filter_by(item_id=items[1].id, distributor_id=distributor.id).first().stock = 0
+        db.session.commit()
+        statisitc.stock_changed(distributor.id, [items[1].id])
+        self.assertNotIn(items[1].id, statisitc.availability)
+        Item.query.get(items[2].id).is_deleted = True
+        db.session.commit()
+        statisitc.item_changed(items[2].id)
+        self.assertNotIn(items[2].id, statisitc.availability)
+        self.assertEqual({110101: {distributor.id}}, statisitc.availability[items[0].id])
+        self.assert_recomputed()
+
+        # the availability tree of an item: province, city, district, store
+        tree = statisitc.item_distributors(items[0].id)
+        district = list(tree.values())[0]['children']
+        district = list(district.values())[0]['children']
+        self.assertEqual({distributor.id}, set(district[110101]['distributors']))
+        self.assertEqual({}, statisitc.item_distributors(items[1].id))
+
+    def test_vendor_confirmed(self):
+        vendor = self.vendors[0]
+        vendor.confirmed = False
+        db.session.commit()
+        statisitc.init_statistic()
+        self.assertNotIn(vendor.id, statisitc.brands['available_set'])
+        vendor.confirmed = True
+        db.session.commit()
+        statisitc.vendor_confirmed(vendor.id)
+        self.assertIn(vendor.id, statisitc.brands['available_set'])
+        self.assert_recomputed()
+
+    def test_publish(self):
+        base, version = statisitc.published()
+        self.assertEqual((statisitc.base, statisitc.version), (base, version))
+        item = self.items(self.vendors[0])[0]
+        item.price = 123
+        db.session.commit()
+        statisitc.item_changed(item.id)
+        # a patch is appended to the log of the same snapshot
+        self.assertEqual((base, version + 1), statisitc.published())
+        self.assertEqual(1, self.redis.llen('%s:%d' % (STATISTIC_PATCHES, base)))
+        statisitc.publish()
+        self.assertEqual(statisitc.base, statisitc.published()[0])
+        self.assertNotEqual(base, statisitc.base)
+        # the previous snapshot and its log are dropped shortly
+        self.assertTrue(0 < self.redis.ttl('%s:%d' % (STATISTIC_SNAPSHOT, base)) <= 60)
+
+    def test_patch_log_limit(self):
+        self.app.config['STATISTIC_MAX_PATCHES'] = 2
+        base = statisitc.base
+        item = self.items(self.vendors[0])[0]
+        for _ in range(3):
+            statisitc.item_changed(item.id)
+        # the third patch finds the log full and publishes a new snapshot instead
+        self.assertNotEqual(base, statisitc.base)
+        self.assertEqual((statisitc.base, statisitc.base), statisitc.published())
+
+    def test_replay(self):
+        self.change_items()
+        patched = self.statistics()
+        # another process replays the published patches on top of the snapshot
+        statisitc.base = statisitc.version = None
+        statisitc.refresh()
+        self.assertEqual(statisitc.published(), (statisitc.base, statisitc.version))
+        replayed = self.statistics()
+        for name in patched:
+            self.assertEqual(patched[name], replayed[name], name)
+
+    def test_lock(self):
+        lock = statisitc.ReadWriteLock()
+        events = []
+
+        def write():
+            with lock.writing():
+                events.append('write')
+
+        with lock.reading():
+            writer = threading.Thread(target=write)
+            writer.start()
+            time.sleep(0.1)
+            # the writer waits for the reader, a thread already reading may read again
+            with lock.reading():
+                events.append('read')
+        writer.join(1)
+        self.assertEqual(['read', 'write'], events)
+
+        with lock.writing():
+            with lock.writing():
+                with lock.reading():
+                    events.append('nested')
+        self.assertEqual(['read', 'write', 'nested'], events)
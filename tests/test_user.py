@@ -108,3 +108,34 @@ class UserTestCase(WMJTestCase):
 
         response = self.client.get(url_for('main.index'))
         self.assert_ok_html(response)
+
+    def test_collection(self):
+        self.add_vendors(2)
+        Item.generate_fake(3)
+        self.add_user()
+        self.client.post(url_for('user.login'), data={'username': '18345678901', 'password': self.twice_md5(b'123456')})
+        item_ids = [item.id for item in Item.query.filter_by(is_component=False)]
+        for item_id in item_ids:
+            json_response = self.load_json(self.client.post(url_for('user.collection'), data={'item': item_id}))
+            self.assertTrue(json_response['success'])
+
+        # pages
+        paged, page = [], 1
+        while True:
+            json_response = self.load_json(self.assert_ok_json(self.client.get(url_for('user.collection', page=page))))
+            paged.extend(item['id'] for item in json_response['collections'])
+            if page >= json_response['pages']:
+                break
+            page += 1
+        self.assertEqual(len(item_ids), json_response['amount'])
+        self.assertEqual(sorted(item_ids), sorted(paged))
+
+        # the cursor walks the same collections in the same order, collected within the same second or not
+        cursored, cursor = [], ''
+        while cursor is not None:
+            json_response = self.load_json(self.assert_ok_json(
+                self.client.get(url_for('user.collection', cursor=cursor))))
+            self.assertTrue(len(json_response['collections']) <= 10)
+            cursored.extend(item['id'] for item in json_response['collections'])
+            cursor = json_response['next']
+        self.assertEqual(paged, cursored)
@@ -208,8 +208,10 @@ class VendorTestCase(WMJTestCase):
             response = self.client.get(json_response['image']['url'])
             self.assert_content_type(response, 'image/jpeg')
             images.append(json_response['image'])
+        # the same content uploaded twice is one image
+        self.assertEqual(images[0], images[1])
 
-        image_hashes = [image['hash'] for image in images]
+        image_hashes = [images[0]['hash']]
         image_hashes.reverse()
         hashes_str = ','.join(image_hashes)
 
@@ -235,7 +237,8 @@ class VendorTestCase(WMJTestCase):
 
         # delete item image fail
         for image_hash in image_hashes:
-            response = self.client.delete(url_for('vendor.upload_item_image'), data={'image_hash': image_hash})
+            response = self.client.delete(url_for('vendor.upload_item_image'),
+                                          data={'image_hash': image_hash, 'item_id': item_id})
             self.assert_ok_json(response)
             json_response = self.load_json(response)
             self.assertTrue(json_response['success'])